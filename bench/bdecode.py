@@ -0,0 +1,80 @@
+"""
+Time to load each test torrent and work out its info hash: bdecode reading the file a byte at a time and the
+info dict re-encoded to hash it, against bdecode_torrent slicing values out of the file's bytes and hashing the
+info dict's span of them.  The test torrents are all single file, so there's also a made up one with
+MANY_FILES files, which is where reading a byte at a time hurts.  Also the time to decode the test tracker response.
+
+Run from the repository root:
+    python -m bench.bdecode
+"""
+import os
+import time
+
+from hashlib import sha1
+
+from bencode import bdecode, bdecode_buffer, bdecode_torrent, bencode
+
+TORRENTS = 'test/torrents'
+TRACKER_RESPONSES = 'test/tracker_responses'
+MANY_FILES = 10000
+
+
+def many_files_torrent() -> bytes:
+    return bencode({
+        'announce': 'http://localhost/announce',
+        'info': {
+            'name': 'many',
+            'piece length': 1 << 18,
+            'pieces': os.urandom(20 * MANY_FILES // 4),
+            'files': [{'length': 1 << 16, 'path': ['dir', f'file{i}.bin']} for i in range(MANY_FILES)],
+        }
+    })
+
+
+def old_load(data: bytes) -> bytes:
+    d = bdecode(data)
+    return sha1(bencode(d['info'])).digest()
+
+
+def new_load(data: bytes) -> bytes:
+    d, info = bdecode_torrent(data)
+    return sha1(info).digest()
+
+
+def bench(f, data: bytes) -> float:
+    """Seconds per call"""
+    rounds = max(1, 2000000 // len(data))
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            f(data)
+        elapsed = (time.perf_counter() - start) / rounds
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    torrents = []
+    for name in sorted(os.listdir(TORRENTS)):
+        with open(os.path.join(TORRENTS, name), 'rb') as f:
+            torrents.append((name, f.read()))
+    torrents.append((f'{MANY_FILES} files', many_files_torrent()))
+
+    print(f'{"":>50} {"bdecode":>10} {"buffer":>10}')
+    for name, data in torrents:
+        assert old_load(data) == new_load(data)
+        old, new = bench(old_load, data), bench(new_load, data)
+        print(f'{name + f" ({len(data) >> 10} KiB)":>50} {old * 1e3:8.2f}ms {new * 1e3:8.2f}ms  {old / new:5.1f}x')
+
+    for name in sorted(os.listdir(TRACKER_RESPONSES)):
+        with open(os.path.join(TRACKER_RESPONSES, name), 'rb') as f:
+            data = f.read()
+
+        old, new = bench(bdecode, data), bench(bdecode_buffer, data)
+        print(f'{name + f" ({len(data)} B)":>50} {old * 1e6:8.1f}us {new * 1e6:8.1f}us  {old / new:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
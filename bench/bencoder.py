@@ -0,0 +1,122 @@
+"""
+Time to bencode each test torrent's decoded contents: the old encoder making several small writes to a BytesIO
+per value (and sorting each dict's items), against bencode building a list of chunks and joining it once.
+Also writing a .torrent back out with its info dict passed as the Torrent's cached encoded_info, and encoding a
+tracker style response.
+
+Run from the repository root:
+    python -m bench.bencoder
+"""
+import os
+import time
+
+from contextlib import redirect_stdout
+
+from collections.abc import Iterable, Mapping
+from io import BytesIO
+
+from bencode import Bencoded, bdecode_buffer, bencode
+from torrent import Torrent
+
+TORRENTS = 'test/torrents'
+MANY_FILES = 10000
+
+
+def old_bencode(data) -> bytes:
+    """bencode before encoding to chunks"""
+    def encode_buffer(string, f):
+        if isinstance(string, str):
+            string = string.encode()
+        f.write(str(len(string)).encode())
+        f.write(b':')
+        f.write(string)
+
+    def encode(data, f):
+        if isinstance(data, int):
+            f.write(b'i')
+            f.write(str(data).encode())
+            f.write(b'e')
+        elif isinstance(data, (str, bytes)):
+            encode_buffer(data, f)
+        elif isinstance(data, Mapping):
+            f.write(b'd')
+            for key, value in sorted(data.items()):
+                encode_buffer(key, f)
+                encode(value, f)
+            f.write(b'e')
+        elif isinstance(data, Iterable):
+            f.write(b'l')
+            for item in data:
+                encode(item, f)
+            f.write(b'e')
+
+    f = BytesIO()
+    encode(data, f)
+    return f.getvalue()
+
+
+def many_files() -> dict:
+    return {
+        'announce': 'http://localhost/announce',
+        'info': {
+            'name': 'many',
+            'piece length': 1 << 18,
+            'pieces': os.urandom(20 * MANY_FILES // 4),
+            'files': [{'length': 1 << 16, 'path': ['dir', f'file{i}.bin']} for i in range(MANY_FILES)],
+        }
+    }
+
+
+def tracker_response() -> dict:
+    return {
+        'interval': 1800,
+        'peers': [{'peer id': os.urandom(20), 'ip': f'10.0.{i >> 8}.{i & 255}', 'port': 6881 + i} for i in range(50)],
+    }
+
+
+def bench(f, data) -> float:
+    """Seconds per call"""
+    rounds = max(1, 200000 // (len(bencode(data)) // 64 + 1))
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            f(data)
+        elapsed = (time.perf_counter() - start) / rounds
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    cases = []
+    for name in sorted(os.listdir(TORRENTS)):
+        with open(os.path.join(TORRENTS, name), 'rb') as f:
+            cases.append((name, bdecode_buffer(f.read())))
+    cases.append((f'{MANY_FILES} files', many_files()))
+    cases.append(('tracker response, 50 peers', tracker_response()))
+
+    print(f'{"":>45} {"BytesIO":>10} {"chunks":>10}')
+    for name, data in cases:
+        assert old_bencode(data) == bencode(data)
+        old, new = bench(old_bencode, data), bench(bencode, data)
+        print(f'{name:>45} {old * 1e6:8.1f}us {new * 1e6:8.1f}us  {old / new:5.1f}x')
+
+    # Writing the 10000 file torrent back out, with its info dict already encoded
+    path = '/tmp/bench_bencoder.torrent'
+    with open(path, 'wb') as f:
+        bencode(many_files(), f)
+    with redirect_stdout(None):
+        t = Torrent(path, '/nonexistent')
+    metainfo = {'announce': t.announce, 'info': t.info}
+    cached = {'announce': t.announce, 'info': Bencoded(t.encoded_info)}
+    assert bencode(metainfo) == bencode(cached)
+
+    old, new = bench(bencode, metainfo), bench(bencode, cached)
+    print(f'{"10000 files, cached encoded_info":>45} {old * 1e6:8.1f}us {new * 1e6:8.1f}us  {old / new:5.1f}x'
+          f'  (chunks re-encoding info vs cached)')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
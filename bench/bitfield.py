@@ -0,0 +1,85 @@
+"""
+Bitfield operations at 100k pieces, with the int backed Bitfield against the old bytes backed one (which only
+had get(), and counted its set bits when it was made).
+
+A peer has half the pieces at random and we have the first 90%: building its bitfield from a BITFIELD message,
+counting its pieces, finding which of them we're missing, the first of those, and listing the set bits
+(what the picker does with a new peer's bitfield).
+
+Run from the repository root:
+    python -m bench.bitfield
+"""
+import os
+import time
+
+from bitfield import Bitfield, MutableBitfield
+
+NUM_PIECES = 100000
+
+
+class OldBitfield:
+    def __init__(self, bitfield: bytes):
+        self._bitfield = bitfield
+        self._num_set = sum(self)
+
+    def get(self, index):
+        return (self._bitfield[index // 8] >> (7 - (index % 8))) & 1
+
+    def num_set(self):
+        return self._num_set
+
+    def __iter__(self):
+        for i in range(0, len(self._bitfield)):
+            yield self._bitfield[i] >> 7 & 1
+            yield self._bitfield[i] >> 6 & 1
+            yield self._bitfield[i] >> 5 & 1
+            yield self._bitfield[i] >> 4 & 1
+            yield self._bitfield[i] >> 3 & 1
+            yield self._bitfield[i] >> 2 & 1
+            yield self._bitfield[i] >> 1 & 1
+            yield self._bitfield[i] & 1
+
+
+def timed(f, rounds=5) -> float:
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    theirs = os.urandom(NUM_PIECES // 8)
+    mine = MutableBitfield(NUM_PIECES)
+    for i in range(NUM_PIECES * 9 // 10):
+        mine.set(i)
+    old_mine = OldBitfield(bytes(mine))
+
+    old, new = OldBitfield(theirs), Bitfield(theirs)
+    assert old.num_set() == new.num_set()
+    old_missing = [i for i in range(NUM_PIECES) if old.get(i) and not old_mine.get(i)]
+    assert old_missing == list((new - mine).set_bits())
+
+    cases = (
+        ('build from BITFIELD', lambda: OldBitfield(theirs), lambda: Bitfield(theirs)),
+        ('count set', lambda: sum(old), lambda: new.num_set()),
+        ('pieces we are missing',
+         lambda: [i for i in range(NUM_PIECES) if old.get(i) and not old_mine.get(i)],
+         lambda: new - mine),
+        ('first piece we are missing',
+         lambda: next(i for i in range(NUM_PIECES) if old.get(i) and not old_mine.get(i)),
+         lambda: (new - mine).first_set()),
+        ('list set bits', lambda: [i for i, bit in enumerate(old) if bit], lambda: list(new.set_bits())),
+    )
+
+    print(f'{NUM_PIECES} pieces')
+    for name, old_f, new_f in cases:
+        old_t, new_t = timed(old_f), timed(new_f)
+        print(f'{name:>28}: {old_t * 1e6:9.1f}us -> {new_t * 1e6:8.1f}us  {old_t / new_t:7.0f}x')
+
+
+if __name__ == '__main__':
+    main()
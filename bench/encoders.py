@@ -0,0 +1,55 @@
+"""
+REQUEST and HAVE messages encoded per second: a packet object serialized for each one and the results joined,
+against serialize_many packing them all straight into one preallocated buffer.
+
+Batches are a pipeline's worth of requests for a peer, and a round of HAVEs.
+
+Run from the repository root:
+    python -m bench.encoders
+"""
+import time
+
+from packet import HavePacket, RequestPacket
+from storage import BLOCK_LEN, Request
+
+BATCH = 256
+ROUNDS = 2000
+
+
+def per_packet_requests(requests):
+    return b''.join(RequestPacket(r).serialize() for r in requests)
+
+
+def per_packet_haves(piece_indices):
+    return b''.join(HavePacket(i).serialize() for i in piece_indices)
+
+
+def bench(encode, batch) -> float:
+    """ns per message"""
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        encode(batch)
+
+    return (time.perf_counter() - start) / (ROUNDS * len(batch)) * 1e9
+
+
+def main():
+    requests = [Request(i // 16, (i % 16) * BLOCK_LEN, BLOCK_LEN) for i in range(BATCH)]
+    piece_indices = list(range(BATCH))
+
+    assert per_packet_requests(requests) == RequestPacket.serialize_many(requests)
+    assert per_packet_haves(piece_indices) == HavePacket.serialize_many(piece_indices)
+
+    print(f'Batches of {BATCH}')
+    for name, encode, batch in (
+            ('REQUEST per packet', per_packet_requests, requests),
+            ('REQUEST serialize_many', RequestPacket.serialize_many, requests),
+            ('HAVE per packet', per_packet_haves, piece_indices),
+            ('HAVE serialize_many', HavePacket.serialize_many, piece_indices),
+    ):
+        ns = min(bench(encode, batch) for _ in range(3))
+        print(f'{name:>24}: {ns:6.0f} ns/message  {1e3 / ns:6.2f}M messages/s')
+
+
+if __name__ == '__main__':
+    main()
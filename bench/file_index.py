@@ -0,0 +1,89 @@
+"""
+Time to find the files holding each block of a synthetic 100k file torrent, with the FileIndex binary search
+against the old linear scan through Torrent.end_offsets (which also rebuilt the offset list on every lookup).
+
+Uses lightweight stand-ins for TorrentFile, since opening 100k files would measure the filesystem instead.
+
+Run from the repository root:
+    python -m bench.file_index
+"""
+import random
+import time
+
+from collections import namedtuple
+
+from storage import BLOCK_LEN
+from torrent import FileIndex
+
+NUM_FILES = 100_000
+MAX_FILE_LEN = 64 * 1024
+PIECE_LEN = 256 * 1024
+LOOKUPS = 200
+
+File = namedtuple('File', ['offset', 'length'])
+
+
+class LinearScan:
+    """The old PieceIO.files_from_offset"""
+
+    def __init__(self, files: list):
+        self.start_offsets = [(f.offset, f) for f in files]
+
+    @property
+    def end_offsets(self) -> list:
+        return [(off + f.length, f) for off, f in self.start_offsets]
+
+    def files_from_offset(self, start_offset):
+        for off, f in self.end_offsets:
+            if off <= start_offset:
+                continue
+
+            yield f
+
+    def files_in_span(self, start_offset: int, length: int):
+        for f in self.files_from_offset(start_offset):
+            if f.offset >= start_offset + length:
+                break
+
+            yield f
+
+
+def make_files(rng: random.Random) -> list:
+    files = []
+    offset = 0
+    for _ in range(NUM_FILES):
+        length = rng.randrange(MAX_FILE_LEN)
+        files.append(File(offset, length))
+        offset += length
+
+    return files
+
+
+def run(index, offsets: list, length: int) -> float:
+    start = time.perf_counter()
+    for off in offsets:
+        for _ in index.files_in_span(off, length):
+            pass
+
+    return time.perf_counter() - start
+
+
+def main():
+    rng = random.Random(0)
+    files = make_files(rng)
+    total = files[-1].offset + files[-1].length
+    block_offsets = [rng.randrange(total - BLOCK_LEN) for _ in range(LOOKUPS)]
+    piece_offsets = [rng.randrange(total - PIECE_LEN) for _ in range(LOOKUPS)]
+
+    print(f'{NUM_FILES} files, {total >> 20} MiB, {LOOKUPS} random lookups')
+    print(f'{"index":<16}{"block us":>12}{"piece us":>12}')
+
+    for name, make_index in (('linear scan', LinearScan), ('bisect', FileIndex)):
+        index = make_index(files)
+        block_time = run(index, block_offsets, BLOCK_LEN)
+        piece_time = run(index, piece_offsets, PIECE_LEN)
+        print(f'{name:<16}{block_time / LOOKUPS * 1e6:>12.1f}{piece_time / LOOKUPS * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Objects, memory and time spent on Requests and Blocks per MiB transferred, with the tuple based classes against
+the old ones (name mangled attributes behind accessor methods).
+
+Downloading a MiB means handling 64 BLOCK messages: making a Block for each, and the Request it answers to find
+it among the outstanding requests.  Seeding one means parsing 64 REQUEST messages, and making Blocks to answer them.
+Payloads are shared, and every Request and Block made is kept alive while counting, so the objects and bytes are
+what it takes to wrap them.
+
+Run from the repository root:
+    python -m bench.messages
+"""
+import time
+import tracemalloc
+
+from struct import Struct
+
+from storage import BLOCK_LEN, Block, Request
+
+MIB = 1 << 20
+BLOCKS_PER_MIB = MIB // BLOCK_LEN
+ROUNDS = 2000
+REQUEST_BODY = Struct('!LLL')
+
+
+class OldRequest:
+    def __init__(self, piece_index: int, begin_offset: int, length: int):
+        self.__piece_idx = piece_index
+        self.__begin_offset = begin_offset
+        self.__length = length
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.index() == other.index() and self.begin_offset() == other.begin_offset() and self.length() == other.length()
+        return False
+
+    def __hash__(self):
+        return self.index() * 19 + self.begin_offset()
+
+    def index(self) -> int:
+        return self.__piece_idx
+
+    def begin_offset(self) -> int:
+        return self.__begin_offset
+
+    def length(self) -> int:
+        return self.__length
+
+
+class OldBlock:
+    def __init__(self, piece_index: int, begin_offset: int, data: bytes):
+        self.piece_index = piece_index
+        self.begin_off = begin_offset
+        self.dat = data
+
+    def index(self) -> int:
+        return self.piece_index
+
+    def begin_offset(self) -> int:
+        return self.begin_off
+
+    def data(self) -> bytes:
+        return self.dat
+
+
+def download_mib(request_class, block_class, outstanding: dict, data: bytes, kept: list):
+    for n in range(BLOCKS_PER_MIB):
+        b = block_class(7, n * BLOCK_LEN, data)
+        r = request_class(b.index(), b.begin_offset(), len(b.data()))
+        assert r in outstanding
+        kept[n] = (r, b)
+
+
+def seed_mib(request_class, block_class, bodies: list, data: bytes, kept: list):
+    for n, body in enumerate(bodies):
+        r = request_class(*REQUEST_BODY.unpack(body))
+        kept[n] = (r, block_class(r.index(), r.begin_offset(), data))
+
+
+def run(request_class, block_class):
+    data = bytes(BLOCK_LEN)
+    bodies = [REQUEST_BODY.pack(7, n * BLOCK_LEN, BLOCK_LEN) for n in range(BLOCKS_PER_MIB)]
+
+    def outstanding():
+        return {request_class(7, n * BLOCK_LEN, BLOCK_LEN): None for n in range(BLOCKS_PER_MIB)}
+
+    results = []
+    for name, transfer, arg in (('download', download_mib, outstanding), ('seed', seed_mib, lambda: bodies)):
+        kept = [None] * BLOCKS_PER_MIB
+        a = arg()
+        tracemalloc.start()
+        transfer(request_class, block_class, a, data, kept)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        stats = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('filename')
+        objects = sum(s.count for s in stats)
+        size = sum(s.size for s in stats)
+
+        args = [arg() for _ in range(ROUNDS)]
+        start = time.perf_counter()
+        for a in args:
+            transfer(request_class, block_class, a, data, kept)
+        elapsed = (time.perf_counter() - start) / ROUNDS
+
+        results.append((name, objects, size, elapsed))
+
+    return results
+
+
+def main():
+    print(f'Per MiB ({BLOCKS_PER_MIB} blocks of {BLOCK_LEN >> 10} KiB)')
+    print(f'{"classes":<10}{"direction":<12}{"objects":>10}{"KiB":>8}{"us":>8}')
+
+    for name, request_class, block_class in (('old', OldRequest, OldBlock), ('tuples', Request, Block)):
+        for direction, objects, size, elapsed in run(request_class, block_class):
+            print(f'{name:<10}{direction:<12}{objects:>10}{size / 1024:>8.1f}{elapsed * 1e6:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
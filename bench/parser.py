@@ -0,0 +1,127 @@
+"""
+Messages parsed per second out of a stream of mixed HAVE, REQUEST and BLOCK messages, arriving in 64 KiB reads:
+with a StreamReader and two readexactly calls per message (copying each payload out of its buffer), against
+PeerConnection parsing every complete message out of one receive buffer (payloads are views of it).
+
+Run from the repository root:
+    python -m bench.parser
+"""
+import asyncio
+import os
+import time
+
+from asyncio import IncompleteReadError, StreamReader
+
+from packet import BittorrentPacketHeader, BlockPacket, HavePacket, HandshakePacket, PACKETS_BY_TYPE, \
+    PeerConnection, PeerDisconnected, RequestPacket
+from storage import BLOCK_LEN, Block, Request
+
+READ_SIZE = 64 * 1024
+BLOCKS = 512  # 8 MiB of payload
+MESSAGES_PER_BLOCK = 8  # HAVEs and REQUESTs between blocks
+
+
+class NullTransport:
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+async def old_read_next_packet(reader: StreamReader):
+    """read_next_packet before PeerConnection"""
+    try:
+        header_bytes = await reader.readexactly(BittorrentPacketHeader.size())
+        header: BittorrentPacketHeader = BittorrentPacketHeader.deserialize(header_bytes)
+
+        next_packet_body = await reader.readexactly(header.body_length())
+        return PACKETS_BY_TYPE[header.type()].deserialize(next_packet_body)
+
+    except IncompleteReadError:
+        raise PeerDisconnected()
+
+
+def make_stream():
+    payload = os.urandom(BLOCK_LEN)
+    messages = []
+    for i in range(BLOCKS):
+        for j in range(MESSAGES_PER_BLOCK // 2):
+            messages.append(HavePacket(i * 4 + j))
+            messages.append(RequestPacket(Request(i, j * BLOCK_LEN, BLOCK_LEN)))
+        messages.append(BlockPacket(Block(i, 0, payload)))
+
+    return len(messages), b''.join(m.serialize() for m in messages)
+
+
+def reads(stream: bytes):
+    return [stream[i:i + READ_SIZE] for i in range(0, len(stream), READ_SIZE)]
+
+
+def bench_stream_reader(handshake: bytes, chunks: list, num_messages: int) -> float:
+    async def run():
+        reader = StreamReader(limit=2 * READ_SIZE)
+        start = time.perf_counter()
+
+        reader.feed_data(handshake)
+        HandshakePacket.deserialize(await reader.readexactly(HandshakePacket.size()))
+
+        n = 0
+        for chunk in chunks:
+            reader.feed_data(chunk)
+            # Parse everything which has arrived, like the event loop would before the next read
+            while len(reader._buffer) >= 4 and \
+                    len(reader._buffer) >= 4 + int.from_bytes(reader._buffer[:4], 'big'):
+                await old_read_next_packet(reader)
+                n += 1
+
+        assert n == num_messages
+        return time.perf_counter() - start
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def bench_peer_connection(handshake: bytes, chunks: list, num_messages: int) -> float:
+    conn = PeerConnection()
+    conn.connection_made(NullTransport())
+    start = time.perf_counter()
+
+    n = 0
+    for chunk in [handshake] + chunks:
+        # The transport reads as much as fits in the buffer it's given
+        while chunk:
+            buf = conn.get_buffer(-1)
+            nbytes = min(len(buf), len(chunk))
+            buf[:nbytes] = chunk[:nbytes]
+            conn.buffer_updated(nbytes)
+            chunk = chunk[nbytes:]
+
+            n += len(conn.packets)
+            conn.packets.clear()
+
+    assert n == num_messages + 1
+    return time.perf_counter() - start
+
+
+def main():
+    num_messages, stream = make_stream()
+    handshake = HandshakePacket(bytes(20), bytes(20)).serialize()
+    chunks = reads(stream)
+
+    print(f'{num_messages} messages ({len(stream) / (1 << 20):.1f} MiB) in {len(chunks)} reads of {READ_SIZE >> 10} KiB')
+    for name, bench in (('StreamReader.readexactly', bench_stream_reader), ('PeerConnection', bench_peer_connection)):
+        elapsed = min(bench(handshake, chunks, num_messages) for _ in range(5))
+        print(f'{name:>26}: {num_messages / elapsed / 1e3:8.0f}k messages/s  {len(stream) / elapsed / 1e6:8.0f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
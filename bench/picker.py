@@ -0,0 +1,131 @@
+"""
+Time-to-complete of the rarest first PiecePicker against the old index order picking, in a simulated swarm.
+
+Each tick, every idle peer uploads one piece to us, taking a number of ticks that depends on its speed.
+The swarm starts with one seed, which leaves after SEED_TICKS.  Other peers only have a few pieces each,
+and leave (taking their pieces with them) to be replaced by new ones, so pieces which aren't fetched
+while someone has them can stall the download.
+
+Run from the repository root:
+    python -m bench.picker
+"""
+import random
+import time
+
+from bitfield import MutableBitfield
+from picker import PiecePicker
+
+NUM_PIECES = 2000
+NUM_PEERS = 30
+SEED_TICKS = 150
+CHURN = 0.02  # Chance each peer leaves on each tick
+MAX_TICKS = 20000
+TRIALS = 5
+
+
+class SimPeer:
+    def __init__(self, rng: random.Random, num_pieces: int, fraction: float = None):
+        if fraction is None:
+            fraction = rng.choice([0.01, 0.02, 0.05, 0.1, 0.2])
+
+        self.bitfield = MutableBitfield(num_pieces)
+        for i in range(num_pieces):
+            if rng.random() < fraction:
+                self.bitfield.set(i)
+
+        self.ticks_per_piece = rng.choice([1, 2, 4, 8])
+        self.busy_until = 0
+        self.downloading = None
+
+
+class IndexOrderPicker:
+    """The old requests2 behaviour: pieces in index order, from any peer which has them"""
+
+    def __init__(self, num_pieces: int):
+        self.unstarted = list(range(num_pieces))
+
+    def add_bitfield(self, bf):
+        pass
+
+    def remove_bitfield(self, bf):
+        pass
+
+    def finish(self, index):
+        pass
+
+    def restart(self, index):
+        self.unstarted.insert(0, index)
+
+    def pick(self, has_piece):
+        for n, index in enumerate(self.unstarted):
+            if has_piece(index):
+                return self.unstarted.pop(n)
+        return None
+
+
+class RarestFirstPicker(PiecePicker):
+    def restart(self, index):
+        # Put a piece we lost the source for back in the pool
+        self.partial.pop(index, None)
+        self._insert(index)
+
+
+def simulate(make_picker, seed: int) -> int:
+    """Returns the number of ticks it took to download every piece, or MAX_TICKS if it stalled"""
+    rng = random.Random(seed)
+    random.seed(seed)
+
+    picker = make_picker(NUM_PIECES)
+    seed_peer = SimPeer(rng, NUM_PIECES, fraction=1)
+    seed_peer.ticks_per_piece = 1
+    peers = [seed_peer]
+    for _ in range(NUM_PEERS - 1):
+        peers.append(SimPeer(rng, NUM_PIECES))
+
+    for p in peers:
+        picker.add_bitfield(p.bitfield)
+
+    finished = 0
+    for tick in range(MAX_TICKS):
+        for p in peers:
+            if p.downloading is not None and p.busy_until <= tick:
+                picker.finish(p.downloading)
+                p.downloading = None
+                finished += 1
+
+            if p.downloading is None:
+                p.downloading = picker.pick(p.bitfield.get)
+                p.busy_until = tick + p.ticks_per_piece
+
+        if finished == NUM_PIECES:
+            return tick
+
+        # Churn
+        for n, p in enumerate(peers):
+            if (p is seed_peer and tick == SEED_TICKS) or (p is not seed_peer and rng.random() < CHURN):
+                if p.downloading is not None:
+                    picker.restart(p.downloading)
+                picker.remove_bitfield(p.bitfield)
+
+                new_peer = SimPeer(rng, NUM_PIECES)
+                picker.add_bitfield(new_peer.bitfield)
+                peers[n] = new_peer
+
+    return MAX_TICKS
+
+
+def main():
+    print(f'{NUM_PIECES} pieces, {NUM_PEERS} peers, seed leaves after {SEED_TICKS} ticks, '
+          f'{CHURN:.0%} churn per tick, {TRIALS} trials')
+    print(f'{"picker":<16}{"mean ticks":>12}{"worst ticks":>14}{"wall time":>12}')
+
+    for name, make_picker in (('index order', IndexOrderPicker), ('rarest first', RarestFirstPicker)):
+        start = time.perf_counter()
+        ticks = [simulate(make_picker, seed) for seed in range(TRIALS)]
+        elapsed = time.perf_counter() - start
+
+        print(f'{name:<16}{sum(ticks) / len(ticks):>12.0f}{max(ticks):>14}{elapsed:>11.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Memory and CPU cost of Piece's bitmap and buffer block tracking against the old lists of Requests and Blocks.
+
+Memory is what tracemalloc sees allocated for every Piece of a torrent before anything is downloaded, and for a
+number of pieces with half their blocks downloaded.  CPU is the time to pop every request of a piece and save the
+blocks for them (arriving slightly out of order, as they do from several peers), then verify it.
+
+Blocks arrive as fresh bytes objects, like the ones parsed off the wire, which the old Piece kept and the new one
+copies into its buffer.  The buffer is allocated whole, so partially downloaded pieces cost their full length.
+
+Run from the repository root:
+    python -m bench.piece
+"""
+import random
+import time
+import tracemalloc
+
+from collections import deque
+from hashlib import sha1
+
+from storage import BLOCK_LEN, Block, Piece, Request, piece_digest
+
+NUM_PIECES = 10_000
+PARTIAL_PIECES = 100
+PIECE_LENGTHS = (256 * 1024, 4 * 1024 * 1024)
+CPU_ROUNDS = 20
+
+
+class ListPiece:
+    """The old Piece, trimmed to what's benchmarked"""
+
+    def __init__(self, index: int, checksum: bytes, length: int, hash_incrementally=True):
+        self.index = index
+        self.checksum = checksum
+        self.length = length
+        self.hash_incrementally = hash_incrementally
+
+        self.num_blocks = length // BLOCK_LEN
+        if length % BLOCK_LEN > 0:
+            self.num_blocks += 1
+
+        self.reset()
+
+    def reset(self):
+        self.requests = deque(self._create_request_list())
+        self.completed_blocks = []
+
+        self.downloaded_blocks = []
+        self.out_of_order_blocks = {}
+        self.checksum_state = sha1()
+        self.bytes_in_order = 0
+
+    def _create_request_list(self):
+        requests = []
+        last_block_len = self.length % BLOCK_LEN
+
+        for begin_offset in range(0, self.length - last_block_len, BLOCK_LEN):
+            requests.append(Request(self.index, begin_offset, BLOCK_LEN))
+
+        if last_block_len > 0:
+            requests.append(Request(self.index, self.length - last_block_len, last_block_len))
+
+        return requests
+
+    def block_completed(self, begin_offset: int) -> bool:
+        return begin_offset in self.completed_blocks
+
+    def complete(self):
+        return len(self.completed_blocks) == self.num_blocks
+
+    def pop_request(self) -> Request:
+        try:
+            r = self.requests.popleft()
+            while self.block_completed(r.begin_offset()):
+                r = self.requests.popleft()
+
+        except IndexError:
+            return None
+
+        return r
+
+    def save_block(self, b: Block):
+        if b.begin_offset() % BLOCK_LEN == 0 and not self.block_completed(b.begin_offset()):
+            self.completed_blocks.append(b.begin_offset())
+            self.out_of_order_blocks[b.begin_offset()] = b
+            self._order_blocks()
+
+    def _order_blocks(self):
+        b = self.out_of_order_blocks.pop(self.bytes_in_order, None)
+        while b is not None:
+            if self.hash_incrementally:
+                self.checksum_state.update(b.data())
+            self.bytes_in_order += len(b.data())
+            self.downloaded_blocks.append(b)
+
+            b = self.out_of_order_blocks.pop(self.bytes_in_order, None)
+
+    def verify(self):
+        if self.bytes_in_order != self.length:
+            return False
+
+        if self.hash_incrementally:
+            return self.checksum_state.digest() == self.checksum
+
+        return piece_digest([b.data() for b in self.downloaded_blocks]) == self.checksum
+
+
+def make_blocks(rng: random.Random, index: int, piece_length: int) -> list:
+    """A piece's blocks in the order they arrive: mostly in order, but swapped around a little"""
+    data = rng.randbytes(piece_length)
+    blocks = [Block(index, off, data[off:off + BLOCK_LEN]) for off in range(0, piece_length, BLOCK_LEN)]
+    for i in range(0, len(blocks) - 1, 3):
+        blocks[i], blocks[i + 1] = blocks[i + 1], blocks[i]
+
+    return blocks, sha1(data).digest()
+
+
+def arrive(blocks: list):
+    """Copies of blocks, as if they'd just been read off a socket"""
+    for b in blocks:
+        yield Block(b.index(), b.begin_offset(), bytes(memoryview(b.data())))
+
+
+def measure(f) -> int:
+    """Bytes allocated by f() which are still alive after it returns"""
+    tracemalloc.start()
+    result = f()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return size
+
+
+def unstarted(piece_class, piece_length: int) -> list:
+    return [piece_class(i, bytes(20), piece_length) for i in range(NUM_PIECES)]
+
+
+def half_downloaded(piece_class, piece_length: int, blocks: list) -> list:
+    pieces = [piece_class(i, bytes(20), piece_length) for i in range(PARTIAL_PIECES)]
+    for p in pieces:
+        for b in arrive(blocks[::2]):
+            p.save_block(b)
+
+    return pieces
+
+
+def download(piece_class, piece_length: int, blocks: list, checksum: bytes):
+    p = piece_class(0, checksum, piece_length)
+
+    r = p.pop_request()
+    while r is not None:
+        r = p.pop_request()
+
+    for b in arrive(blocks):
+        p.save_block(b)
+
+    assert p.complete() and p.verify()
+
+
+def main():
+    rng = random.Random(0)
+
+    print(f'{"piece":<8}{"length":>8}{"unstarted MiB":>16}{"half done MiB":>16}{"download ms":>14}')
+    print(f'{"":<8}{"":>8}{f"({NUM_PIECES} pieces)":>16}{f"({PARTIAL_PIECES} pieces)":>16}')
+
+    for piece_length in PIECE_LENGTHS:
+        blocks, checksum = make_blocks(rng, 0, piece_length)
+
+        for name, piece_class in (('lists', ListPiece), ('bitmap', Piece)):
+            unstarted_size = measure(lambda: unstarted(piece_class, piece_length))
+            partial_size = measure(lambda: half_downloaded(piece_class, piece_length, blocks))
+
+            start = time.perf_counter()
+            for _ in range(CPU_ROUNDS):
+                download(piece_class, piece_length, blocks, checksum)
+            elapsed = (time.perf_counter() - start) / CPU_ROUNDS
+
+            print(f'{name:<8}{piece_length >> 10:>7}K{unstarted_size / (1 << 20):>16.1f}'
+                  f'{partial_size / (1 << 20):>16.1f}{elapsed * 1000:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Piece throughput of PieceManager.save_block against the number of verification workers.
+
+Feeds every block of a synthetic single file torrent through save_block on an event loop, and waits for
+every piece to be verified and written.  "inline" hashes blocks as they arrive and writes on the loop.
+
+Run from the repository root:
+    python -m bench.workers
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+from asyncio import coroutine
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha1
+
+from bencode import bencode
+from storage import BLOCK_LEN, Block, PieceIO, PieceManager
+from torrent import Torrent
+
+PIECE_LEN = 4 * 1024 * 1024
+NUM_PIECES = 48
+WORKER_COUNTS = (1, 2, 4, 8)
+
+
+def make_torrent(directory: str, data: bytes, piece_length: int) -> Torrent:
+    pieces = b''.join(sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+    torrent_file = os.path.join(directory, 'bench.torrent')
+    with open(torrent_file, 'wb') as f:
+        f.write(bencode({
+            'announce': 'http://localhost/announce',
+            'info': {'name': 'bench.bin', 'length': len(data), 'piece length': piece_length, 'pieces': pieces}
+        }))
+
+    return Torrent(torrent_file, os.path.join(directory, 'download'))
+
+
+def make_blocks(data: bytes, piece_length: int) -> list:
+    return [
+        Block(off // piece_length, off % piece_length, data[off:off + BLOCK_LEN])
+        for off in range(0, len(data), BLOCK_LEN)
+    ]
+
+
+@coroutine
+def feed_blocks(mgr: PieceManager, blocks: list):
+    checks = []
+    for n, b in enumerate(blocks):
+        checked = mgr.save_block(b)
+        if checked is not None:
+            checks.append(asyncio.wrap_future(checked))
+
+        # Let finished pieces get handled, like we would between packets
+        if n % 64 == 0:
+            yield from asyncio.sleep(0)
+
+    results = yield from asyncio.gather(*checks)
+    assert all(results)
+
+
+def run(torrent: Torrent, blocks: list, executor=None) -> float:
+    mgr = PieceManager(torrent, PieceIO(torrent), executor=executor)
+
+    start = time.perf_counter()
+    asyncio.get_event_loop().run_until_complete(feed_blocks(mgr, blocks))
+    elapsed = time.perf_counter() - start
+
+    assert mgr.complete()
+    if executor is not None:
+        executor.shutdown()
+
+    return elapsed
+
+
+def main():
+    data = os.urandom(PIECE_LEN * NUM_PIECES)
+    megabytes = len(data) / (1 << 20)
+
+    with tempfile.TemporaryDirectory() as directory:
+        torrent = make_torrent(directory, data, PIECE_LEN)
+        blocks = make_blocks(data, PIECE_LEN)
+
+        print(f'{NUM_PIECES} pieces of {PIECE_LEN >> 20} MiB, {os.cpu_count()} cpus')
+        print(f'{"workers":<16}{"pieces/s":>10}{"MiB/s":>10}')
+
+        configs = [('inline', lambda: None)]
+        configs += [(f'{n} threads', lambda n=n: ThreadPoolExecutor(n)) for n in WORKER_COUNTS]
+        configs += [(f'{n} processes', lambda n=n: ProcessPoolExecutor(n)) for n in WORKER_COUNTS]
+
+        for name, make_executor in configs:
+            elapsed = run(torrent, blocks, make_executor())
+            print(f'{name:<16}{NUM_PIECES / elapsed:>10.1f}{megabytes / elapsed:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
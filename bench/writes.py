@@ -0,0 +1,95 @@
+"""
+Small messages sent per second over a loopback socket: writing and draining each one like send_packet used to,
+against send_packet corking them into one write per event loop iteration.
+
+Each round sends a burst of HAVE and REQUEST messages, the way a peer sends a pipeline's worth of requests (or
+announces pieces) at once, then waits for the other end to receive them.
+
+Run from the repository root:
+    python -m bench.writes
+"""
+import asyncio
+import socket
+import time
+
+from asyncio import coroutine
+
+from packet import HavePacket, PeerConnection, RequestPacket, send_packet
+from storage import BLOCK_LEN, Request
+
+ROUNDS = 500
+BURST = 64
+
+
+class Sink(asyncio.Protocol):
+    def __init__(self):
+        self.received = 0
+        self.waiter = None
+        self.expected = 0
+
+    def data_received(self, data):
+        self.received += len(data)
+        if self.received >= self.expected and self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+@coroutine
+def old_send_packet(conn: PeerConnection, packet):
+    """send_packet before corking"""
+    conn.transport.write(packet.serialize())
+    yield from conn.drain()
+
+
+def burst(i: int) -> list:
+    pkts = []
+    for j in range(BURST // 2):
+        pkts.append(HavePacket(i * BURST + j))
+        pkts.append(RequestPacket(Request(i, j * BLOCK_LEN, BLOCK_LEN)))
+
+    return pkts
+
+
+def bench(send) -> tuple:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    a, b = socket.socketpair()
+
+    @coroutine
+    def run():
+        _, conn = yield from loop.create_connection(PeerConnection, sock=a)
+        _, sink = yield from loop.create_connection(Sink, sock=b)
+
+        bursts = [burst(i) for i in range(ROUNDS)]
+        lengths = [sum(len(p.serialize()) for p in pkts) for pkts in bursts]
+
+        start = time.perf_counter()
+        for pkts, length in zip(bursts, lengths):
+            sink.expected += length
+            sink.waiter = loop.create_future()
+
+            for p in pkts:
+                yield from send(conn, p)
+
+            yield from sink.waiter
+
+        elapsed = time.perf_counter() - start
+        conn.close()
+        return elapsed
+
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def main():
+    messages = ROUNDS * BURST
+    print(f'{messages} messages in bursts of {BURST}')
+    for name, send in (('write + drain each', old_send_packet), ('corked send_packet', send_packet)):
+        elapsed = min(bench(send) for _ in range(3))
+        print(f'{name:>20}: {messages / elapsed / 1e3:6.0f}k messages/s')
+
+
+if __name__ == '__main__':
+    main()
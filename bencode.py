@@ -135,46 +135,173 @@ def bdecode(f_or_data):
 		assert_btype(f_or_data.read(1), _TYPE_END)
 		return None
 
+########################
+### Decoding buffers ###
+########################
+
+# Index based: values are sliced straight out of one bytes object instead of read from a file a byte at a time.
+# Strings are left as bytes (only dict keys are decoded, when they're UTF-8).
+
+_ORD_INT  = ord(_TYPE_INT)
+_ORD_LIST = ord(_TYPE_LIST)
+_ORD_DICT = ord(_TYPE_DICT)
+_ORD_END  = ord(_TYPE_END)
+
+def _decode_buffer_at(data, i):
+	"""Decodes the value starting at data[i], returning it and the index just after it"""
+	c = data[i]
+	if c == _ORD_INT:
+		end = data.index(_TYPE_END, i + 1)
+		return int(data[i + 1:end]), end + 1
+
+	if c == _ORD_LIST:
+		ret = []
+		i += 1
+		while data[i] != _ORD_END:
+			item, i = _decode_buffer_at(data, i)
+			ret.append(item)
+		return ret, i + 1
+
+	if c == _ORD_DICT:
+		ret = {}
+		i += 1
+		while data[i] != _ORD_END:
+			key, i = _decode_string_at(data, i)
+			try:
+				key = key.decode()
+			except UnicodeDecodeError:
+				pass
+			ret[key], i = _decode_buffer_at(data, i)
+		return ret, i + 1
+
+	return _decode_string_at(data, i)
+
+def _decode_string_at(data, i):
+	sep = data.index(_TYPE_SEP, i)
+	start = sep + 1
+	end = start + int(data[i:sep])
+	if end > len(data) or start > end:
+		raise ValueError('string at {} runs past the end of the data'.format(i))
+	return data[start:end], end
+
+def _decode_buffer_value(data, i):
+	try:
+		return _decode_buffer_at(data, i)
+	except IndexError:
+		raise ValueError('Data ended unexpectedly')
+
+def bdecode_buffer(data):
+	"""
+	bdecodes bytes (or a memoryview, or bytearray) in one pass over it.
+	Unlike bdecode, strings are always returned as bytes (dict keys are str when they're UTF-8).
+	"""
+	data = bytes(data)
+	ret, end = _decode_buffer_value(data, 0)
+	if end != len(data):
+		raise ValueError('{} bytes of trailing data'.format(len(data) - end))
+	return ret
+
+def bdecode_torrent(data):
+	"""
+	bdecodes a .torrent like bdecode_buffer,
+	also returning the exact bytes the info dict was encoded as (which the info hash is the hash of)
+	"""
+	data = bytes(data)
+	if data[:1] != _TYPE_DICT:
+		raise TypeError('Torrent is not a dict')
+
+	ret = {}
+	info = None
+	i = 1
+	try:
+		while data[i] != _ORD_END:
+			key, i = _decode_string_at(data, i)
+			start = i
+			value, i = _decode_buffer_value(data, i)
+			if key == b'info':
+				info = data[start:i]
+			try:
+				key = key.decode()
+			except UnicodeDecodeError:
+				pass
+			ret[key] = value
+	except IndexError:
+		raise ValueError('Data ended unexpectedly')
+
+	if info is None:
+		raise KeyError('info')
+	return ret, info
+
 ################
 ### Encoding ###
 ################
 
-def _encode_int(integer, f):
-	f.write(_TYPE_INT)
-	f.write(str(integer).encode())
-	f.write(_TYPE_END)
+# Everything is encoded onto a list of chunks, which is joined (or written) once at the end
+
+class Bencoded:
+	"""Data which has already been bencoded, and is put into the output as it is (e.g. a torrent's info dict)"""
+	__slots__ = ('data',)
+
+	def __init__(self, data):
+		self.data = bytes(data)
+
+	def __repr__(self):
+		return 'Bencoded({!r})'.format(self.data)
 
-def _encode_buffer(string, f):
-	"""Writes the bencoded form of the input string or bytes"""
+def _encode_int(integer, chunks):
+	chunks.append(b'i%de' % integer)
+
+def _encode_buffer(string, chunks):
+	"""Appends the bencoded form of the input string or bytes"""
 	if isinstance(string, str):
 		string = string.encode()
-	f.write(str(len(string)).encode())
-	f.write(_TYPE_SEP)
-	f.write(string)
+	chunks.append(b'%d:' % len(string))
+	chunks.append(string)
 
-def _encode_iterable(iterable, f):
-	f.write(_TYPE_LIST)
+def _encode_iterable(iterable, chunks):
+	chunks.append(_TYPE_LIST)
 	for item in iterable:
-		bencode(item, f)
-	f.write(_TYPE_END)
-
-def _encode_mapping(mapping, f):
-	"""Encodes the mapping items in lexical order (spec)"""
-	f.write(_TYPE_DICT)
-	for key, value in sorted(mapping.items()):
-		_encode_buffer(key, f)
-		bencode(value, f)
-	f.write(_TYPE_END)
-
-def _bencode_to_file(data, f):
-	if isinstance(data, int):
-		_encode_int(data, f)
-	elif isinstance(data, (str, bytes)):
-		_encode_buffer(data, f)
+		_encode_chunks(item, chunks)
+	chunks.append(_TYPE_END)
+
+def _encode_mapping(mapping, chunks):
+	"""Encodes the mapping items in lexical order of the encoded keys (spec)"""
+	chunks.append(_TYPE_DICT)
+	try:
+		keys = sorted(mapping)  # str sorts the same as its UTF-8 encoding
+	except TypeError:
+		# Both str and bytes keys
+		keys = sorted(mapping, key=lambda k: k.encode() if isinstance(k, str) else k)
+	for key in keys:
+		_encode_buffer(key, chunks)
+		_encode_chunks(mapping[key], chunks)
+	chunks.append(_TYPE_END)
+
+def _encode_bencoded(bencoded, chunks):
+	chunks.append(bencoded.data)
+
+_ENCODERS = {
+	int:      _encode_int,
+	str:      _encode_buffer,
+	bytes:    _encode_buffer,
+	dict:     _encode_mapping,
+	list:     _encode_iterable,
+	tuple:    _encode_iterable,
+	Bencoded: _encode_bencoded,
+}
+
+def _encode_chunks(data, chunks):
+	encoder = _ENCODERS.get(type(data))
+	if encoder is not None:
+		encoder(data, chunks)
+	elif isinstance(data, int):
+		_encode_int(data, chunks)
+	elif isinstance(data, (str, bytes, bytearray, memoryview)):
+		_encode_buffer(bytes(data) if not isinstance(data, str) else data, chunks)
 	elif isinstance(data, Mapping):
-		_encode_mapping(data, f)
+		_encode_mapping(data, chunks)
 	elif isinstance(data, Iterable):
-		_encode_iterable(data, f)
+		_encode_iterable(data, chunks)
 	else:
 		raise TypeError(
 			'the passed value {} of type {} is not bencodable.'
@@ -186,15 +313,14 @@ def bencode(data, f=None):
 	The order of tests is nonarbitrary,
 	as strings and mappings are iterable.
 	
-	If f is None, it writes to a byte buffer
-	and returns a bytestring
+	If f is None, it returns a bytestring
 	"""
+	chunks = []
+	_encode_chunks(data, chunks)
 	if f is None:
-		f = BytesIO()
-		_bencode_to_file(data, f)
-		return f.getvalue()
+		return b''.join(chunks)
 	else:
-		_bencode_to_file(data, f)
+		f.writelines(chunks)
 
 def main(args=None):
 	"""Decodes bencoded files to python syntax (like JSON, but with bytes support)"""
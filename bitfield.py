@@ -1,47 +1,100 @@
 from math import ceil
-from typing import Union
+from typing import Optional, Union
+
+
+# Bit i of the int backing a Bitfield is piece i, but on the wire piece 0 is the high bit of the first byte,
+# so bytes go through this table (every byte with its bits reversed) on the way in and out.
+_REVERSED_BITS = bytes(int(f'{b:08b}'[::-1], 2) for b in range(256))
+
+
+try:
+    _popcount = int.bit_count  # Python 3.10+
+except AttributeError:
+    def _popcount(x: int) -> int:
+        return bin(x).count('1')
 
 
 class Bitfield:
+    """
+    Which of a torrent's pieces someone has, held in one int so counting, intersecting and searching it takes
+    a handful of operations on the whole thing rather than a Python loop over every piece.
+    """
+
     def __init__(self, bitfield: bytes):
-        self._bitfield = bitfield
-        self._num_set = sum(self)
+        self._num_bits = len(bitfield) * 8
+        self._bits = int.from_bytes(bytes(bitfield).translate(_REVERSED_BITS), 'little')
+
+    @classmethod
+    def _from_int(cls, bits: int, num_bits: int) -> "Bitfield":
+        bf = Bitfield.__new__(cls)
+        bf._num_bits = num_bits
+        bf._bits = bits
+        return bf
 
     def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            if self._bitfield == other._bitfield:
-                assert self._num_set == other._num_set
-                return True
+        if isinstance(other, Bitfield):
+            return self._bits == other._bits and self._num_bits == other._num_bits
         return False
 
+    def __repr__(self):
+        return f'{self.__class__.__name__}({bytes(self)})'
+
     def get(self, index):
-        return (self._bitfield[index // 8] >> (7 - (index % 8))) & 1
+        return self._bits >> index & 1
 
     def num_bytes(self):
-        return len(self._bitfield)
+        return self._num_bits // 8
 
     def num_set(self):
-        return self._num_set
+        return _popcount(self._bits)
 
     def fraction_set(self):
         return self.num_set() / len(self)
 
+    def any(self) -> bool:
+        return self._bits != 0
+
     def __bytes__(self):
-        return self._bitfield
+        return self._bits.to_bytes(self.num_bytes(), 'little').translate(_REVERSED_BITS)
 
     def __iter__(self):
-        for i in range(0, len(self._bitfield)):
-            yield self._bitfield[i] >> 7 & 1
-            yield self._bitfield[i] >> 6 & 1
-            yield self._bitfield[i] >> 5 & 1
-            yield self._bitfield[i] >> 4 & 1
-            yield self._bitfield[i] >> 3 & 1
-            yield self._bitfield[i] >> 2 & 1
-            yield self._bitfield[i] >> 1 & 1
-            yield self._bitfield[i] & 1
+        """Every bit, 1 or 0"""
+        bits = self._bits
+        for i in range(self._num_bits):
+            yield bits >> i & 1
 
     def __len__(self):
-        return len(self._bitfield) * 8
+        return self._num_bits
+
+    def __and__(self, other: "Bitfield") -> "Bitfield":
+        """Pieces in both"""
+        return Bitfield._from_int(self._bits & other._bits, self._num_bits)
+
+    def __or__(self, other: "Bitfield") -> "Bitfield":
+        """Pieces in either"""
+        return Bitfield._from_int((self._bits | other._bits) & ((1 << self._num_bits) - 1), self._num_bits)
+
+    def __sub__(self, other: "Bitfield") -> "Bitfield":
+        """Pieces in this one, but not other (e.g. a peer's pieces we don't have)"""
+        return Bitfield._from_int(self._bits & ~other._bits, self._num_bits)
+
+    def first_set(self, start: int = 0) -> Optional[int]:
+        """The first set bit at or after start, or None"""
+        bits = self._bits >> start
+        if not bits:
+            return None
+
+        return start + (bits & -bits).bit_length() - 1
+
+    def set_bits(self):
+        """Indices of the set bits, in order"""
+        data = self._bits.to_bytes(ceil(self._num_bits / 64) * 8, 'little')
+        for base in range(0, len(data) * 8, 64):
+            word = int.from_bytes(data[base // 8:base // 8 + 8], 'little')
+            while word:
+                lowest = word & -word
+                yield base + lowest.bit_length() - 1
+                word ^= lowest
 
 
 # class ChainedBitfield(Bitfield):
@@ -70,25 +123,19 @@ class Bitfield:
 class MutableBitfield(Bitfield):
     def __init__(self, bitfield: Union[int, bytes, bytearray, Bitfield]):
         if type(bitfield) is int:
-            self._bitfield = bytearray(ceil(bitfield / 8))
-        elif type(bitfield) is bytes:
-            self._bitfield = bytearray(bitfield)
-        elif type(bitfield) is Bitfield:
-            self._bitfield = bytearray(bitfield._bitfield)
+            # Number of bits
+            self._num_bits = ceil(bitfield / 8) * 8
+            self._bits = 0
+        elif isinstance(bitfield, Bitfield):
+            self._num_bits = bitfield._num_bits
+            self._bits = bitfield._bits
         else:
-            self._bitfield = bitfield
-
-        self._num_set = sum(self)
-
-    def __bytes__(self):
-        return bytes(self._bitfield)
+            super().__init__(bitfield)
 
     def set(self, index):
-        if self.get(index) == 0:
-            self._num_set += 1
-        self._bitfield[index // 8] |= 1 << (7 - (index % 8))
+        if not 0 <= index < self._num_bits:
+            raise IndexError(f'Bit {index} out of range')
+        self._bits |= 1 << index
 
     def unset(self, index):
-        if self.get(index) == 1:
-            self._num_set -= 1
-        self._bitfield[index // 8] &= ~(1 << (index % 8))
+        self._bits &= ~(1 << index)
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+
+
+class PieceCache:
+    """
+    Keeps the data of recently read pieces in memory, up to max_bytes, dropping the least recently used.
+    Counts hits and misses so the size can be tuned.
+    """
+
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.pieces = OrderedDict()  # piece index -> data, least recently used first
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __repr__(self):
+        return f'PieceCache({len(self)} pieces, {self.size} bytes, {self.hits} hits, {self.misses} misses)'
+
+    def get(self, index: int):
+        """The data of piece index, or None (counting a miss) if it isn't cached"""
+        data = self.pieces.get(index)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.pieces.move_to_end(index)
+        return data
+
+    def put(self, index: int, data):
+        if len(data) > self.max_bytes:
+            return
+
+        self.discard(index)
+        self.pieces[index] = data
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, index: int):
+        data = self.pieces.pop(index, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def clear(self):
+        self.pieces.clear()
+        self.size = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,52 @@
+from typing import Callable
+
+
+class Choker:
+    """
+    Chooses which peers we upload to (tit-for-tat).
+
+    Every round, the unchoke_slots interested peers which gave us the most (or, once we're seeding, took the most)
+    are unchoked, plus one optimistic unchoke so peers that haven't given us anything yet get a chance to.
+    The optimistic slot moves on every optimistic_rounds rounds, to whichever interested, choked peer has gone
+    longest without it.
+    """
+
+    def __init__(self, unchoke_slots: int = 4, optimistic_rounds: int = 3):
+        self.unchoke_slots = unchoke_slots
+        self.optimistic_rounds = optimistic_rounds
+
+        self.optimistic = None  # The optimistically unchoked peer
+        self.rounds = 0
+        self.last_optimistic = {}  # peer -> round it was last optimistically unchoked
+
+    def max_unchoked(self) -> int:
+        return self.unchoke_slots + 1
+
+    def choose(self, peers: list, rate: Callable) -> set:
+        """
+        The peers to unchoke this round, out of peers (anything with peer_interested()).
+        rate(peer) is how much the peer is worth to us: the rate it sends to us, or the rate we send to it.
+        """
+        interested = [p for p in peers if p.peer_interested()]
+        ranked = sorted(interested, key=rate, reverse=True)
+        unchoked = set(ranked[:self.unchoke_slots])
+
+        # Forget disconnected peers
+        connected = set(peers)
+        self.last_optimistic = {p: r for p, r in self.last_optimistic.items() if p in connected}
+
+        if self.optimistic not in interested or self.optimistic in unchoked \
+                or self.rounds % self.optimistic_rounds == 0:
+            self.optimistic = None
+
+            # Peers never optimistically unchoked go first, then whoever has waited longest
+            waiting = [p for p in interested if p not in unchoked]
+            if waiting:
+                self.optimistic = min(waiting, key=lambda p: self.last_optimistic.get(p, -1))
+                self.last_optimistic[self.optimistic] = self.rounds
+
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        self.rounds += 1
+        return unchoked
@@ -0,0 +1,137 @@
+class Candidate:
+    """An address we could connect to, and how it's gone so far"""
+
+    __slots__ = ('address', 'failures', 'drops', 'next_attempt', 'connected', 'connected_since')
+
+    def __init__(self, address: tuple):
+        self.address = address  # (host, port)
+        self.failures = 0  # Failed connection attempts since the last one that worked
+        self.drops = 0  # Connections in a row which didn't last STABLE_CONNECTION
+        self.next_attempt = 0  # Not dialed again before this time
+        self.connected = False
+        self.connected_since = None
+
+    def __repr__(self):
+        return f'Candidate({self.address}, failures={self.failures}, drops={self.drops}, connected={self.connected})'
+
+
+class ConnectionManager:
+    """
+    Decides who to connect to, and how many connections we can have.
+
+    Addresses from the peer finder go into a backlog.  Each time a connection to one fails it's left alone for
+    twice as long (up to MAX_BACKOFF), and dropped after MAX_FAILURES failures in a row.  Peers which keep
+    disconnecting soon after connecting are backed off from and dropped the same way.  Addresses that have
+    failed least (then waited longest) are dialed first, at most max_dials at once, until there are target_peers
+    peers.  Incoming connections are accepted up to max_peers, leaving room for peers that find us.
+    """
+
+    BASE_BACKOFF = 5  # Seconds before redialing an address after its first failure, or after it disconnects
+    MAX_BACKOFF = 300
+    MAX_FAILURES = 8
+    STABLE_CONNECTION = 60  # Seconds a connection has to last for its disconnect not to count against the peer
+
+    def __init__(self, target_peers: int = 20, max_peers: int = 30, max_dials: int = 8):
+        self.target_peers = target_peers
+        self.max_peers = max_peers
+        self.max_dials = max_dials
+
+        self.candidates = {}  # address -> Candidate
+        self.dialing = set()  # addresses
+        self.accepting = 0  # Incoming connections still handshaking
+
+        self.dials = 0
+        self.dial_failures = 0
+        self.rejected = 0  # Incoming connections turned away
+
+    def __repr__(self):
+        return f'ConnectionManager(candidates={len(self.candidates)}, dialing={len(self.dialing)})'
+
+    def add_candidates(self, addresses):
+        """Remember addresses (host, port) to connect to, besides ones we already know"""
+        for address in addresses:
+            if address not in self.candidates:
+                self.candidates[address] = Candidate(address)
+
+    def num_dialable(self, now: float) -> int:
+        return sum(1 for c in self.candidates.values() if self._dialable(c, now))
+
+    def _dialable(self, c: Candidate, now: float) -> bool:
+        return not c.connected and c.address not in self.dialing and c.next_attempt <= now
+
+    def to_dial(self, num_peers: int, now: float) -> list:
+        """
+        The addresses to dial now, given we have num_peers peers, best first.
+        They're counted as dialing until connected() or failed() is called for them.
+        """
+        n = min(self.target_peers - num_peers, self.max_peers - num_peers - self.accepting,
+                self.max_dials) - len(self.dialing)
+        if n <= 0:
+            return []
+
+        ready = [c for c in self.candidates.values() if self._dialable(c, now)]
+        ready.sort(key=lambda c: (c.failures + c.drops, c.next_attempt))
+
+        addresses = [c.address for c in ready[:n]]
+        self.dialing.update(addresses)
+        self.dials += len(addresses)
+        return addresses
+
+    def connected(self, address: tuple, now: float):
+        self.dialing.discard(address)
+        c = self.candidates.get(address)
+        if c is not None:
+            c.connected = True
+            c.connected_since = now
+            c.failures = 0
+
+    def _backoff(self, times: int) -> float:
+        return min(self.BASE_BACKOFF * 2 ** (times - 1), self.MAX_BACKOFF)
+
+    def failed(self, address: tuple, now: float):
+        """Dialing address didn't work out: back off from it, or give up on it"""
+        self.dialing.discard(address)
+        self.dial_failures += 1
+        c = self.candidates.get(address)
+        if c is None:
+            return
+
+        c.failures += 1
+        if c.failures >= self.MAX_FAILURES:
+            del self.candidates[address]
+        else:
+            c.next_attempt = now + self._backoff(c.failures)
+
+    def disconnected(self, address: tuple, now: float):
+        """
+        A peer we dialed went away.  Someone else can be dialed meanwhile, and it can be dialed again later:
+        the more often it's disconnected soon after connecting, the later.
+        """
+        c = self.candidates.get(address)
+        if c is None:
+            return
+
+        c.connected = False
+        if c.connected_since is not None and now - c.connected_since >= self.STABLE_CONNECTION:
+            c.drops = 0
+        c.drops += 1
+
+        if c.drops >= self.MAX_FAILURES:
+            del self.candidates[address]
+        else:
+            c.next_attempt = now + self._backoff(c.drops)
+
+    def reserve_incoming(self, num_peers: int) -> bool:
+        """
+        Whether to take on an incoming connection, when we have num_peers peers.  If so, it holds a slot until
+        incoming_done() is called, once it's been added to the peers or given up on.
+        """
+        if num_peers + len(self.dialing) + self.accepting < self.max_peers:
+            self.accepting += 1
+            return True
+
+        self.rejected += 1
+        return False
+
+    def incoming_done(self):
+        self.accepting -= 1
@@ -1,9 +1,16 @@
 import argparse
 import asyncio
+import os
 import random
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cache import PieceCache
+from filepool import FilePool
+from ratelimit import GLOBAL_LIMITS
+from resume import ResumeState
 from tracker import Tracker, DummyTracker, Peer
-from storage import PieceIO, PieceManager
+from storage import MmapPieceIO, PieceIO, PieceManager
 from swarm import Swarm
 from torrent import Torrent
 
@@ -16,13 +23,36 @@ PEER_ID_LEN = 20
 # PEER_ID = random.SystemRandom.getrandbits(PEER_ID_LEN * 8).to_bytes(PEER_ID_LEN, byteorder='little')
 
 class Downloader:
-    def __init__(self, file, dl_dir, ip, port, direct_host=None, direct_port=None):
+    def __init__(self, file, dl_dir, ip, port, direct_host=None, direct_port=None, workers=None, worker_processes=False,
+                 recheck=False, use_mmap=False, max_open_files=FilePool.DEFAULT_MAX_OPEN, preallocate=False,
+                 read_cache_size=PieceCache.DEFAULT_MAX_BYTES, write_buffer_size=PieceIO.DEFAULT_WRITE_BUFFER_SIZE,
+                 upload_limit=None, download_limit=None):
         self.torrent = Torrent(file, dl_dir)
 
-        piece_io = PieceIO(self.torrent)
+        # Bytes per second, across everything (None for unlimited)
+        GLOBAL_LIMITS.set(upload_limit, download_limit)
+
+        # Verify and write pieces off the event loop
+        if worker_processes:
+            executor = ProcessPoolExecutor(workers)
+        else:
+            executor = ThreadPoolExecutor(workers or os.cpu_count())
+
+        pool = FilePool(max_open_files, preallocate)
+        if use_mmap:
+            self.piece_io = MmapPieceIO(self.torrent, pool)
+            # Reads from the mapping don't copy, so there's nothing to cache
+            self.cache = None
+        else:
+            self.piece_io = PieceIO(self.torrent, pool, write_buffer_size)
+            self.cache = PieceCache(read_cache_size) if read_cache_size else None
         piece_mgr = PieceManager(
             t=self.torrent,
-            io=piece_io
+            io=self.piece_io,
+            executor=executor,
+            resume_file=ResumeState.path_for(self.torrent),
+            recheck=recheck,
+            cache=self.cache
         )
 
         if direct_host and direct_port:
@@ -48,13 +78,25 @@ class Downloader:
     def start(self):
         loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
 
-        loop.run_until_complete(
-            self.swarm.start()
-        )
-
-
-def download_torrent(filename, dl_dir, public_port, dhost=None, dport=None):
-    d = Downloader(filename, dl_dir, HOST, public_port, direct_host=dhost, direct_port=dport)
+        try:
+            loop.run_until_complete(
+                self.swarm.start()
+            )
+        finally:
+            self.swarm.stop()
+            if self.cache is not None:
+                self.cache.clear()
+            self.piece_io.close()
+
+
+def download_torrent(filename, dl_dir, public_port, dhost=None, dport=None, workers=None, worker_processes=False,
+                     recheck=False, use_mmap=False, max_open_files=FilePool.DEFAULT_MAX_OPEN, preallocate=False,
+                     read_cache_size=PieceCache.DEFAULT_MAX_BYTES, write_buffer_size=PieceIO.DEFAULT_WRITE_BUFFER_SIZE,
+                     upload_limit=None, download_limit=None):
+    d = Downloader(filename, dl_dir, HOST, public_port, direct_host=dhost, direct_port=dport, workers=workers,
+                   worker_processes=worker_processes, recheck=recheck, use_mmap=use_mmap,
+                   max_open_files=max_open_files, preallocate=preallocate, read_cache_size=read_cache_size,
+                   write_buffer_size=write_buffer_size, upload_limit=upload_limit, download_limit=download_limit)
     d.start()
 
 
@@ -64,6 +106,19 @@ def main():
     p.add_argument("-p", "--port", type=int, required=True)
     p.add_argument("-d", "--download-dir", required=True)
     p.add_argument("--direct")
+    p.add_argument("-w", "--workers", type=int, help="Threads (or processes) verifying and writing pieces")
+    p.add_argument("--worker-processes", action="store_true", help="Hash pieces in processes instead of threads")
+    p.add_argument("--recheck", action="store_true", help="Hash everything on disk instead of trusting the resume file")
+    p.add_argument("--mmap", action="store_true", help="Memory map downloaded files")
+    p.add_argument("--max-open-files", type=int, default=FilePool.DEFAULT_MAX_OPEN,
+                   help="How many downloaded files to keep open at once")
+    p.add_argument("--preallocate", action="store_true", help="Allocate disk space for files up front")
+    p.add_argument("--read-cache", type=int, default=PieceCache.DEFAULT_MAX_BYTES >> 20,
+                   help="MiB of pieces to keep in memory for seeding (0 to disable)")
+    p.add_argument("--write-buffer", type=int, default=PieceIO.DEFAULT_WRITE_BUFFER_SIZE >> 20,
+                   help="MiB of downloaded pieces to gather before writing them out (0 to write each one straight away)")
+    p.add_argument("--upload-limit", type=int, default=0, help="KiB/s to upload at most (0 for no limit)")
+    p.add_argument("--download-limit", type=int, default=0, help="KiB/s to download at most (0 for no limit)")
 
     args = p.parse_args()
 
@@ -73,7 +128,9 @@ def main():
         print(f'Making direct connection to {args.direct}')
         dhost, dport = args.direct.split(':')
 
-    download_torrent(args.torrent_file, args.download_dir, args.port, dhost, dport)
+    download_torrent(args.torrent_file, args.download_dir, args.port, dhost, dport, args.workers, args.worker_processes,
+                     args.recheck, args.mmap, args.max_open_files, args.preallocate, args.read_cache << 20,
+                     args.write_buffer << 20, (args.upload_limit << 10) or None, (args.download_limit << 10) or None)
 
 
 if __name__ == "__main__":
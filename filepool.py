@@ -0,0 +1,121 @@
+import os
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+from torrent import TorrentFile
+
+# Flushes a file's data (but not necessarily metadata like its mtime) to disk
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class FilePool:
+    """
+    Opens a torrent's files the first time they're read or written, and keeps at most max_open of them open,
+    closing the least recently used.
+
+    Files are sized to their full length when opened: sparsely (by truncating), or by allocating every block
+    up front if preallocate is set, which avoids fragmentation and running out of space halfway through.
+
+    Files written to are remembered until sync() flushes them to disk, whether or not they're still open.
+    """
+
+    DEFAULT_MAX_OPEN = 128
+
+    def __init__(self, max_open: int = DEFAULT_MAX_OPEN, preallocate: bool = False):
+        assert max_open > 0
+
+        self.max_open = max_open
+        self.preallocate = preallocate
+
+        self.fds = OrderedDict()  # path -> fd, least recently used first
+        self.users = {}  # path -> number of threads using its fd, which mustn't be closed under them
+        self.dirty = set()  # paths written to since the last sync()
+        self.lock = Lock()
+
+    @contextmanager
+    def open(self, f: TorrentFile, writing: bool = False):
+        """Yields a file descriptor for f, which stays open until the with block exits"""
+        with self.lock:
+            if writing:
+                self.dirty.add(f.path)
+
+            fd = self.fds.get(f.path)
+            if fd is None:
+                fd = self._open(f)
+                self.fds[f.path] = fd
+            else:
+                self.fds.move_to_end(f.path)
+
+            self.users[f.path] = self.users.get(f.path, 0) + 1
+            self._close_unused()
+
+        try:
+            yield fd
+
+        finally:
+            with self.lock:
+                self.users[f.path] -= 1
+                if self.users[f.path] == 0:
+                    del self.users[f.path]
+
+                # Catch up, if everything was in use when we went over the limit
+                self._close_unused()
+
+    def num_open(self) -> int:
+        return len(self.fds)
+
+    def sync(self):
+        """Flushes every file written to since the last sync to disk"""
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+
+            for path in dirty:
+                fd = self.fds.get(path)
+                if fd is not None:
+                    _fdatasync(fd)
+                    continue
+
+                # Closed since: syncing any descriptor for the file flushes it
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    _fdatasync(fd)
+                finally:
+                    os.close(fd)
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+
+            self.fds.clear()
+
+    def _open(self, f: TorrentFile) -> int:
+        os.makedirs(os.path.dirname(f.path), exist_ok=True)
+        fd = os.open(f.path, os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            size = os.fstat(fd).st_size
+            if size != f.length:
+                if self.preallocate and size < f.length and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, size, f.length - size)
+                else:
+                    os.ftruncate(fd, f.length)
+
+        except OSError:
+            os.close(fd)
+            raise
+
+        return fd
+
+    def _close_unused(self):
+        """Closes least recently used files until we're within max_open (or everything left is in use)"""
+        excess = len(self.fds) - self.max_open
+        if excess <= 0:
+            return
+
+        for path in [path for path in self.fds if path not in self.users][:excess]:
+            os.close(self.fds.pop(path))
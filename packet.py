@@ -1,7 +1,10 @@
+import asyncio
+
 from abc import ABC, abstractmethod
-from asyncio import coroutine, StreamReader, StreamWriter, IncompleteReadError
+from asyncio import coroutine
+from collections import deque
 from enum import Enum
-from struct import calcsize, pack, unpack, Struct
+from struct import calcsize, error as StructError, pack, unpack, Struct
 from typing import Union
 
 from bitfield import Bitfield
@@ -122,7 +125,7 @@ class BittorrentPacketHeader:
         return cls.bspec.size
 
     def serialize(self) -> bytes:
-        self.bspec.pack(self.length, self.type().value)
+        return self.bspec.pack(self.length, self.type().value)
 
     @classmethod
     def deserialize(cls, buf: bytes):
@@ -238,6 +241,21 @@ class HavePacket(BittorrentPacket):
     def serialize(self):
         return self.bspec.pack(self.body_bspec.size + 1, self.type.value, self.completed_piece_index)
 
+    @classmethod
+    def serialize_many(cls, piece_indices: list) -> bytearray:
+        """HAVE messages for every piece in piece_indices, packed straight into one buffer"""
+        size = cls.bspec.size
+        buf = bytearray(size * len(piece_indices))
+
+        pack_into = cls.bspec.pack_into
+        length, ptype = cls.body_bspec.size + 1, cls.type.value
+        offset = 0
+        for piece_index in piece_indices:
+            pack_into(buf, offset, length, ptype, piece_index)
+            offset += size
+
+        return buf
+
     @classmethod
     def size(cls):
         return cls.bspec.size
@@ -257,7 +275,7 @@ class BitfieldPacket(BittorrentPacket):
         self.b = Bitfield(bitfield)
 
     def __repr__(self):
-        return f'BitfieldPacket(\n\tbitfield={self.b.bitfield}\n)'
+        return f'BitfieldPacket(\n\tbitfield={bytes(self.b)}\n)'
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -275,7 +293,7 @@ class BitfieldPacket(BittorrentPacket):
 
     @classmethod
     def deserialize(cls, buf: bytes) -> "BitfieldPacket":
-        return cls(bitfield=buf)
+        return cls(bitfield=bytes(buf))
 
 
 class RequestPacket(BittorrentPacket):
@@ -295,21 +313,26 @@ class RequestPacket(BittorrentPacket):
         return False
 
     def serialize(self):
-        return self.bspec.pack(
-            self.body_bspec.size + 1,
-            self.type.value,
-            self.req.index(),
-            self.req.begin_offset(),
-            self.req.length()
-        )
+        return self.bspec.pack(self.body_bspec.size + 1, self.type.value, *self.req)
 
     @classmethod
-    def deserialize(cls, buf: bytes) -> "RequestPacket":
-        piece_index, begin_offset, piece_length = cls.body_bspec.unpack(buf)
+    def serialize_many(cls, requests: list) -> bytearray:
+        """Messages (REQUESTs, or CANCELs from CancelPacket) for every request, packed straight into one buffer"""
+        size = cls.bspec.size
+        buf = bytearray(size * len(requests))
 
-        return cls(
-            Request(piece_index, begin_offset, piece_length)
-        )
+        pack_into = cls.bspec.pack_into
+        length, ptype = cls.body_bspec.size + 1, cls.type.value
+        offset = 0
+        for piece_index, begin_offset, block_length in requests:
+            pack_into(buf, offset, length, ptype, piece_index, begin_offset, block_length)
+            offset += size
+
+        return buf
+
+    @classmethod
+    def deserialize(cls, buf: bytes) -> "RequestPacket":
+        return cls(Request(*cls.body_bspec.unpack(buf)))
 
     def request(self) -> Request:
         return self.req
@@ -335,15 +358,20 @@ class BlockPacket(BittorrentPacket):
         return self.bspec.size + len(self.b.data())
 
     def serialize(self):
+        return self.serialize_header() + self.b.data()
+
+    def serialize_header(self) -> bytes:
+        """Everything before the data, so the data can be sent without copying it into one message"""
         return self.bspec.pack(
             self.body_bspec.size + 1 + len(self.b.data()),
             self.type.value,
             self.b.index(),
             self.b.begin_offset(),
-        ) + self.b.data()
+        )
 
     @classmethod
     def deserialize(cls, buf: bytes) -> "PiecePacket":
+        """Keeps a view of buf for the data when it's a memoryview, rather than copying it"""
         piece_index, begin_offset = cls.body_bspec.unpack_from(buf)
         data = buf[cls.body_bspec.size:]
 
@@ -378,55 +406,283 @@ PACKETS_BY_TYPE = {
     BittorrentPacketType.CANCEL: CancelPacket
 }
 
+PACKETS_BY_ID = {t.value: cls for t, cls in PACKETS_BY_TYPE.items() if t.value >= 0}
 
-@coroutine
-def read_next_packet(reader: StreamReader):
-    try:
-        # Read header to get length
-        header_bytes = yield from reader.readexactly(BittorrentPacketHeader.size())
-        header: BittorrentPacketHeader = BittorrentPacketHeader.deserialize(header_bytes)
+message_length_bspec = Struct('!L')
 
-        # Read inner packet
-        pkt_len = header.body_length()
-        next_packet_body = yield from reader.readexactly(pkt_len)
-        next_packet = PACKETS_BY_TYPE[header.type()].deserialize(next_packet_body)
 
-        return next_packet
+def parse_packets(buf: memoryview, start: int, end: int, packets: list) -> int:
+    """
+    Parses every complete message in buf[start:end] onto packets, and returns where the first incomplete one starts.
+    Payloads are views of buf, not copies.
+    """
+    while end - start >= 4:
+        length, = message_length_bspec.unpack_from(buf, start)
+        if end - start - 4 < length:
+            break
 
-    except IncompleteReadError:
-        raise PeerDisconnected()
+        if length == 0:
+            packets.append(KeepalivePacket())
+
+        else:
+            pkt_cls = PACKETS_BY_ID.get(buf[start + 4])
+            if pkt_cls is None:
+                print(f'Ignoring message of unknown type {buf[start + 4]}')
+            else:
+                packets.append(pkt_cls.deserialize(buf[start + 5:start + 4 + length]))
+
+        start += 4 + length
+
+    return start
+
+
+class PeerConnection(asyncio.BufferedProtocol):
+    """
+    A connection to a peer.  Everything received goes into one buffer, and as many messages as possible are parsed
+    out of each read, queueing up for read_packet() (reading pauses if they pile up).  BLOCK payloads are views of
+    the receive buffer, so they're only copied once: into their piece.
+
+    Sending is corked: packets queue up until the end of the event loop iteration (or until CORK_LIMIT bytes are
+    queued) and go out in one writelines() call, with runs of small messages joined together and BLOCK payloads
+    passed along as they are.  Senders only wait when the transport is over WRITE_HIGH_WATER.
+    """
+
+    RECEIVE_BUFFER_SIZE = 256 * 1024
+    MIN_READ = 16 * 1024  # Move on to a new buffer when there's less room than this left
+    MAX_MESSAGE_LENGTH = 1 << 22  # Bigger ones are junk (a bitfield this big would be for 32 million pieces)
+    MAX_QUEUED_PACKETS = 256
+
+    SMALL_WRITE = 1024  # Messages shorter than this are joined with their neighbours
+    CORK_LIMIT = 64 * 1024  # Write out queued messages straight away once there are this many bytes
+    WRITE_HIGH_WATER = 256 * 1024  # Senders wait while the transport has more than this buffered
+
+    def __init__(self, on_connect=None):
+        self.on_connect = on_connect  # Coroutine function started with this connection when a peer connects to us
+        self.transport = None
+
+        # Receive buffer.  Bytes from start to end haven't been parsed yet.
+        self.buffer = bytearray(self.RECEIVE_BUFFER_SIZE)
+        self.start = 0
+        self.end = 0
+        self.needed = 0  # Length of the message at start (including its length), once we know it
+        self.handshake_received = False
+
+        self.packets = deque()
+        self.packet_waiter = None
+        self.reading_paused = False
+        self.error = None  # Why there won't be any more packets
+
+        self.outgoing = []  # Corked writes: bytearrays of joined small messages, and large buffers
+        self.joining = None  # The bytearray at the end of outgoing which small messages are being joined onto
+        self.outgoing_bytes = 0
+        self.flush_handle = None
+        self.writing_paused = False
+        self.drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.WRITE_HIGH_WATER)
+        if self.on_connect is not None:
+            asyncio.ensure_future(self.on_connect(self))
+
+    def connection_lost(self, exc):
+        self._stop_reading(PeerDisconnected(exc or 'Connection closed'))
+        self._wake(self.drain_waiter)
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < self.MIN_READ or len(self.buffer) - self.start < self.needed:
+            self._new_buffer()
+
+        return memoryview(self.buffer)[self.end:]
+
+    def _new_buffer(self):
+        # Packets we've parsed might still be looking at the old one, so it can't be reused
+        unparsed = self.end - self.start
+        buffer = bytearray(max(self.RECEIVE_BUFFER_SIZE, self.needed + self.MIN_READ))
+        buffer[:unparsed] = memoryview(self.buffer)[self.start:self.end]
+
+        self.buffer, self.start, self.end = buffer, 0, unparsed
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        buf = memoryview(self.buffer)
+        packets = []
 
-    except ValueError as e:
-        print(e)
         try:
-            print(header)
-        except:
-            print('header was not defined')
+            if not self.handshake_received:
+                # Handshakes aren't length prefixed
+                if self.end - self.start < HandshakePacket.size():
+                    return
+
+                packets.append(HandshakePacket.deserialize(buf[self.start:self.start + HandshakePacket.size()]))
+                self.start += HandshakePacket.size()
+                self.handshake_received = True
+
+            self.start = parse_packets(buf, self.start, self.end, packets)
+
+            self.needed = 0
+            if self.end - self.start >= 4:
+                self.needed = 4 + message_length_bspec.unpack_from(buf, self.start)[0]
+                if self.needed > self.MAX_MESSAGE_LENGTH:
+                    raise MalformedPacketException(f'{self.needed} byte message')
+
+        except (ValueError, StructError) as e:
+            print(f'Malformed packet: {e}')
+            self._stop_reading(PeerDisconnected(f'Malformed packet: {e}'))
+            self.transport.close()
+
+        finally:
+            self.packets.extend(packets)
+            if packets:
+                self._wake(self.packet_waiter)
+
+        if len(self.packets) > self.MAX_QUEUED_PACKETS and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def eof_received(self):
+        self._stop_reading(PeerDisconnected('Peer closed the connection'))
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self._wake(self.drain_waiter)
+
+    @coroutine
+    def read_packet(self):
+        """The next packet from the peer (the first is always its handshake), waiting for it if needs be"""
+        while not self.packets:
+            if self.error is not None:
+                raise self.error
 
-    # except Exception as e:
-    #     print(e)
+            self.packet_waiter = asyncio.get_event_loop().create_future()
+            yield from self.packet_waiter
 
-        # raise e
+        pkt = self.packets.popleft()
+
+        if self.reading_paused and len(self.packets) <= self.MAX_QUEUED_PACKETS // 2:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+        return pkt
+
+    def send(self, packet: Union[BittorrentPacket, HandshakePacket]):
+        """Queues packet to be written, with everything else sent before the event loop next polls"""
+        if self.transport.is_closing():
+            raise PeerDisconnected('Connection closed')
+
+        if isinstance(packet, BlockPacket):
+            self.write(packet.serialize_header())
+            self.write(packet.block().data())
+        else:
+            self.write(packet.serialize())
+
+    def write(self, data):
+        if len(data) < self.SMALL_WRITE:
+            if self.outgoing and self.outgoing[-1] is self.joining:
+                self.joining += data
+            else:
+                self.joining = bytearray(data)
+                self.outgoing.append(self.joining)
+        else:
+            self.outgoing.append(data)
+
+        self.outgoing_bytes += len(data)
+
+        if self.outgoing_bytes >= self.CORK_LIMIT:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        """Writes out everything queued"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        outgoing = self.outgoing
+        self.outgoing = []
+        self.joining = None
+        self.outgoing_bytes = 0
+
+        if outgoing and not self.transport.is_closing():
+            self.transport.writelines(outgoing)
+
+    @coroutine
+    def drain(self):
+        """Waits while the transport's write buffer is over its high-water mark"""
+        while self.writing_paused and not self.transport.is_closing():
+            self.drain_waiter = asyncio.get_event_loop().create_future()
+            yield from self.drain_waiter
+
+        if self.transport.is_closing():
+            raise PeerDisconnected('Connection closed')
+
+    def close(self):
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
+
+    def _stop_reading(self, error: Exception):
+        if self.error is None:
+            self.error = error
+        self._wake(self.packet_waiter)
+
+    @staticmethod
+    def _wake(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
 
 
 @coroutine
-def read_handshake_response(reader: StreamReader) -> HandshakePacket:
-    try:
-        handshake_resp_bytes = yield from reader.readexactly(HandshakePacket.size())
-    except (ConnectionResetError, IncompleteReadError):
-        raise PeerDisconnected()
+def open_peer_connection(host, port) -> PeerConnection:
+    _, conn = yield from asyncio.get_event_loop().create_connection(PeerConnection, host, port)
+    return conn
+
+
+@coroutine
+def start_peer_server(on_connect, host, port):
+    """Listens for peers, starting on_connect(PeerConnection) for each one which connects"""
+    return (yield from asyncio.get_event_loop().create_server(lambda: PeerConnection(on_connect), host=host, port=port))
+
+
+@coroutine
+def read_handshake_response(conn: PeerConnection) -> HandshakePacket:
+    pkt = yield from conn.read_packet()
+    if not isinstance(pkt, HandshakePacket):
+        raise MalformedPacketException(f'Expected a handshake, got {pkt}')
 
-    handshake_resp = HandshakePacket.deserialize(handshake_resp_bytes)
+    return pkt
 
-    return handshake_resp
+
+@coroutine
+def read_next_packet(conn: PeerConnection):
+    return (yield from conn.read_packet())
+
+
+@coroutine
+def send_packet(conn: PeerConnection, packet: Union[BittorrentPacket, HandshakePacket]):
+    """Queues packet on conn, only waiting if conn has too much to write already"""
+    try:
+        conn.send(packet)
+        if conn.writing_paused:
+            yield from conn.drain()
+    except (BrokenPipeError, ConnectionError):
+        raise PeerDisconnected()
 
 
 @coroutine
-def send_packet(writer: StreamWriter, packet: Union[BittorrentPacket, HandshakePacket]):
-    writer.write(packet.serialize())
+def send_serialized(conn: PeerConnection, data):
+    """Like send_packet, for messages which have already been serialized (e.g. by serialize_many)"""
+    if conn.transport.is_closing():
+        raise PeerDisconnected('Connection closed')
 
     try:
-        yield from writer.drain()
+        conn.write(data)
+        if conn.writing_paused:
+            yield from conn.drain()
     except (BrokenPipeError, ConnectionError):
         raise PeerDisconnected()
 
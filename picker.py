@@ -0,0 +1,123 @@
+from random import randrange
+from typing import Callable, Optional
+
+from bitfield import Bitfield
+
+
+class PiecePicker:
+    """
+    Chooses which piece to download next.
+
+    Tracks how many connected peers have each piece (its availability), and hands out pieces
+    nobody has started yet rarest first.  Pieces that have been started are kept in insertion
+    order in self.partial so they can be finished before new pieces are picked.
+    """
+
+    def __init__(self, num_pieces: int):
+        self.num_pieces = num_pieces
+        self.availability = [0] * num_pieces
+
+        # buckets[a] holds the unstarted pieces which a peers have.
+        # position[i] is piece i's index in its bucket, or -1 once it's been started or finished.
+        self.buckets = [list(range(num_pieces))]
+        self.position = list(range(num_pieces))
+
+        # Started, but not finished pieces (dict as an ordered set)
+        self.partial = {}
+
+    def __repr__(self):
+        return f'PiecePicker(\n\tnum_pieces={self.num_pieces},\n\tunstarted={self.num_unstarted()},\n\tpartial={len(self.partial)}\n)'
+
+    def num_unstarted(self) -> int:
+        return sum(len(b) for b in self.buckets)
+
+    def _remove(self, index: int):
+        pos = self.position[index]
+        if pos < 0:
+            return
+
+        bucket = self.buckets[self.availability[index]]
+        last = bucket.pop()
+        if last != index:
+            # Swap the last piece into the hole
+            bucket[pos] = last
+            self.position[last] = pos
+
+        self.position[index] = -1
+
+    def _insert(self, index: int):
+        a = self.availability[index]
+        while len(self.buckets) <= a:
+            self.buckets.append([])
+
+        bucket = self.buckets[a]
+        self.position[index] = len(bucket)
+        bucket.append(index)
+
+    def _set_availability(self, index: int, a: int):
+        if self.position[index] < 0:
+            self.availability[index] = a
+            return
+
+        self._remove(index)
+        self.availability[index] = a
+        self._insert(index)
+
+    def peer_has(self, index: int):
+        """A peer announced it has piece index (HAVE)"""
+        self._set_availability(index, self.availability[index] + 1)
+
+    def peer_lost(self, index: int):
+        """A peer which had piece index went away"""
+        assert self.availability[index] > 0
+        self._set_availability(index, self.availability[index] - 1)
+
+    def add_bitfield(self, bf: Bitfield):
+        """A peer announced all the pieces it has (BITFIELD)"""
+        for i in bf.set_bits():
+            if i >= self.num_pieces:
+                break
+            self.peer_has(i)
+
+    def remove_bitfield(self, bf: Bitfield):
+        """A peer with pieces bf disconnected or replaced its bitfield"""
+        for i in bf.set_bits():
+            if i >= self.num_pieces:
+                break
+            self.peer_lost(i)
+
+    def start(self, index: int):
+        """Take piece index out of the rarest first pool, and finish it before picking others"""
+        self._remove(index)
+        self.partial[index] = None
+
+    def finish(self, index: int):
+        """Never pick piece index again"""
+        self._remove(index)
+        self.partial.pop(index, None)
+
+    def partial_pieces(self) -> list:
+        """Started pieces, oldest first"""
+        return list(self.partial)
+
+    def pick(self, has_piece: Callable[[int], bool] = None) -> Optional[int]:
+        """
+        Starts and returns the rarest unstarted piece for which has_piece(index) is true,
+        or None if there isn't one.  Ties are broken randomly.
+
+        Pieces no peer has are only picked once every piece someone has was started.
+        """
+        for a in list(range(1, len(self.buckets))) + [0]:
+            bucket = self.buckets[a]
+            if not bucket:
+                continue
+
+            # Start at a random spot, so peers don't all go after the same piece
+            start = randrange(len(bucket))
+            for i in range(len(bucket)):
+                index = bucket[(start + i) % len(bucket)]
+                if has_piece is None or has_piece(index):
+                    self.start(index)
+                    return index
+
+        return None
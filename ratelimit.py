@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+from asyncio import coroutine
+
+
+class TokenBucket:
+    """
+    Limits a byte rate.  Tokens accumulate at rate per second, up to burst, and consume(n) takes n of them.
+    Bytes are let through as soon as there are any tokens, which can leave the bucket in debt (so messages bigger
+    than the burst still get through); the next consumer waits for the debt to be paid off.
+
+    Consumers wait their turn in order, so one busy peer can't starve the others.
+    rate is None for no limit, and can be changed at any time with set_rate().
+    """
+
+    MAX_WAIT = 0.25  # Waiting consumers look again this often, in case the rate was changed
+
+    def __init__(self, rate: int = None, burst: int = None):
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0
+        self.__last_refill = time.monotonic()
+        self.__turn = None  # Made on first use, as before Python 3.10 locks belong to the loop current when made
+
+        self.set_rate(rate, burst)
+
+    def __repr__(self):
+        return f'TokenBucket(rate={self.rate}, burst={self.burst})'
+
+    def set_rate(self, rate: int = None, burst: int = None):
+        """Bytes per second (None for unlimited), and how many can go at once (a second's worth by default)"""
+        self._refill()
+        was_limited = self.rate is not None
+        self.rate = rate or None
+        self.burst = burst if burst is not None else (rate or 0)
+        # A new limit starts with a full bucket, a changed one keeps its debt
+        self.tokens = min(self.tokens, self.burst) if was_limited else self.burst
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.__last_refill) * self.rate)
+        self.__last_refill = now
+
+    def limited(self) -> bool:
+        return self.rate is not None
+
+    @coroutine
+    def consume(self, n: int):
+        """Waits until n bytes can go"""
+        if self.rate is None:
+            return
+
+        if self.__turn is None:
+            self.__turn = asyncio.Lock()
+
+        yield from self.__turn.acquire()
+        try:
+            self._refill()
+            while self.rate is not None and self.tokens <= 0:
+                yield from asyncio.sleep(min(-self.tokens / self.rate + 0.001, self.MAX_WAIT))
+                self._refill()
+
+            self.tokens -= n
+        finally:
+            self.__turn.release()
+
+
+class RateLimits:
+    """Upload and download limits for everything, one torrent, or one peer"""
+
+    def __init__(self, upload: int = None, download: int = None):
+        self.upload = TokenBucket(upload)
+        self.download = TokenBucket(download)
+
+    def __repr__(self):
+        return f'RateLimits(upload={self.upload.rate}, download={self.download.rate})'
+
+    def set(self, upload: int = None, download: int = None):
+        """Changes both limits (None for unlimited)"""
+        self.upload.set_rate(upload)
+        self.download.set_rate(download)
+
+
+# Shared by every torrent
+GLOBAL_LIMITS = RateLimits()
+
+
+@coroutine
+def throttle(buckets: list, n: int):
+    """Waits until n bytes are allowed by every bucket (narrowest scope first)"""
+    for bucket in buckets:
+        yield from bucket.consume(n)
@@ -0,0 +1,76 @@
+import os
+
+from bencode import bencode, bdecode_buffer
+from torrent import Torrent
+
+
+class ResumeState:
+    """
+    What we had downloaded last time, saved next to the download so restarts don't have to rehash it.
+
+    Holds the finished pieces' bitfield, each file's size and modification time when the state was saved
+    (so files touched since can be rehashed), and the blocks of partially downloaded pieces.
+    """
+
+    def __init__(self, info_hash: bytes, bitfield: bytes, files: dict, partial_pieces: dict):
+        self.info_hash = info_hash
+        self.bitfield = bitfield
+        self.files = files  # path -> (length, mtime in ns)
+        self.partial_pieces = partial_pieces  # piece index -> list[tuple[begin_offset, data]]
+
+    def __repr__(self):
+        return f'ResumeState(\n\tinfo_hash={self.info_hash},\n\tfiles={len(self.files)},\n\tpartial_pieces={len(self.partial_pieces)}\n)'
+
+    @staticmethod
+    def path_for(t: Torrent) -> str:
+        """Where the resume state for t is kept"""
+        return os.path.join(t.download_dir, f'.{t.name}.resume')
+
+    def unchanged(self, path: str, length: int, mtime: int) -> bool:
+        """True if the file at path was the same size and last modified at the same time when this was saved"""
+        return self.files.get(path) == (length, mtime)
+
+    def serialize(self) -> bytes:
+        return bencode({
+            'info hash': self.info_hash,
+            'pieces': self.bitfield,
+            'files': [{'path': path, 'length': length, 'mtime': mtime} for path, (length, mtime) in self.files.items()],
+            'partial': {str(index): [[off, data] for off, data in blocks] for index, blocks in self.partial_pieces.items()}
+        })
+
+    @classmethod
+    def deserialize(cls, buf: bytes) -> "ResumeState":
+        d = bdecode_buffer(buf)
+
+        return cls(
+            info_hash=d['info hash'],
+            bitfield=d['pieces'],
+            files={f['path'].decode(): (f['length'], f['mtime']) for f in d['files']},
+            partial_pieces={int(index): [(off, data) for off, data in blocks]
+                            for index, blocks in d['partial'].items()}
+        )
+
+    def save(self, path: str):
+        # Write then rename, so a crash never leaves half a resume file
+        tmp_path = path + '.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(self.serialize())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ResumeState":
+        """Returns the state saved at path, or None if there isn't a usable one"""
+        try:
+            with open(path, 'rb') as f:
+                return cls.deserialize(f.read())
+
+        except FileNotFoundError:
+            return None
+
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f'Ignoring corrupt resume file {path}: {e}')
+            return None
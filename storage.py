@@ -1,73 +1,90 @@
+import asyncio
+import mmap
+import os
+
 from abc import ABC, abstractmethod
-from collections import deque
+from asyncio import coroutine
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from hashlib import sha1
-from random import shuffle
-
-from bitfield import MutableBitfield
+from threading import Condition, Lock, Thread
+from typing import Optional
+
+from bitfield import Bitfield, MutableBitfield
+from cache import PieceCache
+from filepool import FilePool
+from picker import PiecePicker
+from resume import ResumeState
 # from packet import PiecePacket, RequestPacket
 from torrent import Torrent, TorrentFile
 
 BLOCK_EXP = 14
 BLOCK_LEN = int(1 << 14)
+IOV_MAX = 1024  # Most buffers one pwritev takes (POSIX only promises 16, but Linux and the BSDs take 1024)
 
 
 class PieceVerificationException(Exception):
     pass
 
 
-class Request:
-    def __init__(self, piece_index: int, begin_offset: int, length: int):
-        self.__piece_idx = piece_index
-        self.__begin_offset = begin_offset
-        self.__length = length
+class Request(tuple):
+    """
+    A request for length bytes at begin_offset into piece piece_index.
+
+    Requests (and Blocks) are made for every message on the wire, so they're plain tuples underneath:
+    cheap to make, hash and compare, with no __dict__.
+    """
+    __slots__ = ()
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.index() == other.index() and self.begin_offset() == other.begin_offset() and self.length() == other.length()
-        return False
+    def __new__(cls, piece_index: int, begin_offset: int, length: int):
+        return tuple.__new__(cls, (piece_index, begin_offset, length))
 
-    def __hash__(self):
-        return self.index() * 19 + self.begin_offset()
+    def __getnewargs__(self):
+        return tuple(self)
 
     def __repr__(self):
         return f'Request(\n\tpiece_index={self.index()},\n\tbegin_offset={self.begin_offset()},\n\tlength={self.length()}\n)'
 
     def index(self) -> int:
-        return self.__piece_idx
+        return self[0]
 
     def begin_offset(self) -> int:
-        return self.__begin_offset
+        return self[1]
 
     def length(self) -> int:
-        return self.__length
+        return self[2]
 
 
-class Block:
+class Block(tuple):
+    """length bytes of data at begin_offset into piece piece_index"""
+    __slots__ = ()
 
-    def __init__(self, piece_index: int, begin_offset: int, data: bytes):
-        self.piece_index = piece_index
-        self.begin_off = begin_offset
-        self.dat = data
+    def __new__(cls, piece_index: int, begin_offset: int, data: bytes):
+        return tuple.__new__(cls, (piece_index, begin_offset, data))
 
-    def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.index() == other.index() and self.begin_offset() == other.begin_offset() and self.data() == other.data()
-        return False
+    def __getnewargs__(self):
+        return tuple(self)
 
     def __hash__(self):
-        return self.index() * 19 + self.begin_offset()
+        # Data can be a (unhashable) view of a piece's buffer
+        return hash((self[0], self[1]))
 
     def __repr__(self):
         return f'Block(\n\tpiece_index={self.index()},\n\tbegin_offset={self.begin_offset()},\n\tdata={self.data()}\n)'
 
     def index(self) -> int:
-        return self.piece_index
+        return self[0]
 
     def begin_offset(self) -> int:
-        return self.begin_off
+        return self[1]
 
     def data(self) -> bytes:
-        return self.dat
+        return self[2]
+
+    def request(self) -> Request:
+        """The request this block answers"""
+        return Request(self[0], self[1], len(self[2]))
 
 
 # def fill_file(blocks: iter[Block], start_offset: int = 0):
@@ -105,11 +122,19 @@ def fill_file(blocks: iter, start_offset: int = 0):
 
 
 class Piece:
-    def __init__(self, index: int, checksum: bytes, length: int):
+    """
+    A piece being downloaded.  Which blocks we have (and which have been handed out as requests) are bitmaps,
+    and the blocks themselves are copied into one buffer for the whole piece, allocated when the first one arrives.
+    """
+
+    def __init__(self, index: int, checksum: bytes, length: int, hash_incrementally=True):
         self.index = index
         self.checksum = checksum
         self.length = length
 
+        # Hash blocks as they arrive, or the whole piece in verify() (e.g. on a worker)
+        self.hash_incrementally = hash_incrementally
+
         self.num_blocks = length // BLOCK_LEN
         last_block_len = length % BLOCK_LEN
         if last_block_len > 0:
@@ -124,93 +149,141 @@ class Piece:
     def reset(self):
         """Clear all downloaded blocks, and regenerate block requests"""
         self._init_request_list()
-        self.downloaded_blocks = []
+
+        self.buffer = None  # bytearray of the whole piece
+        self.have = 0  # Bit i is set once block i has been copied into the buffer
+        self.num_have = 0
+
+        # Blocks are hashed as soon as every block before them has arrived
+        self.checksum_state = None
+        self.bytes_in_order = 0
 
     def _init_request_list(self):
-        requests = self._create_request_list()
-        # shuffle(requests)
+        # Blocks from next_block on haven't been handed out by pop_request.  Ones before it have, except for
+        # released ones, which go out again first.
+        self.next_block = 0
+        self.released = []
 
-        self.requests = deque(requests)
-        self.completed_blocks = []
+        # Where next_request carries on looking from
+        self.next_rotation = 0
 
     def _create_request_list(self):
         """Create list of requests for blocks needed to complete this piece"""
-        requests: list[Request] = []
-        last_block_len = self.length % BLOCK_LEN
-
-        # Create block requests
-        for begin_offset in range(0, self.length - last_block_len, BLOCK_LEN):
-            r = Request(
-                self.index,
-                begin_offset,
-                BLOCK_LEN
-            )
-            requests.append(r)
+        return [self._request(i) for i in range(self.num_blocks)]
 
-        # Create last request when BLOCK_LEN doesn't divide PIECE_LEN
-        if last_block_len > 0:
-            r = Request(
-                piece_index=self.index,
-                begin_offset=self.length - last_block_len,
-                length=last_block_len
-            )
-            requests.append(r)
+    def _request(self, block: int) -> Request:
+        begin_offset = block * BLOCK_LEN
+        return Request(self.index, begin_offset, min(BLOCK_LEN, self.length - begin_offset))
 
-        # Double Check That Loop!
-        if len(requests) != self.num_blocks:
-            print(self.length)
-            print(last_block_len)
-            print(len(requests))
-            print(self.num_blocks)
-            print(requests)
-            assert False
+    def _has_block(self, block: int) -> bool:
+        return (self.have >> block) & 1 == 1
 
-        return requests
+    @property
+    def completed_blocks(self) -> list:
+        """Begin offsets of the blocks downloaded so far"""
+        return [i * BLOCK_LEN for i in range(self.num_blocks) if self._has_block(i)]
 
     def all_requests(self) -> list:
         return self._create_request_list()
 
     def block_completed(self, begin_offset: int) -> bool:
         assert begin_offset % BLOCK_LEN == 0
-        # block_index = begin_offset >> BLOCK_EXP
 
-        # return block_index in self.completed_blocks
-        return begin_offset in self.completed_blocks
+        return self._has_block(begin_offset // BLOCK_LEN)
 
     def complete(self):
         """True if all blocks have been downloaded.  ¡DOES NOT VERIFY PIECE HASH!"""
-        return len(self.completed_blocks) == self.num_blocks
+        return self.num_have == self.num_blocks
+
+    def data(self) -> memoryview:
+        """
+        The piece's data.  All of it ONLY if this.complete()
+        Correct ONLY if this.verify()
+        """
+        if self.buffer is None:
+            return memoryview(b'')
+
+        return memoryview(self.buffer)
+
+    def _block(self, block: int) -> Block:
+        begin_offset = block * BLOCK_LEN
+        return Block(self.index, begin_offset, self.data()[begin_offset:min(begin_offset + BLOCK_LEN, self.length)])
 
     # def get_downloaded_blocks(self) -> list[Block]:
     def get_downloaded_blocks(self) -> list:
         """
-        Returns a list of downloaded blocks.
+        Returns a list of downloaded blocks, in order.
         Includes all blocks ONLY if this.completed()
         Blocks are correct ONLY if this.verify()
         """
-        return self.downloaded_blocks
+        return [self._block(i) for i in range(self.num_blocks) if self._has_block(i)]
+
+    def all_blocks(self) -> list:
+        """Every block downloaded so far"""
+        return self.get_downloaded_blocks()
 
     def next_request(self) -> Request:
         """Generate request for next block needed to finish this piece"""
+        if self.complete():
+            return None
 
-        try:
-            r = self.requests.popleft()
-            while self.block_completed(r.begin_offset()):
-                # We can remove completed blocks from the queue
-                r = self.requests.popleft()
+        # Carry on round the piece from the last one
+        block = self.next_rotation
+        while self._has_block(block):
+            block = (block + 1) % self.num_blocks
 
-        except IndexError:
-            # Queue is empty
-            return None
+        self.next_rotation = (block + 1) % self.num_blocks
+        return self._request(block)
+
+    def pop_request(self) -> Request:
+        """
+        Take the request for the next block needed to finish this piece off the queue.
+        Unlike next_request, it isn't asked for again until requeue_missing.
+        """
+        while self.released:
+            block = self.released.pop()
+            if not self._has_block(block):
+                return self._request(block)
+
+        while self.next_block < self.num_blocks:
+            block = self.next_block
+            self.next_block += 1
+
+            if not self._has_block(block):
+                return self._request(block)
+
+        # Every missing block has been requested
+        return None
 
-        # Found a block still needed to complete this piece
-        self.requests.append(r)  # Put r back in the queue until we get data back for it
-        return r
+    def requeue_missing(self):
+        """Queue requests for every block which hasn't been downloaded yet"""
+        self._init_request_list()
+
+    def all_requested(self) -> bool:
+        """True once pop_request has handed out every missing block (and none were released)"""
+        return self.next_block >= self.num_blocks and all(self._has_block(block) for block in self.released)
+
+    def missing_requests(self) -> list:
+        """Requests for every block which hasn't been downloaded yet, whether or not it's been requested"""
+        return [self._request(i) for i in range(self.num_blocks) if not self._has_block(i)]
+
+    def release_request(self, r: Request):
+        """Put a popped request which was never answered back at the front of the queue"""
+        block = r.begin_offset() // BLOCK_LEN
+        if not self._has_block(block) and block < self.next_block and block not in self.released:
+            self.released.append(block)
 
     def save_block(self, b: Block):
         if self.valid_block(b) and not self.block_completed(b.begin_offset()):
-            self.downloaded_blocks.append(b)
-            self.completed_blocks.append(b.begin_offset())
+            if self.buffer is None:
+                self.buffer = bytearray(self.length)
+
+            data = b.data()
+            self.buffer[b.begin_offset():b.begin_offset() + len(data)] = data
+            self.have |= 1 << (b.begin_offset() // BLOCK_LEN)
+            self.num_have += 1
+
+            self._order_blocks()
 
         else:
             if self.block_completed(b.begin_offset()):
@@ -221,8 +294,16 @@ class Piece:
             else:
                 assert False
 
-    def sort_blocks(self):
-        self.downloaded_blocks.sort(key=lambda b: b.begin_offset())
+    def _order_blocks(self):
+        """Move past (and hash) every block which directly follows the in order data"""
+        start = self.bytes_in_order
+        while self.bytes_in_order < self.length and self._has_block(self.bytes_in_order // BLOCK_LEN):
+            self.bytes_in_order = min(self.bytes_in_order + BLOCK_LEN, self.length)
+
+        if self.hash_incrementally and self.bytes_in_order > start:
+            if self.checksum_state is None:
+                self.checksum_state = sha1()
+            self.checksum_state.update(self.data()[start:self.bytes_in_order])
 
     def valid_block(self, b: Block):
         def is_last_block(b: Block):
@@ -230,23 +311,63 @@ class Piece:
 
         return \
             b.begin_offset() % BLOCK_LEN == 0 and \
+            b.begin_offset() < self.length and \
             (len(b.data()) == BLOCK_LEN or is_last_block(b))
 
     def verify(self):
-        self.sort_blocks()
+        """True if the whole piece has been downloaded, and matches its checksum"""
+        if self.bytes_in_order != self.length:
+            return False
 
-        checksum = sha1()
-        bytes_hashed = 0
-        for b in self.downloaded_blocks:
-            data = b.data()
-            checksum.update(data)
-            bytes_hashed += len(data)
+        if self.hash_incrementally:
+            checksum_state = self.checksum_state or sha1()
+            return checksum_state.digest() == self.checksum
+
+        return piece_digest([self.data()]) == self.checksum
 
-        # Pad with 0's  # Don't do this?
-        # if bytes_hashed < self.length:
-        #     checksum.update(b'\x00' * (self.length - bytes_hashed))
+    def release(self):
+        """Drop the piece's data once it's been written"""
+        self.buffer = None
+        self.checksum_state = None
 
-        return checksum.digest() == self.checksum
+
+def print_check_progress(checked: int, total: int):
+    """Prints a line about every 5% of existing pieces checked"""
+    if checked == total or checked % max(total // 20, 1) == 0:
+        print(f'Checked {checked} of {total} existing pieces')
+
+
+def piece_digest(blocks: list) -> bytes:
+    """SHA-1 of a piece's blocks.  Runs on piece verification workers, so it only takes plain data."""
+    checksum = sha1()
+    for data in blocks:
+        checksum.update(data)
+
+    return checksum.digest()
+
+
+def pwrite_all(fd: int, bufs: list, offset: int):
+    """Writes bufs back to back at offset in fd, with as few system calls as we can"""
+    if not hasattr(os, 'pwritev'):
+        for b in bufs:
+            os.pwrite(fd, b, offset)
+            offset += len(b)
+        return
+
+    for i in range(0, len(bufs), IOV_MAX):
+        batch = bufs[i:i + IOV_MAX]
+        length = sum(len(b) for b in batch)
+
+        written = os.pwritev(fd, batch, offset)
+        if written < length:
+            # Short writes don't happen to regular files in practice, but finish the job if one does
+            rest = memoryview(b''.join(batch))[written:]
+            while rest:
+                n = os.pwrite(fd, rest, offset + written)
+                rest = rest[n:]
+                written += n
+
+        offset += length
 
 
 # class PieceStore(ABC):
@@ -275,12 +396,45 @@ class Piece:
 #     return (length_in_bytes // piece_size_in_bytes) + (-length_in_bytes % piece_size_in_bytes)
 
 class PieceIO:
-    """Writes pieces to a file (or multiple files depending on the torrent)"""
+    """
+    Writes pieces to a file (or multiple files depending on the torrent)
 
-    def __init__(self, t: Torrent):
+    With a write buffer, written pieces are kept in memory (up to write_buffer_size bytes) and a background thread
+    writes them out in offset order, joining neighbouring pieces into one vectored write per file.  Reads see
+    pieces which haven't been written out yet, and sync() waits for everything to be.
+    """
+
+    DEFAULT_WRITE_BUFFER_SIZE = 32 * 1024 * 1024
+    FLUSH_INTERVAL = 1  # Longest a piece waits in the write buffer when it isn't filling up (seconds)
+
+    def __init__(self, t: Torrent, pool: FilePool = None, write_buffer_size: int = 0):
         self.torrent: Torrent = t
         # self.path = path
 
+        # Files are opened as they're needed.  Reads and writes are positional, so threads can share them.
+        self.pool = pool or FilePool()
+        self.lock = Lock()
+
+        # Nothing is ever written to empty files, so create them now
+        for f in t.files:
+            if f.length == 0:
+                with self.pool.open(f):
+                    pass
+
+        # Pieces waiting for the flusher thread.  They stay here until they're in the files.
+        self.write_buffer_size = write_buffer_size
+        self.pending = {}  # piece index -> (offset, list of block data)
+        self.pending_bytes = 0
+        self.pending_changed = Condition()
+        self.flush_requested = False
+        self.flush_error = None
+        self.closed = False
+
+        self.flusher = None
+        if write_buffer_size:
+            self.flusher = Thread(target=self._flush_forever, name='PieceIO flusher', daemon=True)
+            self.flusher.start()
+
     # def files_for_piece(self):
     #     '''Returns mapping from offsets in a piece '''
     #     pass
@@ -300,88 +454,202 @@ class PieceIO:
 
         start_offset = r.index() * self.torrent.piece_length + r.begin_offset()
 
-        bytes_to_read = r.length()
-        bytes_read = bytearray()
+        return Block(
+            piece_index=r.index(),
+            begin_offset=r.begin_offset(),
+            data=self.read(start_offset, r.length())
+        )
 
-        for f in self.files_from_offset(start_offset):
-            if bytes_to_read <= 0:
-                break
+    def read(self, start_offset: int, length: int) -> bytearray:
+        """Reads length bytes starting start_offset bytes into the torrent's data, across files"""
+        # Pieces only leave the buffer once they're in the files, so look there first
+        pending = self._pending_in_span(start_offset, length) if self.write_buffer_size else ()
 
-            f: TorrentFile = f
-            fstart_offset = start_offset - f.offset
-            fbytes_to_read = min(bytes_to_read, f.length)
+        data = bytearray()
 
-            f.file.seek(fstart_offset)
-            bytes_read.extend(f.file.read(fbytes_to_read))
+        for f, offset_in_file, _, bytes_to_read in self.file_spans(start_offset, length):
+            with self.pool.open(f) as fd:
+                data += os.pread(fd, bytes_to_read, offset_in_file)
 
-            bytes_to_read -= fbytes_to_read
+        end_offset = start_offset + length
+        for offset, blocks in pending:
+            for b in blocks:
+                first, last = max(offset, start_offset), min(offset + len(b), end_offset)
+                if first < last:
+                    data[first - start_offset:last - start_offset] = b[first - offset:last - offset]
 
-        assert bytes_to_read == 0
+                offset += len(b)
 
-        return Block(
-            piece_index=r.index(),
-            begin_offset=r.begin_offset(),
-            data=bytes_read
-        )
+        return data
 
-    def files_from_offset(self, start_offset):
-        for off, f in self.torrent.end_offsets:
-            # f: TorrentFile = f
-            if off <= start_offset:
-                continue
+    def on_disk(self, start_offset: int, length: int) -> bool:
+        """False if part of this span is in a file which was created (or extended) when the torrent was opened"""
+        end_offset = start_offset + length
 
-            yield f
+        for f in self.files_in_span(start_offset, length):
+            if min(end_offset, f.offset + f.length) > f.offset + f.existing_length:
+                return False
 
-    def write(self, p: Piece):
-        assert p.complete()
-        assert p.verify()
+        return True
+
+    def files_in_span(self, start_offset: int, length: int):
+        """Files holding any of the length bytes starting start_offset bytes into the torrent's data"""
+        return self.torrent.file_index.files_in_span(start_offset, length)
+
+    def files_from_offset(self, start_offset):
+        return self.torrent.file_index.files_from_offset(start_offset)
+
+    def file_spans(self, start_offset: int, length: int):
+        """
+        Splits length bytes starting start_offset bytes into the torrent's data up by (non-empty) file.
+        Yields (file, offset in the file, offset in the span, number of bytes).
+        """
+        done = 0
+        for f in self.files_in_span(start_offset, length):
+            if f.length == 0:
+                continue
 
-        start_offset = p.index * self.torrent.piece_length
-        bytes_written = 0
+            offset_in_file = start_offset + done - f.offset
+            n = min(length - done, f.length - offset_in_file)
 
-        out_files = self.files_from_offset(start_offset)
-        current_file: TorrentFile = next(out_files)
-        offset_in_file = start_offset - current_file.offset
-        current_file.file.seek(offset_in_file)
+            yield f, offset_in_file, done, n
+            done += n
 
-        blocks = iter(p.get_downloaded_blocks())
-        current_block: Block = next(blocks)  # TODO: Should this even have to write an empty piece?
+        assert done == length
 
-        bbytes_written = 0
-        bytes_left_in_block = len(current_block.data())
-        bytes_left_in_file = current_file.length - offset_in_file
+    def sync(self):
+        """Make sure everything written so far is on disk (before anything, like a resume file, says it is)"""
+        if self.write_buffer_size:
+            with self.pending_changed:
+                self.flush_requested = True
+                self.pending_changed.notify_all()
+                self.pending_changed.wait_for(lambda: not self.pending or self.flush_error)
 
-        while bytes_written < p.length:
-            # Get a new block if we need data to write
-            assert bytes_left_in_block >= 0
-            if bytes_left_in_block == 0:
-                assert bbytes_written == len(current_block.data())
-                current_block = next(blocks)
+            self._check_flush_error()
 
-                bbytes_written = 0
-                bytes_left_in_block = len(current_block.data())
+        self.pool.sync()
 
-            # Get a new file if we've filled the last one
-            assert bytes_left_in_file >= 0
-            if bytes_left_in_file == 0:
-                current_file.file.flush()
-                current_file = next(out_files)
-                bytes_left_in_file = current_file.length
+    def close(self):
+        self.sync()
 
-            # How many bytes can we write FROM this blk TO this file
-            bytes_to_write = min(bytes_left_in_block, bytes_left_in_file)
+        if self.flusher is not None:
+            with self.pending_changed:
+                self.closed = True
+                self.pending_changed.notify_all()
+            self.flusher.join()
 
-            # Write it
-            bdata = current_block.data()
-            data_to_write = bdata[bbytes_written: bbytes_written + bytes_to_write]
-            current_file.file.write(data_to_write)
+        self.pool.close()
 
-            bytes_written += bytes_to_write  # Num bytes written of entire piece
-            bbytes_written += bytes_to_write  # Num bytes written of current block
-            bytes_left_in_block -= bytes_to_write  # Bytes still to write in current block
-            bytes_left_in_file -= bytes_to_write  # Bytes we can still write to current file
+    def write(self, p: Piece):
+        """Writes a complete piece.  Callers verify it first (hashing it again here would double the work)."""
+        assert p.complete()
 
-        current_file.file.flush()
+        offset = self.torrent.piece_offset(p.index)
+        blocks = [p.data()]
+
+        if not self.write_buffer_size:
+            self._write_span(offset, blocks)
+            return
+
+        with self.pending_changed:
+            # Wait for room
+            while self.pending and self.pending_bytes + p.length > self.write_buffer_size:
+                self._check_flush_error()
+                self.flush_requested = True
+                self.pending_changed.notify_all()
+                self.pending_changed.wait()
+
+            self._check_flush_error()
+
+            self.pending[p.index] = (offset, blocks)
+            self.pending_bytes += p.length
+
+            if self.pending_bytes >= self.write_buffer_size // 2:
+                self.pending_changed.notify_all()
+
+    def _write_span(self, start_offset: int, bufs: list):
+        """Writes bufs back to back starting start_offset bytes into the torrent's data, one pwritev per file"""
+        length = sum(len(b) for b in bufs)
+        bufs = iter(bufs)
+        current = memoryview(b'')
+
+        for f, offset_in_file, _, n in self.file_spans(start_offset, length):
+            # The (pieces of) buffers going in this file
+            chunk = []
+            while n > 0:
+                if not current:
+                    current = next(bufs)
+
+                chunk.append(current[:n])
+                n -= len(chunk[-1])
+                current = current[len(chunk[-1]):]
+
+            with self.pool.open(f, writing=True) as fd:
+                pwrite_all(fd, chunk, offset_in_file)
+
+    def _pending_in_span(self, start_offset: int, length: int) -> list:
+        """(offset, blocks) of the buffered pieces overlapping a span"""
+        if length == 0:
+            return []
+
+        first = start_offset // self.torrent.piece_length
+        last = (start_offset + length - 1) // self.torrent.piece_length
+
+        with self.pending_changed:
+            return [self.pending[i] for i in range(first, last + 1) if i in self.pending]
+
+    def _flush_forever(self):
+        """Runs on the flusher thread, writing buffered pieces when there's enough of them (or enough time has passed)"""
+        while True:
+            with self.pending_changed:
+                self.pending_changed.wait_for(
+                    lambda: self.closed or self.flush_requested or self.pending_bytes >= self.write_buffer_size // 2,
+                    self.FLUSH_INTERVAL
+                )
+
+                self.flush_requested = False
+                if not self.pending:
+                    if self.closed:
+                        return
+                    continue
+
+                batch = sorted(self.pending.items(), key=lambda item: item[1][0])
+
+            try:
+                self._write_pieces([piece for _, piece in batch])
+
+            except OSError as e:
+                print(f'Error writing pieces: {e}')
+                with self.pending_changed:
+                    self.flush_error = e
+                    self.pending_changed.notify_all()
+                return
+
+            with self.pending_changed:
+                for index, _ in batch:
+                    del self.pending[index]
+                self.pending_bytes -= sum(sum(len(b) for b in blocks) for _, (_, blocks) in batch)
+                self.pending_changed.notify_all()
+
+    def _write_pieces(self, pieces: list):
+        """Writes (offset, blocks) pieces in offset order, joining runs of neighbouring pieces into one write"""
+        run_offset, run_end, run = None, None, []
+        for offset, blocks in pieces:
+            if run and offset != run_end:
+                self._write_span(run_offset, run)
+                run = []
+
+            if not run:
+                run_offset = run_end = offset
+            run.extend(blocks)
+            run_end += sum(len(b) for b in blocks)
+
+        if run:
+            self._write_span(run_offset, run)
+
+    def _check_flush_error(self):
+        if self.flush_error is not None:
+            raise self.flush_error
 
     # def write(self, p: Piece):
     #     assert p.complete()
@@ -404,22 +672,135 @@ class PieceIO:
     #     return bytes_written
 
 
+class MmapPieceIO(PieceIO):
+    """
+    Maps each file into memory.  Blocks are served as memoryviews straight out of the mapping
+    (unless they span files), and pieces are copied straight into it.
+
+    Each mapping keeps its file open whether or not the pool has closed it, so like the pool, at most
+    pool.max_open files stay mapped: the least recently used mapping not in use is flushed and unmapped
+    to make room for another.
+    """
+
+    def __init__(self, t: Torrent, pool: FilePool = None):
+        super().__init__(t, pool)
+
+        self.maps = OrderedDict()  # path -> mmap, least recently used first
+        self.map_users = {}  # path -> number of threads using its mapping, which mustn't be unmapped under them
+
+    @contextmanager
+    def map(self, f: TorrentFile):
+        """Yields the mapping of f, which stays mapped until the with block exits"""
+        with self.lock:
+            m = self.maps.get(f.path)
+            if m is None:
+                with self.pool.open(f) as fd:
+                    m = mmap.mmap(fd, f.length)
+                self.maps[f.path] = m
+            else:
+                self.maps.move_to_end(f.path)
+
+            self.map_users[f.path] = self.map_users.get(f.path, 0) + 1
+            self._unmap_unused()
+
+        try:
+            yield m
+
+        finally:
+            with self.lock:
+                self.map_users[f.path] -= 1
+                if self.map_users[f.path] == 0:
+                    del self.map_users[f.path]
+
+    def _unmap_unused(self):
+        """Unmaps least recently used files until we're within the pool's max_open (or everything left is in use)"""
+        excess = len(self.maps) - self.pool.max_open
+        if excess <= 0:
+            return
+
+        for path in [path for path in self.maps if path not in self.map_users][:excess]:
+            m = self.maps.pop(path)
+            # Written pages would otherwise miss the next sync
+            m.flush()
+            try:
+                m.close()
+            except BufferError:
+                # Blocks read out of it are still being sent: it's unmapped once they're gone
+                pass
+
+    def read(self, start_offset: int, length: int):
+        """Like PieceIO.read, but returns a memoryview into the mapping when the span is in one file"""
+        views = []
+        for f, offset_in_file, _, n in self.file_spans(start_offset, length):
+            with self.map(f) as m:
+                views.append(memoryview(m)[offset_in_file:offset_in_file + n])
+
+        if len(views) == 1:
+            return views[0]
+
+        # Spans files
+        return bytearray().join(views)
+
+    def write(self, p: Piece):
+        """Copies a complete, verified piece into the mappings"""
+        assert p.complete()
+
+        data = p.data()
+        for f, offset_in_file, start, n in self.file_spans(self.torrent.piece_offset(p.index), p.length):
+            with self.map(f) as m:
+                m[offset_in_file:offset_in_file + n] = data[start:start + n]
+
+    def sync(self):
+        """Flush written pages to disk (which also makes the next write to them update the file's mtime)"""
+        # Under the lock, so nothing's unmapped mid-flush
+        with self.lock:
+            for m in self.maps.values():
+                m.flush()
+
+        super().sync()
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            for m in self.maps.values():
+                m.close()
+
+            self.maps.clear()
+
+        super().close()
+
+
 class PieceManager:
     """
     Manages requesting blocks in pieces, caching them until the piece is complete, and saving the piece
     """
 
-    def __init__(self, t: Torrent, io: PieceIO):
+    def __init__(self, t: Torrent, io: PieceIO, executor: Executor = None, resume_file: str = None, recheck=False,
+                 cache: PieceCache = None):
         self.torrent: Torrent = t
         self.io: PieceIO = io
 
-        self.unfinished_pieces = self.make_piece_dict(t)
+        # Finished pieces peers have asked for lately, read from disk whole on their first request (None to disable).
+        # Mapped files are already read without copying, and cached views of them would stop the mappings closing.
+        self.cache = cache if not isinstance(io, MmapPieceIO) else None
+
+        # Where what's been downloaded is saved between runs, and whether to ignore it and hash everything on startup
+        self.resume_file = resume_file
+        self.recheck = recheck
+
+        # Verifies and writes completed pieces off the event loop (inline if None).
+        # With an executor, whole pieces are hashed there instead of block by block as they arrive.
+        self.executor = executor
+
+        self.unfinished_pieces = self.make_piece_dict(t, hash_incrementally=executor is None)
         self.finished_pieces = {}
         self.finished_pieces_bitfield: MutableBitfield = MutableBitfield(len(self.unfinished_pieces))
 
+        self.picker = PiecePicker(len(self.unfinished_pieces))
+
     @staticmethod
     # def make_piece_dict(self, t: Torrent) -> dict[int, Piece]:
-    def make_piece_dict(t: Torrent) -> dict:
+    def make_piece_dict(t: Torrent, hash_incrementally=True) -> dict:
         """Makes a map from piece_indices to pieces"""
         bytes_left = t.download_length
 
@@ -429,7 +810,8 @@ class PieceManager:
             p = Piece(
                 index,
                 checksum=piece,
-                length=piece_len
+                length=piece_len,
+                hash_incrementally=hash_incrementally
             )
 
             pieces[index] = p
@@ -437,14 +819,112 @@ class PieceManager:
 
         return pieces
 
-    def load_exiting_pieces(self):
-        for p in list(self.unfinished_pieces.values()):
-            # p: Piece = p
-            for r in p.all_requests():
-                # r: Request = r
-                b = self.io.get_block(r)
-                self.save_block(b)
-        print()
+    def load_exiting_pieces(self, progress=None):
+        """
+        Marks pieces whose data is already on disk as finished.
+
+        Pieces whose files haven't changed since the resume file was saved are taken from it without hashing.
+        The rest are read with one large read each and hashed on a thread pool (hashlib and file
+        reads release the GIL, so this uses every core).  Pieces in files we just created are skipped.
+        progress(pieces_checked, pieces_to_check) is called as pieces are checked.
+        """
+        if progress is None:
+            progress = print_check_progress
+
+        pieces = [p for p in self.unfinished_pieces.values()
+                  if self.io.on_disk(self.torrent.piece_offset(p.index), p.length)]
+
+        state = None
+        if self.resume_file and not self.recheck:
+            state = ResumeState.load(self.resume_file)
+
+        if state is not None and state.info_hash == self.torrent.info_hash:
+            pieces = self.resume(state, pieces)
+
+        executor = self.executor
+        if not isinstance(executor, ThreadPoolExecutor):
+            executor = ThreadPoolExecutor(os.cpu_count())
+
+        try:
+            checks = {executor.submit(self._check_existing_piece, p): p for p in pieces}
+
+            for checked, f in enumerate(as_completed(checks), 1):
+                if f.result():
+                    self.mark_finished(checks[f])
+                progress(checked, len(pieces))
+
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+        print(f'Have {len(self.finished_pieces)} of {self.num_pieces()} pieces.')
+
+    def resume(self, state: ResumeState, pieces: list) -> list:
+        """Restores what state says we had, returning the pieces in files which have changed since"""
+        changed = set(f.path for f in self.torrent.files if not state.unchanged(f.path, f.length, f.existing_mtime))
+        saved_bitfield = MutableBitfield(state.bitfield)
+
+        to_check = []
+        for p in pieces:
+            if p.index in state.partial_pieces:
+                # Restored from its saved blocks below, rather than whatever's on disk
+                continue
+
+            if any(f.path in changed for f in self.io.files_in_span(self.torrent.piece_offset(p.index), p.length)):
+                to_check.append(p)
+            elif saved_bitfield.get(p.index):
+                self.mark_finished(p)
+
+        for index, blocks in state.partial_pieces.items():
+            p = self.unfinished_pieces.get(index)
+            if p is None:
+                continue
+
+            for off, data in blocks:
+                p.save_block(Block(index, off, data))
+            self.picker.start(index)
+
+            if p.complete():
+                # It was being verified when we stopped
+                self._piece_checked(p, self._verify_and_write(p))
+
+        print(f'Resumed {len(self.finished_pieces)} pieces and {len(state.partial_pieces)} partial pieces, '
+              f'{len(to_check)} pieces changed since')
+        return to_check
+
+    def save_resume(self):
+        """Saves what we've downloaded to the resume file, if there is one"""
+        if not self.resume_file:
+            return
+
+        self.io.sync()
+
+        files = {}
+        for f in self.torrent.files:
+            # Files we haven't written to yet might not exist
+            try:
+                stat = os.stat(f.path)
+            except FileNotFoundError:
+                continue
+
+            files[f.path] = (stat.st_size, stat.st_mtime_ns)
+
+        partial_pieces = {}
+        for index in self.picker.partial_pieces():
+            blocks = self.unfinished_pieces[index].all_blocks()
+            if blocks:
+                partial_pieces[index] = [(b.begin_offset(), bytes(b.data())) for b in blocks]
+
+        ResumeState(
+            info_hash=self.torrent.info_hash,
+            bitfield=bytes(self.finished_pieces_bitfield),
+            files=files,
+            partial_pieces=partial_pieces
+        ).save(self.resume_file)
+
+    def _check_existing_piece(self, p: Piece) -> bool:
+        data = self.io.read(self.torrent.piece_offset(p.index), p.length)
+        return sha1(data).digest() == p.checksum
 
     def complete(self):
         if len(self.finished_pieces) == self.num_pieces():
@@ -453,17 +933,43 @@ class PieceManager:
         return len(self.finished_pieces) == self.num_pieces()
 
     def get_block(self, r: Request) -> Block:
-        return self.io.get_block(r)
+        if self.cache is None:
+            return self.io.get_block(r)
+
+        assert r.length() <= BLOCK_LEN
+        data = self.cache.get(r.index())
+        if data is None:
+            # Peers tend to ask for the rest of a piece next, so read all of it
+            data = self.io.read(self.torrent.piece_offset(r.index()), self.finished_pieces[r.index()].length)
+            self.cache.put(r.index(), data)
+
+        return Block(
+            piece_index=r.index(),
+            begin_offset=r.begin_offset(),
+            data=memoryview(data)[r.begin_offset():r.begin_offset() + r.length()]
+        )
 
     def has_piece(self, index: int):
         return index in self.finished_pieces
 
+    def first_wanted_piece(self, bf: Bitfield, start: int = 0) -> Optional[int]:
+        """The first piece at or after start which bf has and we don't, or None"""
+        index = (bf - self.finished_pieces_bitfield).first_set(start)
+        if index is None or index >= self.num_pieces():
+            return None
+
+        return index
+
     def mark_finished(self, p: Piece):
         assert p.index in self.unfinished_pieces
 
         del self.unfinished_pieces[p.index]
         self.finished_pieces[p.index] = p
         self.finished_pieces_bitfield.set(p.index)
+        self.picker.finish(p.index)
+
+        # It's been written, so don't hold on to the data
+        p.release()
 
     def num_pieces(self):
         return self.torrent.num_pieces
@@ -483,48 +989,114 @@ class PieceManager:
                 print(f'Moving on from {piece.index}')
                 # print(piece)
 
-    def requests2(self):
-        """ Generates requests needed to finish all pieces"""
-
-        def chunks(l, n):
-            return (l[i:i+n] for i in range(0, len(l), n))
-
-        while len(self.unfinished_pieces) > 0:
-            # For now, just finish one piece at a time
-            for pieces in chunks(list(self.unfinished_pieces.values()), 100):  # (mark_finished removes piece from unfinished_pieces)
-                # piece: Piece = piece
+    def next_request(self, has_piece=None) -> Request:
+        """
+        Returns a request for a block nobody has been asked for yet, or None if every missing block has been requested.
+        Partially downloaded pieces are finished first, then the rarest pieces are started.
 
-                rs = [p.next_request() for p in pieces]
-                while any(rs):
-                    for r in rs:
-                        if r:
-                            yield r
-                    rs = [p.next_request() for p in pieces]
-                print('Getting more pieces!')
-                # print(f'moving on from {piece.index}')
-                # print(piece)
+        has_piece(index) limits the choice to pieces a particular peer has.
+        """
+        for index in self.picker.partial_pieces():
+            if has_piece is None or has_piece(index):
+                r = self.unfinished_pieces[index].pop_request()
+                if r is not None:
+                    return r
+
+        index = self.picker.pick(has_piece)
+        while index is not None:
+            r = self.unfinished_pieces[index].pop_request()
+            if r is not None:
+                return r
+
+            # Empty piece
+            index = self.picker.pick(has_piece)
+
+        return None
+
+    def all_requested(self) -> bool:
+        """True once every missing block has been requested, i.e. it's time for endgame"""
+        return self.picker.num_unstarted() == 0 and all(p.all_requested() for p in self.unfinished_pieces.values())
+
+    def missing_requests(self, has_piece=None):
+        """Requests for the blocks still missing from started pieces (which has_piece(index) is true for)"""
+        for index in self.picker.partial_pieces():
+            if has_piece is None or has_piece(index):
+                piece = self.unfinished_pieces.get(index)
+                if piece is not None:
+                    yield from piece.missing_requests()
+
+    def release_request(self, r: Request):
+        """Consider request r lost, so next_request asks for it again"""
+        piece = self.unfinished_pieces.get(r.index())
+        if piece is not None:
+            piece.release_request(r)
 
     def save_block(self, b: Block):
+        """
+        Returns None, or if b completed its piece, a future which resolves to True once the piece
+        has been verified and written (or False if it failed verification and was reset).
+        """
         idx = b.index()
 
         if self.valid_piece_index(idx) and not self.has_piece(idx):
             piece: Piece = self.unfinished_pieces[idx]
+            already_complete = piece.complete()
             piece.save_block(b)
 
-            if piece.complete():
-                if piece.verify():
-                    self.mark_finished(piece)
-                    self.io.write(piece)
-                    print(f'Piece {idx} finished!')
-                    print(f'Have {len(self.finished_pieces)} of {self.num_pieces()} pieces.')
-                else:
-                    print(f'Piece {piece.index} failed verification!  Resetting...')
-                    piece.reset()
+            if piece.complete() and not already_complete:
+                return self.check_piece(piece)
 
         else:
             # print('Block does not correspond to a valid piece.')
             # print(b)
             pass
 
+        return None
+
+    def check_piece(self, piece: Piece):
+        """Verifies and writes a complete piece on the executor, or right away without one"""
+        if self.executor is None:
+            f = Future()
+            f.set_result(self._piece_checked(piece, self._verify_and_write(piece)))
+            return f
+
+        return asyncio.ensure_future(self._check_piece_on_executor(piece))
+
+    def _verify_and_write(self, piece: Piece) -> bool:
+        if not piece.verify():
+            return False
+
+        self.io.write(piece)
+        return True
+
+    @coroutine
+    def _check_piece_on_executor(self, piece: Piece):
+        loop = asyncio.get_event_loop()
+
+        if isinstance(self.executor, ProcessPoolExecutor):
+            # Processes can't share our file handles, so they only hash
+            blocks = [piece.buffer]
+            digest = yield from loop.run_in_executor(self.executor, piece_digest, blocks)
+            verified = digest == piece.checksum
+            if verified:
+                yield from loop.run_in_executor(None, self.io.write, piece)
+
+        else:
+            verified = yield from loop.run_in_executor(self.executor, self._verify_and_write, piece)
+
+        # Back on the event loop
+        return self._piece_checked(piece, verified)
+
+    def _piece_checked(self, piece: Piece, verified: bool) -> bool:
+        if verified:
+            self.mark_finished(piece)
+            print(f'Piece {piece.index} finished!')
+            print(f'Have {len(self.finished_pieces)} of {self.num_pieces()} pieces.')
+        else:
+            print(f'Piece {piece.index} failed verification!  Resetting...')
+            piece.reset()
+
+        return verified
+
     def valid_piece_index(self, index: int) -> bool:
         return 0 <= index < self.torrent.num_pieces
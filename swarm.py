@@ -1,17 +1,25 @@
 import asyncio
+import heapq
+import itertools
 import random
 import time
 
 from abc import ABC, abstractmethod
-from asyncio import coroutine, open_connection, Semaphore, sleep, StreamReader, StreamWriter, IncompleteReadError
+from asyncio import coroutine, sleep, Event, IncompleteReadError
+from collections import OrderedDict
+from math import ceil, exp
 from typing import Union
 
 from bitfield import MutableBitfield
+from choker import Choker
+from connections import ConnectionManager
 from packet import BittorrentPacket, HandshakePacket, KeepalivePacket, ChokePacket, UnchokePacket, InterestedPacket, \
     UninterestedPacket, HavePacket, BitfieldPacket, BlockPacket, RequestPacket, CancelPacket, read_handshake_response, \
-    read_next_packet, send_packet, PeerError, PeerDisconnected, MalformedPacketException
-from storage import Block, PieceManager, Request
-from tracker import Peer, PeerFinder
+    read_next_packet, send_packet, send_serialized, PeerError, PeerDisconnected, MalformedPacketException, PeerConnection, \
+    open_peer_connection, start_peer_server
+from ratelimit import GLOBAL_LIMITS, RateLimits, throttle
+from storage import BLOCK_LEN, Block, PieceManager, Request
+from tracker import PeerFinder, TrackerConnectionException
 from torrent import Torrent
 
 
@@ -32,21 +40,73 @@ class NoPeersException(Exception):
     pass
 
 
+class RateMeter:
+    """Exponentially weighted moving average of bytes per second"""
+
+    def __init__(self, time_constant: float = 5):
+        self.time_constant = time_constant
+        self.__rate = 0
+        self.__last_update = time.monotonic()
+
+    def _decay(self, now: float):
+        self.__rate *= exp(-(now - self.__last_update) / self.time_constant)
+        self.__last_update = now
+
+    def update(self, num_bytes: int):
+        self._decay(time.monotonic())
+        self.__rate += num_bytes / self.time_constant
+
+    def rate(self) -> float:
+        self._decay(time.monotonic())
+        return self.__rate
+
+
 class SwarmPeer:
-    def __init__(self, swarm: "Swarm", reader: StreamReader, writer: StreamWriter, choking=True, interested=False):
+    MIN_PIPELINE_DEPTH = 4
+    MAX_PIPELINE_DEPTH = 500
+    PIPELINE_QUEUE_TIME = 1  # Seconds of requests to keep queued at the peer, on top of the round trip
+    DELAY_WINDOW = 10  # Seconds the lowest request round trip is remembered for
+    PENALTY_TIMEOUTS = 3  # Requests timing out in a row, with nothing coming back meanwhile, before a penalty
+    PENALTY_TIME = 10  # Seconds a penalized peer only gets one request at a time
+
+    def __init__(self, swarm: "Swarm", conn: PeerConnection, choking=True, interested=False, address: tuple = None):
         self.swarm = swarm
+        self.address = address  # (host, port) we dialed, or None if the peer connected to us
         self.__pid = b'UNNAMED_PEER01234569'  # set when connection is made (self.connect())
         self.__am_choking = choking
         self.__am_interested = interested
         self.__peer_choking = True
         self.__peer_interested = False
-        self.__reader = reader
-        self.__writer = writer
+        self.__conn = conn
 
         self.__last_seen = time.time()
 
         num_pieces = swarm.torrent.num_pieces
-        self.__bitfield = MutableBitfield(bytearray(num_pieces))
+        self.__bitfield = MutableBitfield(num_pieces)
+
+        # Request pipeline
+        self.outstanding = OrderedDict()  # Request -> time it was sent
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+
+        # Bandwidth limits: this peer's own, then the torrent's, then everything's
+        self.limits = RateLimits(swarm.peer_upload_limit, swarm.peer_download_limit)
+        self.__upload_buckets = [self.limits.upload, swarm.limits.upload, swarm.global_limits.upload]
+        self.__download_buckets = [self.limits.download, swarm.limits.download, swarm.global_limits.download]
+        self.__delay = None  # Lowest recent request round trip
+        self.__delay_measured = 0
+        self.__request_slot = Event()
+
+        # Requests which went unanswered
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+        self.last_block_time = None  # When the last block we asked for arrived
+        self.last_answered_sent = 0  # When the latest request to be answered was sent
+        self.__penalized_until = 0
+
+        # HAVEs waiting to go out together
+        self.__pending_haves = []
+        self.__have_flush = None
 
         # Stops eternal coroutines
         self.running = True
@@ -55,14 +115,14 @@ class SwarmPeer:
         return self.__pid
 
     def __del__(self):
-        self.__writer.close()
+        self.__conn.close()
 
     @coroutine
     def connect(self):
         pkt = HandshakePacket(self.swarm.torrent.info_hash, self.swarm.my_pid)
         yield from self.send_packet(pkt)
         # resp: HandshakePacket = yield from read_handshake_response(self.reader)
-        resp = yield from read_handshake_response(self.__reader)
+        resp = yield from read_handshake_response(self.__conn)
 
         self.__pid = resp.peer_id()
 
@@ -75,7 +135,7 @@ class SwarmPeer:
     def accept_connection(self):
         # incoming_handshake: HandshakePacket = yield from read_handshake_response(self.reader)
 
-        incoming_handshake = yield from read_handshake_response(self.__reader)
+        incoming_handshake = yield from read_handshake_response(self.__conn)
 
         self.__pid = incoming_handshake.peer_id()
 
@@ -150,16 +210,108 @@ class SwarmPeer:
     def has_piece(self, index: int) -> bool:
         return self.__bitfield.get(index)
 
+    def bitfield(self) -> MutableBitfield:
+        return self.__bitfield
+
+    def pipeline_depth(self) -> int:
+        """How many requests to keep outstanding: enough to cover the bandwidth-delay product, plus a little queue"""
+        if self.penalized():
+            return 1
+
+        if self.__delay is None:
+            return self.MIN_PIPELINE_DEPTH
+
+        depth = ceil(self.download_rate.rate() * (self.__delay + self.PIPELINE_QUEUE_TIME) / BLOCK_LEN)
+        return max(self.MIN_PIPELINE_DEPTH, min(depth, self.MAX_PIPELINE_DEPTH))
+
+    def can_request(self) -> bool:
+        return not self.__peer_choking and len(self.outstanding) < self.pipeline_depth()
+
+    def free_request_slots(self) -> int:
+        """How many more requests its pipeline has room for"""
+        if self.__peer_choking:
+            return 0
+        return max(0, self.pipeline_depth() - len(self.outstanding))
+
+    @coroutine
+    def wait_for_request_slot(self):
+        """Waits until the peer is unchoking us and there's room in its pipeline"""
+        while not self.can_request():
+            self.__request_slot.clear()
+            yield from self.__request_slot.wait()
+
+    def block_received(self, b: Block, r: Request):
+        """Returns the outstanding request r, which b answers (or None), and measures the peer's bandwidth and delay"""
+        self.download_rate.update(len(b.data()))
+
+        sent = self.outstanding.pop(r, None)
+        if sent is None:
+            return None
+
+        now = time.monotonic()
+        delay = now - sent
+        if self.__delay is None or delay < self.__delay or now - self.__delay_measured > self.DELAY_WINDOW:
+            self.__delay = delay
+            self.__delay_measured = now
+
+        self.last_block_time = now
+        self.last_answered_sent = max(self.last_answered_sent, sent)
+        self.consecutive_timeouts = 0
+
+        self.__request_slot.set()
+        return r
+
+    def request_timed_out(self, r: Request, stalled: bool, now: float = None):
+        """
+        Forgets outstanding request r, penalizing the peer if it keeps letting requests time out while stalled
+        (not answering any).  Peers which are still answering others just dropped r.
+        """
+        now = time.monotonic() if now is None else now
+        self.outstanding.pop(r, None)
+        self.timeouts += 1
+        if stalled:
+            self.consecutive_timeouts += 1
+
+        if self.consecutive_timeouts >= self.PENALTY_TIMEOUTS and not self.penalized(now):
+            print(f'{self.consecutive_timeouts} requests to {self.peer_id()} timed out in a row, '
+                  f'only sending it one at a time for {self.PENALTY_TIME}s')
+            self.__penalized_until = now + self.PENALTY_TIME
+
+        self.__request_slot.set()
+
+    def penalized(self, now: float = None) -> bool:
+        return (time.monotonic() if now is None else now) < self.__penalized_until
+
+    def release_requests(self) -> list:
+        """Forget all outstanding requests, returning them"""
+        released = list(self.outstanding)
+        self.outstanding.clear()
+        self.__request_slot.set()
+
+        return released
+
     @coroutine
     def request_piece(self, r: Request):
         pkt = RequestPacket(r)
 
+        self.outstanding[r] = time.monotonic()
         yield from self.send_packet(pkt)
 
+    @coroutine
+    def request_blocks(self, rs: list, now: float = None):
+        """Sends every request in rs at once (noting they were sent now)"""
+        now = time.monotonic() if now is None else now
+        for r in rs:
+            self.outstanding[r] = now
+
+        yield from send_serialized(self.__conn, RequestPacket.serialize_many(rs))
+
     @coroutine
     def send_block(self, b: Block):
         pkt = BlockPacket(b)
 
+        yield from throttle(self.__upload_buckets, len(b.data()))
+        self.upload_rate.update(len(b.data()))
         yield from self.send_packet(pkt)
 
     @coroutine
@@ -168,20 +320,65 @@ class SwarmPeer:
 
         yield from self.send_packet(pkt)
 
+    def queue_have(self, piece_index: int) -> bool:
+        """
+        Sends a HAVE for piece_index along with any others within HAVE_BATCH_INTERVAL,
+        unless the peer already has the piece (returning False).
+        """
+        if self.has_piece(piece_index):
+            return False
+
+        self.__pending_haves.append(piece_index)
+        if self.__have_flush is None:
+            self.__have_flush = asyncio.get_event_loop().call_later(self.swarm.HAVE_BATCH_INTERVAL,
+                                                                    self.__flush_haves)
+        return True
+
+    def __flush_haves(self):
+        self.__have_flush = None
+        piece_indices = self.__pending_haves
+        self.__pending_haves = []
+
+        asyncio.ensure_future(self.send_haves(piece_indices))
+
+    @coroutine
+    def send_haves(self, piece_indices: list):
+        try:
+            yield from self.send_serialized(HavePacket.serialize_many(piece_indices))
+        except PeerDisconnected:
+            # Noticed by whoever is reading from the peer
+            pass
+
     @coroutine
     def send_cancel(self, r: Request):
         pkt = CancelPacket(r)
 
         yield from self.send_packet(pkt)
 
+    @coroutine
+    def cancel_request(self, r: Request):
+        """Takes back outstanding request r (another peer answered it), freeing up its slot in the pipeline"""
+        if self.outstanding.pop(r, None) is not None:
+            self.__request_slot.set()
+
+        try:
+            yield from self.send_cancel(r)
+        except PeerDisconnected:
+            # Noticed by whoever is reading from the peer
+            pass
+
     @coroutine
     def send_packet(self, pkt: Union[BittorrentPacket, HandshakePacket]):
-        yield from send_packet(self.__writer, pkt)
+        yield from send_packet(self.__conn, pkt)
+
+    @coroutine
+    def send_serialized(self, data):
+        yield from send_serialized(self.__conn, data)
 
     @coroutine
     def read_next_packet(self):
         """Returns (self, next_pkt_for_this_peer)"""
-        pkt = yield from read_next_packet(self.__reader)
+        pkt = yield from read_next_packet(self.__conn)
 
         self.__last_seen = time.time()
 
@@ -194,22 +391,29 @@ class SwarmPeer:
 
         elif isinstance(pkt, UnchokePacket):
             self.__peer_choking = False
+            self.__request_slot.set()
 
         elif isinstance(pkt, InterestedPacket):
             self.__peer_interested = True
-            yield from self.unchoke_and_notify()
 
         elif isinstance(pkt, UninterestedPacket):
             self.__peer_interested = False
-            yield from self.choke_and_notify()
 
         elif isinstance(pkt, HavePacket):
-            self.__bitfield.set(pkt.piece_index())
+            if pkt.piece_index() < self.swarm.torrent.num_pieces and not self.__bitfield.get(pkt.piece_index()):
+                self.__bitfield.set(pkt.piece_index())
+                self.swarm.piece_manager.picker.peer_has(pkt.piece_index())
+
+        elif isinstance(pkt, BlockPacket):
+            # Holding blocks back stops us reading from the connection, once enough pile up
+            yield from throttle(self.__download_buckets, len(pkt.block().data()))
 
         elif isinstance(pkt, BitfieldPacket):
             # Bitfields allocate to the nearest byte
             assert 0 <= len(pkt.bitfield()) - self.swarm.torrent.num_pieces < 8
+            self.swarm.piece_manager.picker.remove_bitfield(self.__bitfield)
             self.__bitfield = MutableBitfield(pkt.bitfield())
+            self.swarm.piece_manager.picker.add_bitfield(self.__bitfield)
 
         # hand off to swarm's read_next_packet
         return self, pkt
@@ -217,16 +421,26 @@ class SwarmPeer:
 
 class Swarm:
     MAX_ACTIVE_PEERS = 30
-    MAX_OUTSTANDING_REQUESTS = 500
-
-    def __init__(self, torrent: Torrent, manager: PieceManager, finder: PeerFinder, port, piece_request_timeout=1):
+    TARGET_PEERS = 20  # Peers we dial out to, leaving room for peers which connect to us
+    MAX_DIALS = 8  # Connection attempts at once
+    DIAL_TIMEOUT = 10
+    DIAL_INTERVAL = 1  # Seconds between looking for peers to dial, if nothing happens sooner
+    FIND_PEERS_INTERVAL = 60  # Least time between asking the peer finder for more peers
+    RESUME_SAVE_INTERVAL = 60
+    ENDGAME_MAX_PEERS = 3  # In endgame, how many peers each missing block is requested from at once
+    HAVE_BATCH_INTERVAL = 0.1  # Seconds HAVEs are held back so several can be sent together
+    CHOKE_INTERVAL = 10  # Seconds between choker rounds
+
+    def __init__(self, torrent: Torrent, manager: PieceManager, finder: PeerFinder, port, piece_request_timeout=1,
+                 choker: Choker = None, limits: RateLimits = None, global_limits: RateLimits = GLOBAL_LIMITS,
+                 connections: ConnectionManager = None):
         self.running = False
         self.my_pid = generate_peer_id()
         self.__peer_port = port
 
         self.finder = finder
-        self.outstanding_requests = Semaphore(self.MAX_OUTSTANDING_REQUESTS)
         self.outstanding_requests_d = dict()
+        self.download_complete = Event()
         # self.peers: list[SwarmPeer] = finder.get_peers()
         self.peers: list = []
         # self.peers_not_choking_me: set[SwarmPeer] = set()
@@ -236,60 +450,126 @@ class Swarm:
 
         self.request_timeout = piece_request_timeout
 
+        # HAVEs sent, and how many didn't need sending (as the peer had the piece)
+        self.haves_sent = 0
+        self.haves_suppressed = 0
+
+        # Endgame: once every missing block has been requested, they're requested from other peers too
+        self.endgame_started = None
+        self.endgame_ended = None
+        self.endgame_requests = 0  # Duplicate requests sent
+        self.endgame_cancels = 0
+
+        # (deadline, sequence number, Request, SwarmPeer, time sent) for every request sent, soonest first
+        self.request_deadlines = []
+        self.__request_seq = itertools.count()
+        self.request_timeouts = 0
+        self.requests_reissued = 0
+
+        # Who we upload to
+        self.choker = choker if choker is not None else Choker()
+
+        # Bandwidth limits (bytes per second, None for unlimited) for this torrent, each of its peers, and everything
+        self.limits = limits if limits is not None else RateLimits()
+        self.global_limits = global_limits
+        self.peer_upload_limit = None
+        self.peer_download_limit = None
+
+        # Who we're connected to, and who to connect to next
+        self.connections = connections if connections is not None else \
+            ConnectionManager(self.TARGET_PEERS, self.MAX_ACTIVE_PEERS, self.MAX_DIALS)
+        self.__connections_changed = Event()
+        self.__last_find = None
+
         self.__torrent = torrent
 
     @property
     def torrent(self):
         return self.__torrent
 
-    def disconnect(self, p: Peer):
-        self.peers_not_choking_me.remove(p)
-        self.peers.remove(p)
+    def add_peer(self, p: SwarmPeer):
+        self.peers.append(p)
+
+        if not self.piece_manager.complete():
+            asyncio.ensure_future(self.request_from_peer(p))
+
+    def set_peer_limits(self, upload: int = None, download: int = None):
+        """Limits every peer's upload and download rate (None for unlimited), including peers which connect later"""
+        self.peer_upload_limit = upload
+        self.peer_download_limit = download
+        for p in self.peers:
+            p.limits.set(upload, download)
+
+    def disconnect(self, p: SwarmPeer):
+        self.peers_not_choking_me.discard(p)
+        if p in self.peers:
+            self.peers.remove(p)
+            # Its pieces aren't available anymore
+            self.piece_manager.picker.remove_bitfield(p.bitfield())
+            self.release_requests(p)
+
+            # Someone else can take its place
+            if p.address is not None:
+                self.connections.disconnected(p.address, time.monotonic())
+            self.__connections_changed.set()
 
     @coroutine
     def find_peers(self):
-        @coroutine
-        def safe_connect(p: Peer):
-            tries = 1
-            while tries > 0:
-                try:
-                    yield from asyncio.wait_for(self.connect_to_peer(p.host, p.port), 10)
-                    print(f'Connected to peer {p.host}:{p.port}')
-                    print(f'I now have {len(self.peers)} peers.')
-                    print(f'{len(self.peers_not_choking_me)} peers have unchoked me.')
-
-                except (
-                        PeerError, PeerDisconnected, IncompleteReadError, ConnectionRefusedError,
-                        asyncio.TimeoutError) as e:
-                    print(type(e))
-                    print(f'Could not connect to peer {p.host}:{p.port}')
-
-                tries -= 1
-                print("Trying again in 3 seconds...")
-                yield from asyncio.sleep(3)
-
-        connect_tasks = [safe_connect(p) for p in self.finder.get_peers()]
-        yield from asyncio.gather(*connect_tasks)
-
-        # for p in self.finder.get_peers():
-        #     try:
-        #         yield from self.connect_to_peer(p.host, p.port)
-        #         print(f'Connected to peer {p.host}:{p.port}')
-        #         print(f'I now have {len(self.peers)} peers.')
-        #         print(f'{len(self.peers_not_choking_me)} peers have unchoked me.')
-        #
-        #     except (PeerError, PeerDisconnected, IncompleteReadError, ConnectionRefusedError, asyncio.TimeoutError) as e:
-        #         print(type(e))
-        #         print(f'Could not connect to peer {p.host}:{p.port}')
+        """Adds the peers the finder knows about to the backlog (on a thread, as trackers block)"""
+        self.__last_find = time.monotonic()
+        try:
+            peers = yield from asyncio.get_event_loop().run_in_executor(None, self.finder.get_peers)
+        except TrackerConnectionException as e:
+            print(e)
+            return
+
+        self.connections.add_candidates((p.host, p.port) for p in peers)
+
+    @coroutine
+    def manage_connections_forever(self):
+        """Dials peers from the backlog until we have enough, replacing peers which disconnect"""
+        while self.running:
+            now = time.monotonic()
+            if len(self.peers) < self.connections.target_peers and not self.connections.num_dialable(now) and \
+                    (self.__last_find is None or now - self.__last_find > self.FIND_PEERS_INTERVAL):
+                yield from self.find_peers()
+
+            for address in self.connections.to_dial(len(self.peers), time.monotonic()):
+                asyncio.ensure_future(self.dial(address))
+
+            self.__connections_changed.clear()
+            try:
+                yield from asyncio.wait_for(self.__connections_changed.wait(), self.DIAL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @coroutine
+    def dial(self, address: tuple):
+        host, port = address
+        try:
+            p = yield from asyncio.wait_for(self.connect_to_peer(host, port), self.DIAL_TIMEOUT)
+            self.connections.connected(address, time.monotonic())
+            print(f'Connected to peer {host}:{port}')
+            print(f'I now have {len(self.peers)} peers.')
+            asyncio.ensure_future(self.handle_peer_msgs(p))
+
+        except (PeerError, PeerDisconnected, IncompleteReadError, OSError, MalformedPacketException,
+                InfoHashDoesntMatchException, asyncio.TimeoutError) as e:
+            print(type(e))
+            print(f'Could not connect to peer {host}:{port}')
+            self.connections.failed(address, time.monotonic())
+
+        self.__connections_changed.set()
 
     @coroutine
     def connect_to_peer(self, host, port):
-        reader, writer = yield from asyncio.wait_for(open_connection(host, port), self.request_timeout)
+        conn = yield from asyncio.wait_for(open_peer_connection(host, port), self.request_timeout)
 
-        p = SwarmPeer(self, reader, writer)
+        p = SwarmPeer(self, conn, address=(host, port))
         yield from p.connect()
         yield from p.take_interest_and_notify()
-        self.peers.append(p)
+        self.add_peer(p)
+        return p
 
     def peers_with_piece(self, piece_index: int):
         return [p for p in self.peers_not_choking_me if p.has_piece(piece_index)]
@@ -301,43 +581,160 @@ class Swarm:
             return random.choice(peers_with_piece)
         return None
 
-    def reset_outstanding_requests(self):
-        self.outstanding_requests = Semaphore(self.MAX_OUTSTANDING_REQUESTS)
+    def release_requests(self, p: SwarmPeer):
+        """Let other peers be asked for the blocks p was asked for"""
+        for r in p.release_requests():
+            self.piece_manager.release_request(r)
+            self._forget_request(r, p)
+
+    def _remember_request(self, r: Request, p: SwarmPeer):
+        self.outstanding_requests_d.setdefault(r, []).append(p)
+
+    def _forget_request(self, r: Request, p: SwarmPeer):
+        ps = self.outstanding_requests_d.get(r)
+        if ps and p in ps:
+            ps.remove(p)
+            if not ps:
+                del self.outstanding_requests_d[r]
+
+    def endgame(self) -> bool:
+        return self.endgame_started is not None and self.endgame_ended is None
+
+    def endgame_duration(self):
+        """Seconds spent in endgame so far (or in total once the download's complete), or None if it never started"""
+        if self.endgame_started is None:
+            return None
+
+        return (self.endgame_ended or time.monotonic()) - self.endgame_started
+
+    def endgame_requests_for(self, p: SwarmPeer, n: int, exclude=()) -> list:
+        """
+        Up to n requests (not in exclude) for missing blocks of pieces p has, which have already been sent to
+        other peers (but fewer than ENDGAME_MAX_PEERS), least duplicated first.
+        """
+        candidates = []
+        for r in self.piece_manager.missing_requests(p.has_piece):
+            asked = self.outstanding_requests_d.get(r, ())
+            if r not in exclude and p not in asked and len(asked) < self.ENDGAME_MAX_PEERS:
+                candidates.append((len(asked), r))
+
+        candidates.sort(key=lambda c: c[0])
+        return [r for _, r in candidates[:n]]
 
     @coroutine
-    def request_pieces(self):
-        for request in self.piece_manager.requests2():
-            # request: Request = request
-
-            peer_to_ask: SwarmPeer = self.random_peer_with_piece(request.index())
-            while peer_to_ask is None:
-                print('Waiting for peers')
-                yield from asyncio.sleep(1)
-                peer_to_ask: SwarmPeer = self.random_peer_with_piece(request.index())
-
+    def request_from_peer(self, p: SwarmPeer):
+        """Keeps p's request pipeline full while it unchokes us, independently of other peers"""
+        while self.running and p in self.peers and not self.piece_manager.complete():
             try:
-                yield from peer_to_ask.request_piece(request)
+                yield from asyncio.wait_for(p.wait_for_request_slot(), timeout=self.request_timeout)
+
+            except asyncio.TimeoutError:
+                # Requests which don't come back are expired by expire_requests_forever
+                continue
+
+            if self.piece_manager.first_wanted_piece(p.bitfield()) is None:
+                # p doesn't have any piece we're missing
+                yield from asyncio.sleep(self.request_timeout)
+                continue
+
+            # Fill the pipeline in one go
+            free = p.free_request_slots()
+            requests = []
+            while len(requests) < free:
+                request = self.piece_manager.next_request(p.has_piece)
+                if request is None:
+                    break
+                requests.append(request)
+
+            if len(requests) < free and self.piece_manager.all_requested():
+                if self.endgame_started is None:
+                    print('Every missing block has been requested, starting endgame')
+                    self.endgame_started = time.monotonic()
+
+                duplicates = self.endgame_requests_for(p, free - len(requests), exclude=set(requests))
+                self.endgame_requests += len(duplicates)
+                requests += duplicates
+
+            if not requests:
+                # p doesn't have anything we still need to ask for
+                yield from asyncio.sleep(self.request_timeout)
+                continue
+
+            yield from self.send_requests(p, requests)
 
-                # End Game Mode
-                o = self.outstanding_requests_d.get(request) or []
-                o.append(peer_to_ask)
-                self.outstanding_requests_d[request] = o
+    @coroutine
+    def send_requests(self, p: SwarmPeer, requests: list):
+        """Sends requests to p, remembering who was asked for what and when they expire"""
+        sent = time.monotonic()
+        for r in requests:
+            # To cancel the others when one answers
+            self._remember_request(r, p)
+            heapq.heappush(self.request_deadlines, (sent + self.request_timeout, next(self.__request_seq), r, p, sent))
 
-                try:
-                    # print('waiting to send more requests')
-                    yield from asyncio.wait_for(self.outstanding_requests.acquire(), timeout=self.request_timeout)
-                    # print('done waiting')
+        try:
+            yield from p.request_blocks(requests, sent)
 
-                except asyncio.TimeoutError:
-                    # Consider all outstanding requests timed out
-                    print('Hit request limit!')
-                    self.reset_outstanding_requests()
+        except (PeerDisconnected, PeerError):
+            self.disconnect(p)
 
-            except (PeerDisconnected, PeerError):
-                self.disconnect(peer_to_ask)
+    @coroutine
+    def expire_requests_forever(self):
+        while self.running:
+            yield from asyncio.sleep(self.request_timeout / 4)
+            self.expire_requests(time.monotonic())
+
+    def expire_requests(self, now: float):
+        """
+        Re-issues requests which a peer has been sitting on for request_timeout, to another peer if there's one
+        with room in its pipeline.  Peers work through requests in order, so the clock restarts whenever a peer
+        answers one of its requests, unless it's answered one sent after this one (so this one was dropped).
+        """
+        deadlines = self.request_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, _, r, p, sent = heapq.heappop(deadlines)
+            if p.outstanding.get(r) != sent or p not in self.peers:
+                # Answered, cancelled, released or disconnected since, or this is an old entry for a request sent
+                # to p again
+                continue
+
+            progressing = p.last_block_time is not None and p.last_block_time + self.request_timeout > now
+            if progressing and p.last_answered_sent <= sent:
+                heapq.heappush(deadlines,
+                               (p.last_block_time + self.request_timeout, next(self.__request_seq), r, p, sent))
+                continue
+
+            # Having answered requests sent after (or along with) r, p only dropped r
+            stalled = not progressing and p.last_answered_sent < sent
+            p.request_timed_out(r, stalled, now)
+            self._forget_request(r, p)
+            self.request_timeouts += 1
+
+            if r in self.outstanding_requests_d:
+                # Someone else was asked for it too (endgame)
+                continue
+
+            others = [q for q in self.peers_not_choking_me
+                      if q is not p and q.has_piece(r.index()) and q.free_request_slots() > 0]
+            if others:
+                self.requests_reissued += 1
+                asyncio.ensure_future(self.send_requests(max(others, key=SwarmPeer.free_request_slots), [r]))
+            else:
+                # Whoever asks for a request next gets it
+                self.piece_manager.release_request(r)
+
+    @coroutine
+    def request_pieces(self):
+        """Waits for the peers' request pipelines to finish the download"""
+        if not self.piece_manager.complete():
+            yield from self.download_complete.wait()
 
         assert self.piece_manager.complete()
         print('Download complete!')
+        print(f'Sent {self.haves_sent} HAVEs, skipped {self.haves_suppressed} ({self.have_bytes_saved()} bytes)')
+        print(f'{self.request_timeouts} requests timed out, {self.requests_reissued} re-issued to other peers')
+        if self.endgame_started is not None:
+            print(f'Endgame took {self.endgame_duration():.2f}s: {self.endgame_requests} duplicate requests, '
+                  f'{self.endgame_cancels} cancelled')
         for p in self.peers_not_choking_me:
             # p: SwarmPeer = p
             yield from p.remove_interest_and_notify()
@@ -352,14 +749,9 @@ class Swarm:
                 yield from self._handle_packet(peer, pkt)
             except PeerDisconnected as e:
                 print(e)
+                self.disconnect(p)
                 break
 
-    @coroutine
-    def handle_incoming(self):
-
-        peer_handler_tasks = [self.handle_peer_msgs(p) for p in self.peers]
-        yield from asyncio.gather(*peer_handler_tasks)
-
     @coroutine
     def _handle_packet(self, src_peer: SwarmPeer, pkt: BittorrentPacket):
         # peer: SwarmPeer = peer
@@ -369,15 +761,21 @@ class Swarm:
         # Handled by peer's read_next_packet
         elif isinstance(pkt, ChokePacket):
             self.peers_not_choking_me.discard(src_peer)
+            # Choked peers discard our requests
+            self.release_requests(src_peer)
 
         elif isinstance(pkt, UnchokePacket):
             self.peers_not_choking_me.add(src_peer)
 
-        # elif isinstance(pkt, InterestedPacket):
-        #     self.interested = True
+        elif isinstance(pkt, InterestedPacket):
+            # Don't keep a newcomer waiting for the next round if there's a free slot
+            if src_peer.am_choking() and self.num_unchoked() < self.choker.max_unchoked():
+                yield from src_peer.unchoke_and_notify()
 
-        # elif isinstance(pkt, UninterestedPacket):
-        #     self.interested = False
+        elif isinstance(pkt, UninterestedPacket):
+            # Frees its slot for the next round
+            if not src_peer.am_choking():
+                yield from src_peer.choke_and_notify()
 
         # elif isinstance(pkt, HavePacket):
         # pass
@@ -399,63 +797,130 @@ class Swarm:
                 yield from src_peer.choke_and_notify()
 
         elif isinstance(pkt, BlockPacket):
-            self.outstanding_requests.release()
-            self.piece_manager.save_block(pkt.block())
-            if self.piece_manager.has_piece(pkt.block().index()):
-                for peer in self.peers:
-                    asyncio.ensure_future(peer.send_have(pkt.block().index()))
-
-            # End Game Mode
             b = pkt.block()
-            r = Request(b.index(), b.begin_offset(), len(b.data()))
-            ps = self.outstanding_requests_d.get(r)
+            r = b.request()
+
+            src_peer.block_received(b, r)
+            checked = self.piece_manager.save_block(b)
+            if checked is not None:
+                asyncio.ensure_future(self.announce_piece(b.index(), checked))
+
+            # Endgame: the other peers asked for r needn't send it
+            ps = self.outstanding_requests_d.pop(r, None)
             if ps:
                 for p in ps:
-                    # p: SwarmPeer = p
                     if p != src_peer:
-                        asyncio.ensure_future(p.send_cancel(r))
-            self.outstanding_requests_d.pop(r, None)
+                        self.endgame_cancels += 1
+                        asyncio.ensure_future(p.cancel_request(r))
+
+    @coroutine
+    def announce_piece(self, index: int, checked):
+        """Tells every peer we have piece index, once it's been verified and written"""
+        verified = yield from asyncio.wrap_future(checked)
 
-    # @coroutine
-    # def send_haves(self, p: Block):
-    #     yield from asyncio.gather(
-    #         (peer.send_have(p) for peer in self.peers)
-    #     )
+        if verified:
+            for peer in self.peers:
+                if peer.queue_have(index):
+                    self.haves_sent += 1
+                else:
+                    self.haves_suppressed += 1
+
+            if self.piece_manager.complete():
+                if self.endgame_started is not None and self.endgame_ended is None:
+                    self.endgame_ended = time.monotonic()
+                self.download_complete.set()
+
+    def have_bytes_saved(self) -> int:
+        return self.haves_suppressed * HavePacket.size()
 
     @coroutine
     def send_keepalives_forever(self):
         """Send keepalives to all peers once every 100 seconds"""
-        pkt = KeepalivePacket()
         while self.running:
             yield from asyncio.sleep(100)
-            for peer in self.peers:
-                yield from peer.send_packet(pkt)
+            yield from self.send_keepalives()
 
     @coroutine
-    def accept_peer_connection(self, reader: StreamReader, writer: StreamWriter):
+    def send_keepalives(self):
+        pkt = KeepalivePacket()
+        for p in list(self.peers):
+            try:
+                yield from p.send_packet(pkt)
+            except PeerDisconnected as e:
+                print(e)
+                self.disconnect(p)
+
+    def num_unchoked(self) -> int:
+        return sum(1 for p in self.peers if not p.am_choking())
+
+    def peer_value(self, p: SwarmPeer) -> float:
+        """What p gives us: its download rate to us, or once we're seeding, how fast it takes what we upload"""
+        if self.piece_manager.complete():
+            return p.upload_rate.rate()
+        return p.download_rate.rate()
+
+    @coroutine
+    def rechoke(self):
+        """Unchokes the peers the choker picks, and chokes everyone else"""
+        unchoked = self.choker.choose(list(self.peers), self.peer_value)
+        for p in list(self.peers):
+            try:
+                if p in unchoked:
+                    if p.am_choking():
+                        yield from p.unchoke_and_notify()
+                elif not p.am_choking():
+                    yield from p.choke_and_notify()
+            except (PeerDisconnected, ConnectionResetError) as e:
+                print(e)
+                self.disconnect(p)
+
+    @coroutine
+    def choke_forever(self):
+        """Re-run the choker every CHOKE_INTERVAL seconds"""
+        while self.running:
+            yield from asyncio.sleep(self.CHOKE_INTERVAL)
+            yield from self.rechoke()
+
+    @coroutine
+    def save_resume_forever(self):
+        """Save what we've downloaded every RESUME_SAVE_INTERVAL seconds, so a crash doesn't lose much"""
+        while self.running:
+            yield from asyncio.sleep(self.RESUME_SAVE_INTERVAL)
+            self.piece_manager.save_resume()
+
+    @coroutine
+    def accept_peer_connection(self, conn: PeerConnection):
+        # Holds a slot through the handshake, so connections arriving together can't all take the last one
+        if not self.connections.reserve_incoming(len(self.peers)):
+            print(f'Already have {len(self.peers)} peers, turning away an incoming connection')
+            conn.close()
+            return
+
         peer = SwarmPeer(
             swarm=self,
-            reader=reader,
-            writer=writer
+            conn=conn
         )
 
         try:
             yield from asyncio.wait_for(peer.accept_connection(), timeout=10)
-            self.peers.append(peer)
+            self.add_peer(peer)
             asyncio.ensure_future(self.handle_peer_msgs(peer))
 
         except (PeerDisconnected, ConnectionResetError, MalformedPacketException, InfoHashDoesntMatchException,
                 asyncio.TimeoutError) as e:
             print(e)
             print(f'Disconnecting from peer, {peer.peer_id()}')
-            writer.close()
+            conn.close()
+
+        finally:
+            self.connections.incoming_done()
 
-        # SwarmPeer's __del__ will close the writer
+        # SwarmPeer's __del__ will close the connection
 
     @coroutine
     def handle_incoming_connections(self):
         print(f'Listening on 0.0.0.0:{self.__peer_port}')
-        yield from asyncio.start_server(self.accept_peer_connection, host=None, port=self.__peer_port)
+        yield from start_peer_server(self.accept_peer_connection, host=None, port=self.__peer_port)
 
     @coroutine
     def start(self):
@@ -465,17 +930,19 @@ class Swarm:
         # Get pieces from existing file
         self.piece_manager.load_exiting_pieces()
 
-        yield from self.find_peers()
-
         yield from asyncio.gather(
-            self.handle_incoming(),
+            self.manage_connections_forever(),
             self.handle_incoming_connections(),
             self.request_pieces(),
             self.send_keepalives_forever(),
+            self.save_resume_forever(),
+            self.expire_requests_forever(),
+            self.choke_forever(),
         )
 
     def stop(self):
         self.running = False
+        self.piece_manager.save_resume()
 
         # TODO:
         # Handle adding peers that connect
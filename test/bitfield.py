@@ -2,7 +2,7 @@ from hashlib import sha1
 
 from hypothesis import given
 # from hypothesis.strategies import binary, builds, composite, integers, lists, one_of, sampled_from, sets, text
-from hypothesis.strategies import booleans, lists
+from hypothesis.strategies import booleans, integers, lists
 from hypothesis.core import SearchStrategy
 
 from bitfield import Bitfield, MutableBitfield
@@ -24,3 +24,45 @@ def test_fill_bitfield(bool_list):
         assert bf.get(i) == b
 
 
+
+
+@given(bool_lists)
+def test_bitfield_bytes(bool_list):
+    # Piece 0 is the high bit of the first byte
+    padded = bool_list + [False] * (-len(bool_list) % 8)
+    raw = bytes(int(''.join('1' if b else '0' for b in padded[i:i + 8]), 2) for i in range(0, len(padded), 8))
+
+    bf = Bitfield(raw)
+    assert bytes(bf) == raw
+    assert list(bf) == padded
+    assert bf.num_set() == sum(bool_list)
+    assert list(bf.set_bits()) == [i for i, b in enumerate(padded) if b]
+
+
+@given(bool_lists, integers(0, 100))
+def test_unset(bool_list, index):
+    bf = MutableBitfield(len(bool_list))
+    for i, b in enumerate(bool_list):
+        if b:
+            bf.set(i)
+
+    if index < len(bf):
+        bf.unset(index)
+        assert bf.get(index) == 0
+        assert bf.num_set() == sum(b for i, b in enumerate(bool_list) if i != index)
+
+
+@given(lists(booleans(), min_size=16, max_size=16), lists(booleans(), min_size=16, max_size=16), integers(0, 16))
+def test_set_operations(bits1, bits2, start):
+    bf1, bf2 = MutableBitfield(16), MutableBitfield(16)
+    for bf, bits in ((bf1, bits1), (bf2, bits2)):
+        for i, b in enumerate(bits):
+            if b:
+                bf.set(i)
+
+    assert list(bf1 & bf2) == [a & b for a, b in zip(bits1, bits2)]
+    assert list(bf1 | bf2) == [a | b for a, b in zip(bits1, bits2)]
+    assert list(bf1 - bf2) == [a & (not b) for a, b in zip(bits1, bits2)]
+
+    wanted = [i for i in range(start, 16) if bits1[i] and not bits2[i]]
+    assert (bf1 - bf2).first_set(start) == (wanted[0] if wanted else None)
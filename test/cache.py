@@ -0,0 +1,85 @@
+import os
+import tempfile
+
+from hypothesis import given
+from hypothesis.strategies import integers, lists
+
+from cache import PieceCache
+from storage import Request, MmapPieceIO, PieceIO, PieceManager, BLOCK_LEN
+from torrent import Torrent
+from test.storage import make_torrent
+
+
+@given(lists(integers(0, 20)), integers(1, 10))
+def test_lru(indices, capacity):
+    cache = PieceCache(max_bytes=capacity)
+    recent = []
+
+    for index in indices:
+        if cache.get(index) is None:
+            cache.put(index, b'x')
+        assert cache.size == len(cache) <= capacity
+
+        if index in recent:
+            recent.remove(index)
+        recent.append(index)
+
+        # Holds the most recently used pieces
+        assert sorted(cache.pieces) == sorted(recent[-capacity:])
+
+    assert cache.hits + cache.misses == len(indices)
+
+
+def test_get_block_reads_whole_piece():
+    piece_length = 4 * BLOCK_LEN
+    files = {'a': os.urandom(3 * piece_length + 10)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+        os.makedirs(download_dir)
+        with open(os.path.join(download_dir, 'a'), 'wb') as f:
+            f.write(files['a'])
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        cache = PieceCache(max_bytes=2 * piece_length)
+        mgr = PieceManager(t, PieceIO(t), cache=cache)
+        mgr.load_exiting_pieces()
+
+        for index in (0, 1, 0, 3):
+            for off in range(0, piece_length, BLOCK_LEN):
+                start = index * piece_length + off
+                length = min(BLOCK_LEN, len(data) - start)
+                if length <= 0:
+                    break
+
+                assert mgr.get_block(Request(index, off, length)).data() == data[start:start + length]
+
+        # A miss on the first block of each piece reads the rest of it.  Piece 3 is one short block.
+        assert cache.misses == 3
+        assert cache.hits == 3 + 3 + 4
+
+
+def test_no_cache_with_mmap():
+    """Mapped files aren't cached: it would save nothing, and cached views of the mapping would stop it closing"""
+    piece_length = 2 * BLOCK_LEN
+    files = {'a': os.urandom(3 * piece_length)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+        os.makedirs(download_dir)
+        with open(os.path.join(download_dir, 'a'), 'wb') as f:
+            f.write(files['a'])
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        cache = PieceCache()
+        io = MmapPieceIO(t)
+        mgr = PieceManager(t, io, cache=cache)
+        mgr.load_exiting_pieces()
+
+        assert bytes(mgr.get_block(Request(1, BLOCK_LEN, BLOCK_LEN)).data()) == \
+            data[piece_length + BLOCK_LEN:2 * piece_length]
+        assert len(cache) == 0
+
+        io.close()
@@ -0,0 +1,78 @@
+from hypothesis import given
+from hypothesis.strategies import booleans, composite, floats, integers, lists
+
+from choker import Choker
+
+
+class SimPeer:
+    def __init__(self, rate: float, interested: bool):
+        self.rate = rate
+        self.interested = interested
+
+    def peer_interested(self):
+        return self.interested
+
+
+@composite
+def swarms(draw):
+    """The peers in a swarm, each sending to us at some rate and maybe interested in what we have"""
+    peers = draw(lists(floats(min_value=0, max_value=1e7), max_size=20))
+    return [SimPeer(rate, draw(booleans())) for rate in peers]
+
+
+def rate(p: SimPeer) -> float:
+    return p.rate
+
+
+@given(swarms(), integers(min_value=0, max_value=8))
+def test_unchokes_best_peers(peers, slots):
+    choker = Choker(unchoke_slots=slots)
+    unchoked = choker.choose(peers, rate)
+
+    interested = [p for p in peers if p.interested]
+    assert len(unchoked) == min(len(interested), choker.max_unchoked())
+    assert all(p.interested for p in unchoked)
+
+    # Nobody choked gives us more than anyone unchoked, besides the optimistic unchoke
+    regular = unchoked - {choker.optimistic}
+    choked = [p for p in interested if p not in unchoked]
+    if regular and choked:
+        assert min(p.rate for p in regular) >= max(p.rate for p in choked)
+
+
+@given(swarms(), integers(min_value=0, max_value=4), integers(min_value=1, max_value=4))
+def test_optimistic_unchoke_rotates(peers, slots, optimistic_rounds):
+    """Every interested peer gets unchoked eventually, however little it gives us"""
+    choker = Choker(unchoke_slots=slots, optimistic_rounds=optimistic_rounds)
+
+    interested = [p for p in peers if p.interested]
+    ever_unchoked = set()
+    for _ in range(len(peers) * optimistic_rounds + 1):
+        ever_unchoked |= choker.choose(peers, rate)
+
+    assert ever_unchoked == set(interested)
+
+
+def test_reciprocation():
+    """Simulated rounds: peers which start sending to us more get unchoked, and those which stop get choked"""
+    peers = [SimPeer(rate=i, interested=True) for i in range(10)]
+    choker = Choker(unchoke_slots=3, optimistic_rounds=3)
+
+    unchoked = choker.choose(peers, rate)
+    assert {peers[9], peers[8], peers[7]} <= unchoked
+
+    # The slowest peer starts sending fastest, and the fastest stops
+    peers[0].rate = 100
+    peers[9].rate = 0
+    unchoked = choker.choose(peers, rate)
+    assert peers[0] in unchoked
+    assert {peers[8], peers[7]} <= unchoked
+    assert peers[9] not in unchoked or peers[9] is choker.optimistic
+
+    # Peers losing interest are choked
+    peers[0].interested = False
+    assert peers[0] not in choker.choose(peers, rate)
+
+    # Disconnected peers are forgotten
+    choker.choose(peers[1:5], rate)
+    assert all(p in peers[1:5] for p in choker.last_optimistic)
@@ -0,0 +1,130 @@
+from hypothesis import given
+from hypothesis.strategies import integers
+
+from connections import ConnectionManager
+
+
+def addresses(n):
+    return [('10.0.0.1', 6881 + i) for i in range(n)]
+
+
+@given(integers(min_value=0, max_value=40), integers(min_value=0, max_value=40), integers(min_value=1, max_value=10),
+       integers(min_value=1, max_value=50), integers(min_value=0, max_value=40))
+def test_dial_limits(target, max_peers, max_dials, num_candidates, num_peers):
+    m = ConnectionManager(target_peers=target, max_peers=max_peers, max_dials=max_dials)
+    m.add_candidates(addresses(num_candidates))
+
+    dialing = m.to_dial(num_peers, now=0)
+    assert len(dialing) <= max_dials
+    assert num_peers + len(dialing) <= max(num_peers, min(target, max_peers))
+    assert len(set(dialing)) == len(dialing)
+
+    # Nothing more until some of those dials finish
+    assert m.to_dial(num_peers, now=0) == []
+
+
+def test_backoff():
+    m = ConnectionManager(target_peers=5, max_dials=5)
+    good, bad = addresses(2)
+    m.add_candidates([good, bad])
+    m.add_candidates([good])  # Already known
+    assert len(m.candidates) == 2
+
+    assert set(m.to_dial(0, now=0)) == {good, bad}
+    m.connected(good, now=0)
+    m.failed(bad, now=0)
+
+    # Backs off twice as long after each failure
+    assert m.to_dial(1, now=1) == []
+    assert m.to_dial(1, now=m.BASE_BACKOFF) == [bad]
+    m.failed(bad, now=m.BASE_BACKOFF)
+    assert m.to_dial(1, now=2 * m.BASE_BACKOFF) == []
+    assert m.to_dial(1, now=3 * m.BASE_BACKOFF) == [bad]
+
+    # Given up on after too many failures
+    now = 3 * m.BASE_BACKOFF
+    for _ in range(m.MAX_FAILURES - 2):
+        m.failed(bad, now)
+        now += m.MAX_BACKOFF
+        m.to_dial(1, now)
+    assert bad not in m.candidates
+
+
+def test_replaces_disconnected_peers():
+    m = ConnectionManager(target_peers=2, max_dials=2)
+    a, b, c = addresses(3)
+    m.add_candidates([a, b, c])
+
+    dialing = m.to_dial(0, now=0)
+    assert dialing == [a, b]
+    for address in dialing:
+        m.connected(address, now=0)
+    assert m.to_dial(2, now=0) == []
+
+    # a drops: c takes its place, and a waits a while before being dialed again
+    m.disconnected(a, now=1)
+    assert m.to_dial(1, now=1) == [c]
+    m.failed(c, now=1)
+    assert m.to_dial(1, now=1 + m.BASE_BACKOFF) == [a]
+
+
+def test_peers_dropping_quickly_are_backed_off():
+    m = ConnectionManager(target_peers=1, max_dials=1)
+    a, = addresses(1)
+    m.add_candidates([a])
+
+    now = 0
+    for drops in range(1, m.MAX_FAILURES):
+        assert m.to_dial(0, now) == [a]
+        m.connected(a, now)
+        m.disconnected(a, now + 1)
+
+        # Twice as long each time
+        backoff = min(m.BASE_BACKOFF * 2 ** (drops - 1), m.MAX_BACKOFF)
+        assert m.to_dial(0, now + backoff) == []
+        now += 1 + backoff
+
+    # Then given up on
+    assert m.to_dial(0, now) == [a]
+    m.connected(a, now)
+    m.disconnected(a, now + 1)
+    assert a not in m.candidates
+
+
+def test_long_connections_reset_backoff():
+    m = ConnectionManager(target_peers=1, max_dials=1)
+    a, = addresses(1)
+    m.add_candidates([a])
+
+    now = 0
+    for _ in range(m.MAX_FAILURES + 2):
+        assert m.to_dial(0, now) == [a]
+        m.connected(a, now)
+        now += m.STABLE_CONNECTION
+        m.disconnected(a, now)
+        now += m.BASE_BACKOFF
+
+    assert m.candidates[a].drops == 1
+
+
+def test_incoming_limit():
+    m = ConnectionManager(target_peers=2, max_peers=4, max_dials=2)
+    m.add_candidates(addresses(2))
+
+    assert m.reserve_incoming(2)
+    m.to_dial(1, now=0)  # One dial in flight
+    assert not m.reserve_incoming(2)
+    assert m.rejected == 1
+
+    # Slots stay reserved until the handshake's done, so connections arriving at once can't overfill
+    m.incoming_done()
+    assert m.reserve_incoming(1)
+    assert m.reserve_incoming(1)
+    assert not m.reserve_incoming(1)
+    m.incoming_done()
+    assert m.reserve_incoming(1)
+
+    # Nor can dials take them
+    m.failed(next(iter(m.dialing)), now=0)
+    assert m.reserve_incoming(1)
+    assert m.to_dial(1, now=m.MAX_BACKOFF) == []
@@ -0,0 +1,174 @@
+import os
+import tempfile
+
+import filepool
+import resume
+from filepool import FilePool
+from storage import Block, MmapPieceIO, PieceIO, PieceManager, BLOCK_LEN
+from torrent import Torrent
+from test.storage import make_torrent
+
+
+def test_files_opened_lazily():
+    piece_length = BLOCK_LEN
+    files = {f'{n}': os.urandom(BLOCK_LEN // 2 + n) for n in range(20)}
+    files['empty'] = b''
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        pool = FilePool(max_open=3)
+        mgr = PieceManager(t, PieceIO(t, pool))
+
+        # Only empty files are created up front
+        assert os.listdir(download_dir) == ['empty']
+
+        r = mgr.next_request()
+        while r is not None:
+            start = t.piece_offset(r.index()) + r.begin_offset()
+            mgr.save_block(Block(r.index(), r.begin_offset(), data[start:start + r.length()]))
+            assert pool.num_open() <= 3
+            r = mgr.next_request()
+
+        assert mgr.complete()
+        for start in range(0, len(data), piece_length):
+            piece_data = data[start:start + piece_length]
+            assert mgr.io.read(start, len(piece_data)) == piece_data
+            assert pool.num_open() <= 3
+
+        pool.close()
+        assert pool.num_open() == 0
+
+        for name, d in files.items():
+            with open(os.path.join(download_dir, name), 'rb') as f:
+                assert f.read() == d
+
+
+def test_files_in_use_stay_open():
+    with tempfile.TemporaryDirectory() as directory:
+        make_torrent(directory, {'a': b'a' * 10, 'b': b'b' * 10}, BLOCK_LEN)
+        t = Torrent(os.path.join(directory, 'test.torrent'), os.path.join(directory, 'download'))
+        a, b = t.files
+
+        pool = FilePool(max_open=1, preallocate=True)
+        with pool.open(a) as fd_a:
+            with pool.open(b):
+                assert pool.num_open() == 2
+                assert os.fstat(fd_a).st_size == 10
+
+            # b goes once a is the only file in use
+            assert pool.num_open() == 1
+
+        assert os.path.getsize(b.path) == 10
+        pool.close()
+
+
+def test_mappings_limited():
+    """MmapPieceIO keeps no more files mapped than the pool keeps open, even with blocks out of unmapped files"""
+    piece_length = BLOCK_LEN
+    files = {f'{n}': os.urandom(BLOCK_LEN // 2 + n) for n in range(20)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        t = Torrent(os.path.join(directory, 'test.torrent'), os.path.join(directory, 'download'))
+        io = MmapPieceIO(t, FilePool(max_open=3))
+        mgr = PieceManager(t, io)
+
+        r = mgr.next_request()
+        while r is not None:
+            start = t.piece_offset(r.index()) + r.begin_offset()
+            mgr.save_block(Block(r.index(), r.begin_offset(), data[start:start + r.length()]))
+            assert len(io.maps) <= 3
+            r = mgr.next_request()
+
+        assert mgr.complete()
+
+        # Held on to while every other file is mapped in turn
+        first = io.read(0, len(files['0']))
+        assert isinstance(first, memoryview)
+        for start in range(0, len(data), piece_length):
+            piece_data = data[start:start + piece_length]
+            assert io.read(start, len(piece_data)) == piece_data
+            assert len(io.maps) <= 3
+        assert first == files['0']
+
+        first.release()
+        io.close()
+        for name, d in files.items():
+            with open(t.files[int(name)].path, 'rb') as f:
+                assert f.read() == d
+
+
+def test_written_files_synced_before_resume(monkeypatch):
+    """Everything written is on disk before the resume file says it is, including files the pool has closed"""
+    events = []
+    sync = filepool._fdatasync
+    monkeypatch.setattr(filepool, '_fdatasync', lambda fd: events.append(os.readlink(f'/proc/self/fd/{fd}'))
+                        or sync(fd))
+    save = resume.ResumeState.save
+    monkeypatch.setattr(resume.ResumeState, 'save', lambda self, path: events.append('resume') or save(self, path))
+
+    piece_length = BLOCK_LEN
+    files = {f'{n}': os.urandom(piece_length) for n in range(4)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        t = Torrent(os.path.join(directory, 'test.torrent'), os.path.join(directory, 'download'))
+        mgr = PieceManager(t, PieceIO(t, FilePool(max_open=1)), resume_file=os.path.join(directory, 'resume'))
+
+        # Every other piece
+        for index in range(0, len(files), 2):
+            mgr.save_block(Block(index, 0, data[index * piece_length:(index + 1) * piece_length]))
+
+        mgr.save_resume()
+        written = sorted(t.files[index].path for index in range(0, len(files), 2))
+        assert sorted(events[:-1]) == written
+        assert events[-1] == 'resume'
+
+        # Nothing new to sync
+        events.clear()
+        mgr.save_resume()
+        assert events == ['resume']
+
+        events.clear()
+        mgr.save_block(Block(1, 0, data[piece_length:2 * piece_length]))
+        mgr.io.close()
+        assert events == [t.files[1].path]
+
+
+class RecordingMap:
+    """Wraps a mapping, recording flushes"""
+
+    def __init__(self, m, events):
+        self.m = m
+        self.events = events
+
+    def flush(self):
+        self.events.append('flush')
+        self.m.flush()
+
+    def close(self):
+        self.m.close()
+
+
+def test_mappings_flushed_before_resume(monkeypatch):
+    events = []
+    save = resume.ResumeState.save
+    monkeypatch.setattr(resume.ResumeState, 'save', lambda self, path: events.append('resume') or save(self, path))
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, {'a': os.urandom(2 * BLOCK_LEN)}, BLOCK_LEN)
+        t = Torrent(os.path.join(directory, 'test.torrent'), os.path.join(directory, 'download'))
+        mgr = PieceManager(t, MmapPieceIO(t), resume_file=os.path.join(directory, 'resume'))
+        mgr.save_block(Block(0, 0, data[:BLOCK_LEN]))
+
+        io = mgr.io
+        io.maps = {f: RecordingMap(m, events) for f, m in io.maps.items()}
+        mgr.save_resume()
+        assert events == ['flush', 'resume']
+
+        events.clear()
+        io.close()
+        assert events == ['flush']
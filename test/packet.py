@@ -1,5 +1,5 @@
 from hypothesis import given
-from hypothesis.strategies import binary, builds, composite, integers, one_of, sampled_from, text
+from hypothesis.strategies import binary, builds, composite, integers, lists, one_of, sampled_from, text
 from hypothesis.core import SearchStrategy
 
 from bitfield import Bitfield
@@ -116,12 +116,20 @@ def test_enc_dec(pkt: BittorrentPacket):
     assert pkt_cls == type(pkt)
 
     assert len(pkt) == 4 + 1 + h.body_length()
-
+    if h.type() != BittorrentPacketType.KEEPALIVE:
+        assert h.serialize() == pkt_bytes[:h.size()]
 
     pkt_unserialized = pkt_cls.deserialize(pkt_bytes[-h.body_length():])
     assert pkt == pkt_unserialized
 
 
+@given(lists(bt_ints), lists(block_requests()))
+def test_serialize_many(piece_indices: list, requests: list):
+    assert HavePacket.serialize_many(piece_indices) == b''.join(HavePacket(i).serialize() for i in piece_indices)
+    assert RequestPacket.serialize_many(requests) == b''.join(RequestPacket(r).serialize() for r in requests)
+    assert CancelPacket.serialize_many(requests) == b''.join(CancelPacket(r).serialize() for r in requests)
+
+
 @given(handshake_pkts)
 def test_handshake_enc_dec(pkt: HandshakePacket):
     pkt_bytes = pkt.serialize()
@@ -132,3 +140,96 @@ def test_handshake_enc_dec(pkt: HandshakePacket):
 
 
 
+
+
+class FakeTransport:
+    def __init__(self):
+        self.reading_paused = False
+        self.closed = False
+        self.writes = []  # One list of buffers per writelines() call
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def writelines(self, bufs):
+        self.writes.append([bytes(b) for b in bufs])
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+@given(handshake_pkts, lists(bt_pkts), lists(integers(1, 1 << 16), min_size=1))
+def test_parse_stream(handshake: HandshakePacket, pkts: list, read_sizes: list):
+    stream = handshake.serialize() + b''.join(p.serialize() for p in pkts)
+
+    conn = PeerConnection()
+    conn.connection_made(FakeTransport())
+
+    # However the stream is split up by reads
+    received = 0
+    n = 0
+    while received < len(stream):
+        buf = conn.get_buffer(-1)
+        nbytes = min(read_sizes[n % len(read_sizes)], len(buf), len(stream) - received)
+        buf[:nbytes] = stream[received:received + nbytes]
+        conn.buffer_updated(nbytes)
+
+        received += nbytes
+        n += 1
+
+    assert conn.error is None
+    assert list(conn.packets) == [handshake] + pkts
+
+
+def test_parse_malformed():
+    conn = PeerConnection()
+    conn.connection_made(FakeTransport())
+
+    # A REQUEST two bytes short
+    stream = HandshakePacket(bytes(20), bytes(20)).serialize() + pack('!LB', 11, 6) + bytes(10)
+    conn.get_buffer(-1)[:len(stream)] = stream
+    conn.buffer_updated(len(stream))
+
+    assert isinstance(conn.error, PeerDisconnected)
+    assert conn.transport.closed
+
+
+@given(handshake_pkts, lists(bt_pkts))
+def test_corked_send(handshake: HandshakePacket, pkts: list):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    conn = PeerConnection()
+    conn.connection_made(FakeTransport())
+
+    expected = handshake.serialize() + b''.join(p.serialize() for p in pkts)
+
+    async def send_all():
+        for p in [handshake] + pkts:
+            await send_packet(conn, p)
+
+        # Nothing goes out until the loop gets round to it, unless there's a lot queued
+        if len(expected) < PeerConnection.CORK_LIMIT:
+            assert conn.transport.writes == []
+
+        await asyncio.sleep(0)
+
+    try:
+        loop.run_until_complete(send_all())
+
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    assert b''.join(b''.join(bufs) for bufs in conn.transport.writes) == expected
+    if len(expected) < PeerConnection.CORK_LIMIT:
+        assert len(conn.transport.writes) == 1
@@ -0,0 +1,112 @@
+from hypothesis import given
+from hypothesis.strategies import booleans, composite, integers, lists
+
+from bitfield import MutableBitfield
+from picker import PiecePicker
+
+
+@composite
+def swarms(draw):
+    """A number of pieces, and the bitfields of the peers in a swarm"""
+    num_pieces = draw(integers(min_value=1, max_value=64))
+    peer_bits = draw(lists(lists(booleans(), min_size=num_pieces, max_size=num_pieces), max_size=8))
+
+    bitfields = []
+    for bits in peer_bits:
+        bf = MutableBitfield(num_pieces)
+        for i, b in enumerate(bits):
+            if b:
+                bf.set(i)
+        bitfields.append(bf)
+
+    return num_pieces, bitfields
+
+
+def availability(bitfields, index):
+    return sum(bf.get(index) for bf in bitfields)
+
+
+@given(swarms())
+def test_availability(swarm):
+    num_pieces, bitfields = swarm
+    picker = PiecePicker(num_pieces)
+
+    for bf in bitfields:
+        picker.add_bitfield(bf)
+
+    for i in range(num_pieces):
+        assert picker.availability[i] == availability(bitfields, i)
+
+    for bf in bitfields:
+        picker.remove_bitfield(bf)
+
+    assert picker.availability == [0] * num_pieces
+
+
+@given(swarms())
+def test_picks_rarest_first(swarm):
+    num_pieces, bitfields = swarm
+    picker = PiecePicker(num_pieces)
+
+    for bf in bitfields:
+        picker.add_bitfield(bf)
+
+    picked = []
+    index = picker.pick()
+    while index is not None:
+        picked.append(index)
+        index = picker.pick()
+
+    # Every piece is started exactly once
+    assert sorted(picked) == list(range(num_pieces))
+    assert picker.partial_pieces() == picked
+
+    # Pieces nobody has go last, the rest go from rarest to most common
+    rarity = [availability(bitfields, i) or len(bitfields) + 1 for i in picked]
+    assert rarity == sorted(rarity)
+
+
+@given(swarms(), integers(min_value=0, max_value=7))
+def test_pick_only_pieces_peer_has(swarm, peer):
+    num_pieces, bitfields = swarm
+    if not bitfields:
+        return
+
+    picker = PiecePicker(num_pieces)
+    for bf in bitfields:
+        picker.add_bitfield(bf)
+
+    bf = bitfields[peer % len(bitfields)]
+    index = picker.pick(bf.get)
+    while index is not None:
+        assert bf.get(index)
+        index = picker.pick(bf.get)
+
+    # All the peer's pieces were started
+    assert all(not bf.get(i) or i in picker.partial for i in range(num_pieces))
+
+
+@given(swarms())
+def test_finished_pieces_not_picked(swarm):
+    num_pieces, bitfields = swarm
+    picker = PiecePicker(num_pieces)
+
+    for bf in bitfields:
+        picker.add_bitfield(bf)
+
+    for i in range(0, num_pieces, 2):
+        picker.finish(i)
+
+    # Availability changes keep finished pieces out
+    for bf in bitfields:
+        picker.remove_bitfield(bf)
+        picker.add_bitfield(bf)
+
+    index = picker.pick()
+    while index is not None:
+        assert index % 2 == 1
+        picker.finish(index)
+        index = picker.pick()
+
+    assert picker.partial_pieces() == []
+    assert picker.num_unstarted() == 0
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+from ratelimit import TokenBucket, throttle
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+def test_unlimited():
+    bucket = TokenBucket()
+    start = time.monotonic()
+    run(throttle([bucket], 10 ** 12))
+    assert time.monotonic() - start < 0.1
+
+
+def test_rate():
+    # The first second's worth goes straight away, the rest at the limit
+    bucket = TokenBucket(rate=200_000)
+
+    async def send():
+        for _ in range(40):
+            await bucket.consume(16 * 1024)
+
+    start = time.monotonic()
+    run(send())
+    elapsed = time.monotonic() - start
+
+    expected = (40 * 16 * 1024 - 200_000) / 200_000
+    assert expected * 0.8 < elapsed < expected * 1.5 + 0.1
+
+
+def test_fair():
+    """Consumers sharing a bucket take turns, however much each of them wants to send"""
+    bucket = TokenBucket(rate=200_000, burst=20_000)
+    order = []
+
+    async def peer(name, n):
+        for _ in range(n):
+            await bucket.consume(20_000)
+            order.append(name)
+
+    async def main():
+        await asyncio.gather(peer('a', 10), peer('b', 5))
+
+    run(main())
+    # b's sends are interleaved with a's, rather than waiting for a to finish
+    assert 'ab' * 5 in ''.join(order)
+
+
+def test_set_rate():
+    """A waiting consumer notices the limit being lifted"""
+    bucket = TokenBucket(rate=1000)
+
+    async def main():
+        await bucket.consume(100_000)  # Deep in debt
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.1, bucket.set_rate, None)
+        start = time.monotonic()
+        await bucket.consume(1)
+        return time.monotonic() - start
+
+    assert run(main()) < 0.5
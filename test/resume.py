@@ -0,0 +1,121 @@
+import os
+import tempfile
+
+from hypothesis import given
+from hypothesis.strategies import binary, dictionaries, integers, lists, text, tuples
+
+from resume import ResumeState
+from storage import Block, PieceIO, PieceManager, BLOCK_LEN
+from torrent import Torrent
+from test.storage import make_torrent
+
+bt_ints = integers(0, 0xFFFFFFFF)
+
+
+@given(
+    binary(min_size=20, max_size=20),
+    binary(),
+    dictionaries(text(min_size=1), tuples(bt_ints, integers(min_value=0))),
+    dictionaries(bt_ints, lists(tuples(bt_ints, binary()))),
+)
+def test_enc_dec(info_hash, bitfield, files, partial_pieces):
+    state = ResumeState(info_hash, bitfield, files, partial_pieces)
+    decoded = ResumeState.deserialize(state.serialize())
+
+    assert decoded.info_hash == info_hash
+    assert decoded.bitfield == bitfield
+    assert decoded.files == files
+    assert decoded.partial_pieces == partial_pieces
+
+
+def test_resume():
+    piece_length = 2 * BLOCK_LEN
+    files = {
+        'a': os.urandom(3 * BLOCK_LEN),
+        'b': os.urandom(3 * BLOCK_LEN + 7),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        torrent_file = os.path.join(directory, 'test.torrent')
+        download_dir = os.path.join(directory, 'download')
+
+        # Download pieces 0 and 2, and half of piece 1
+        t = Torrent(torrent_file, download_dir)
+        resume_file = os.path.join(directory, 'test.resume')
+        mgr = PieceManager(t, PieceIO(t), resume_file=resume_file)
+        mgr.load_exiting_pieces()
+
+        for index in (0, 2):
+            for off in range(0, piece_length, BLOCK_LEN):
+                start = index * piece_length + off
+                mgr.save_block(Block(index, off, data[start:start + BLOCK_LEN]))
+        mgr.picker.start(1)
+        mgr.save_block(Block(1, BLOCK_LEN, data[piece_length + BLOCK_LEN:2 * piece_length]))
+
+        mgr.save_resume()
+
+        # Nothing needs hashing when nothing changed
+        t = Torrent(torrent_file, download_dir)
+        mgr = PieceManager(t, PieceIO(t), resume_file=resume_file)
+        mgr._check_existing_piece = None
+        mgr.load_exiting_pieces()
+
+        assert sorted(mgr.finished_pieces) == [0, 2]
+        assert mgr.picker.partial_pieces() == [1]
+        assert mgr.next_request().begin_offset() == 0
+
+        # Pieces in a file which changed are hashed (and piece 2 is all in file b)
+        with open(os.path.join(download_dir, 'b'), 'r+b') as f:
+            f.seek(BLOCK_LEN)
+            f.write(bytes([data[2 * piece_length] ^ 1]))
+
+        t = Torrent(torrent_file, download_dir)
+        mgr = PieceManager(t, PieceIO(t), resume_file=resume_file)
+        mgr.load_exiting_pieces()
+
+        assert sorted(mgr.finished_pieces) == [0]
+
+        # Or everything, when asked
+        t = Torrent(torrent_file, download_dir)
+        mgr = PieceManager(t, PieceIO(t), resume_file=resume_file, recheck=True)
+        mgr.load_exiting_pieces()
+
+        assert sorted(mgr.finished_pieces) == [0]
+        assert mgr.picker.partial_pieces() == []
+
+
+def test_resume_complete_piece_in_changed_file():
+    """A piece saved while it was being verified, in a file touched since, is only finished once"""
+    piece_length = 2 * BLOCK_LEN
+    files = {'a': os.urandom(2 * piece_length)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        torrent_file = os.path.join(directory, 'test.torrent')
+        download_dir = os.path.join(directory, 'download')
+        os.makedirs(download_dir)
+
+        # Every block of piece 0 has arrived, but it hasn't been verified and written
+        t = Torrent(torrent_file, download_dir)
+        resume_file = os.path.join(directory, 'test.resume')
+        mgr = PieceManager(t, PieceIO(t), resume_file=resume_file)
+        mgr.load_exiting_pieces()
+
+        mgr.picker.start(0)
+        for off in range(0, piece_length, BLOCK_LEN):
+            mgr.unfinished_pieces[0].save_block(Block(0, off, data[off:off + BLOCK_LEN]))
+        mgr.save_resume()
+
+        # Then it was written, changing the file
+        path = os.path.join(download_dir, 'a')
+        with open(path, 'wb') as f:
+            f.write(data[:piece_length])
+        os.utime(path, ns=(0, 0))
+
+        t = Torrent(torrent_file, download_dir)
+        mgr = PieceManager(t, PieceIO(t), resume_file=resume_file)
+        mgr.load_exiting_pieces()
+
+        assert sorted(mgr.finished_pieces) == [0]
+        assert mgr.picker.partial_pieces() == []
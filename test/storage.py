@@ -1,10 +1,20 @@
+import asyncio
+import os
+import pickle
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from hashlib import sha1
 
+import pytest
+
 from hypothesis import given
-from hypothesis.strategies import binary, builds, composite, integers, one_of, sampled_from, text
+from hypothesis.strategies import binary, builds, composite, integers, one_of, permutations, sampled_from, text
 from hypothesis.core import SearchStrategy
 
-from storage import Request, Block, Piece, BLOCK_LEN
+from bencode import bencode
+from storage import Request, Block, Piece, MmapPieceIO, PieceIO, PieceManager, BLOCK_LEN
+from torrent import Torrent
 
 block_lengths = integers(min_value=0)
 valid_block_lengths = sampled_from([0, BLOCK_LEN])
@@ -68,6 +78,25 @@ def test_fill_piece(piece_and_blocks):
         assert not p.verify()
 
 
+@given(piece_and_blocks_pairs().flatmap(lambda pb: permutations(pb[1]).map(lambda blks: (pb[0], blks))))
+def test_fill_piece_out_of_order(piece_and_blocks):
+    p, blks = piece_and_blocks
+
+    p: Piece = p
+
+    for b in blks:
+        if b.data():
+            assert not p.verify()
+            p.save_block(b)
+
+    assert p.complete()
+    assert p.verify()
+
+    # Blocks come back in order for writing
+    offsets = [b.begin_offset() for b in p.get_downloaded_blocks()]
+    assert offsets == sorted(offsets)
+
+
 def simple_piece_request():
     data = b'\x00'
     piece = Piece(
@@ -149,3 +178,270 @@ def test_requests_complete_piece(piece_and_data):
     assert len(data) == 0 or p.next_request() is not None
 
 
+
+@given(piece_and_data_pairs())
+def test_pop_requests_once(piece_and_data):
+    p, data = piece_and_data
+
+    popped = []
+    r = p.pop_request()
+    while r:
+        popped.append(r)
+        r = p.pop_request()
+
+    # Each block is handed out once
+    assert len(popped) == p.num_blocks
+    assert len(set(popped)) == len(popped)
+
+    # Lose every other request
+    for r in popped[::2]:
+        p.save_block(make_block_for_request(r, data))
+
+    p.requeue_missing()
+
+    r = p.pop_request()
+    while r:
+        assert r in popped[1::2]
+        p.save_block(make_block_for_request(r, data))
+        r = p.pop_request()
+
+    assert p.complete()
+    assert p.verify()
+
+
+def make_torrent(directory: str, files: dict, piece_length: int) -> bytes:
+    """Writes a multi-file .torrent for files (name -> data) into directory, returning the torrent's data"""
+    data = b''.join(files.values())
+    pieces = b''.join(sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+
+    with open(os.path.join(directory, 'test.torrent'), 'wb') as f:
+        f.write(bencode({
+            'announce': 'http://localhost/announce',
+            'info': {
+                'name': 'test',
+                'piece length': piece_length,
+                'pieces': pieces,
+                'files': [{'length': len(d), 'path': [name]} for name, d in files.items()]
+            }
+        }))
+
+    return data
+
+
+def test_load_existing_pieces():
+    piece_length = 2 * BLOCK_LEN
+    files = {
+        'a': os.urandom(3 * BLOCK_LEN + 5),
+        'b': os.urandom(7),
+        'c': os.urandom(5 * BLOCK_LEN),
+        'd': os.urandom(BLOCK_LEN),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+        os.makedirs(download_dir)
+
+        # Corrupt a byte in piece 1, and leave file d out
+        for name, d in files.items():
+            if name == 'd':
+                continue
+            if name == 'a':
+                d = d[:piece_length] + bytes([d[piece_length] ^ 1]) + d[piece_length + 1:]
+            with open(os.path.join(download_dir, name), 'wb') as f:
+                f.write(d)
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        mgr = PieceManager(t, PieceIO(t))
+        mgr.load_exiting_pieces()
+
+        # File d is only in the last piece
+        last_piece = t.num_pieces - 1
+        for i in range(t.num_pieces):
+            assert mgr.has_piece(i) == (i not in (1, last_piece))
+            assert mgr.finished_pieces_bitfield.get(i) == mgr.has_piece(i)
+
+        # Reads span files
+        r = Request(piece_index=1, begin_offset=BLOCK_LEN, length=BLOCK_LEN)
+        offset = piece_length + BLOCK_LEN
+        assert mgr.get_block(r).data() == data[offset:offset + BLOCK_LEN]
+
+
+def test_mmap_piece_io():
+    piece_length = 2 * BLOCK_LEN
+    files = {
+        'a': os.urandom(BLOCK_LEN + 3),
+        'empty': b'',
+        'b': os.urandom(4 * BLOCK_LEN),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        io = MmapPieceIO(t)
+        mgr = PieceManager(t, io)
+
+        r = mgr.next_request()
+        while r is not None:
+            start = t.piece_offset(r.index()) + r.begin_offset()
+            mgr.save_block(Block(r.index(), r.begin_offset(), data[start:start + r.length()]))
+            r = mgr.next_request()
+
+        assert mgr.complete()
+
+        for start in range(0, len(data), BLOCK_LEN):
+            index, off = divmod(start, piece_length)
+            length = min(BLOCK_LEN, len(data) - start)
+            assert bytes(mgr.get_block(Request(index, off, length)).data()) == data[start:start + length]
+
+        # Blocks within one file come straight out of the mapping
+        assert isinstance(mgr.get_block(Request(1, 0, BLOCK_LEN)).data(), memoryview)
+
+        io.sync()
+        for name, d in files.items():
+            with open(os.path.join(download_dir, name), 'rb') as f:
+                assert f.read() == d
+
+
+def test_write_buffer():
+    piece_length = 2 * BLOCK_LEN
+    files = {
+        'a': os.urandom(3 * BLOCK_LEN + 5),
+        'b': os.urandom(7),
+        'c': os.urandom(6 * BLOCK_LEN),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        io = PieceIO(t, write_buffer_size=3 * piece_length)
+        io.FLUSH_INTERVAL = 60
+        mgr = PieceManager(t, io)
+
+        blocks = [Block(start // piece_length, start % piece_length, data[start:start + BLOCK_LEN])
+                  for start in range(0, len(data), BLOCK_LEN)]
+        for b in reversed(blocks):
+            mgr.save_block(b)
+
+            # Pieces can be read back before they're written out
+            if mgr.has_piece(b.index()):
+                start = t.piece_offset(b.index())
+                assert io.read(start, len(data[start:start + piece_length])) == data[start:start + piece_length]
+
+        assert mgr.complete()
+
+        io.sync()
+        assert not io.pending
+        for name, d in files.items():
+            with open(os.path.join(download_dir, name), 'rb') as f:
+                assert f.read() == d
+
+        io.close()
+        assert not io.flusher.is_alive()
+
+
+@pytest.mark.parametrize('executor_class', [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_check_on_executor(executor_class):
+    """Pieces are only finished once the executor has verified them and they've been written"""
+    piece_length = 2 * BLOCK_LEN
+    files = {
+        'a': os.urandom(3 * BLOCK_LEN + 5),
+        'b': os.urandom(4 * BLOCK_LEN),
+    }
+
+    with tempfile.TemporaryDirectory() as directory, executor_class(2) as executor:
+        data = make_torrent(directory, files, piece_length)
+        download_dir = os.path.join(directory, 'download')
+
+        t = Torrent(os.path.join(directory, 'test.torrent'), download_dir)
+        mgr = PieceManager(t, PieceIO(t), executor=executor)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        def save_piece(index, corrupt=False):
+            start = t.piece_offset(index)
+            piece_data = data[start:start + piece_length]
+            if corrupt:
+                piece_data = bytes([piece_data[0] ^ 1]) + piece_data[1:]
+
+            checked = None
+            for begin in range(0, len(piece_data), BLOCK_LEN):
+                checked = mgr.save_block(Block(index, begin, piece_data[begin:begin + BLOCK_LEN]))
+
+            # Not finished until it's been checked
+            assert not mgr.has_piece(index)
+            return loop.run_until_complete(checked)
+
+        try:
+            assert not save_piece(0, corrupt=True)
+            assert not mgr.has_piece(0)
+
+            for index in range(t.num_pieces):
+                assert save_piece(index)
+                assert mgr.finished_pieces_bitfield.get(index)
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+        assert mgr.complete()
+        mgr.io.close()
+        for name, d in files.items():
+            with open(os.path.join(download_dir, name), 'rb') as f:
+                assert f.read() == d
+
+
+@given(piece_and_data_pairs())
+def test_release_request(piece_and_data):
+    p, data = piece_and_data
+
+    popped = []
+    r = p.pop_request()
+    while r:
+        popped.append(r)
+        r = p.pop_request()
+
+    # Released requests go out again (once), unless their block arrived meanwhile
+    for r in popped:
+        p.release_request(r)
+        p.release_request(r)
+    for r in popped[::2]:
+        p.save_block(make_block_for_request(r, data))
+
+    again = [p.pop_request() for _ in popped[1::2]]
+    assert sorted(again, key=Request.begin_offset) == sorted(popped[1::2], key=Request.begin_offset)
+    assert p.pop_request() is None
+
+
+@given(piece_and_data_pairs())
+def test_endgame_requests(piece_and_data):
+    p, data = piece_and_data
+
+    popped = []
+    while not p.all_requested():
+        popped.append(p.pop_request())
+
+    # Once everything's been requested, the blocks which haven't arrived can be asked for again
+    for r in popped[::2]:
+        p.save_block(make_block_for_request(r, data))
+
+    assert p.all_requested()
+    assert p.missing_requests() == popped[1::2]
+
+
+@given(piece_indices, integers(0, 0xFFFFFFFF), integers(0, BLOCK_LEN), binary())
+def test_request_block_values(index, begin_offset, length, data):
+    r = Request(index, begin_offset, length)
+    b = Block(index, begin_offset, data)
+
+    # Plain values: equal ones are interchangeable as dict keys, and they survive the trip to a worker process
+    assert {r: 1}[Request(piece_index=index, begin_offset=begin_offset, length=length)] == 1
+    assert pickle.loads(pickle.dumps(r)) == r
+    assert pickle.loads(pickle.dumps(b)) == b
+
+    assert (r.index(), r.begin_offset(), r.length()) == (index, begin_offset, length)
+    assert b.request() == Request(index, begin_offset, len(data))
+    assert hash(Block(index, begin_offset, memoryview(bytearray(data)))) == hash(b)
@@ -0,0 +1,415 @@
+import asyncio
+import os
+import tempfile
+
+from collections import deque
+from concurrent.futures import Future
+
+import pytest
+
+import swarm
+from packet import BitfieldPacket, BlockPacket, CancelPacket, HavePacket, KeepalivePacket, RequestPacket, \
+    UnchokePacket
+from storage import Block, PieceIO, PieceManager, BLOCK_LEN
+from swarm import Swarm, SwarmPeer
+from torrent import Torrent
+from tracker import DummyTracker, Peer
+from test.storage import make_torrent
+
+NUM_PIECES = 8
+REQUEST_TIMEOUT = 10
+
+
+class Clock:
+    """Stands in for the time module in swarm"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+class StubTransport:
+    def is_closing(self):
+        return False
+
+
+class StubConnection:
+    """A PeerConnection which records what's written to it, and reads packets queued up by the test"""
+
+    def __init__(self):
+        self.transport = StubTransport()
+        self.writing_paused = False
+        self.written = []
+        self.packets = deque()
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def send(self, packet):
+        self.written.append(packet.serialize())
+
+    @asyncio.coroutine
+    def read_packet(self):
+        return self.packets.popleft()
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(swarm, 'time', c)
+    return c
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def test_swarm():
+    with tempfile.TemporaryDirectory() as directory:
+        piece_length = 2 * BLOCK_LEN
+        make_torrent(directory, {'a': os.urandom(NUM_PIECES * piece_length)}, piece_length)
+        t = Torrent(os.path.join(directory, 'test.torrent'), os.path.join(directory, 'download'))
+        mgr = PieceManager(t, PieceIO(t))
+
+        yield Swarm(t, manager=mgr, finder=DummyTracker(Peer('', '127.0.0.1', 1)), port=0,
+                    piece_request_timeout=REQUEST_TIMEOUT)
+
+
+def add_peer(loop, s: Swarm, pieces=range(NUM_PIECES)) -> SwarmPeer:
+    """A peer which has pieces and is unchoking us"""
+    p = SwarmPeer(s, StubConnection())
+    bits = bytearray(1)
+    for i in pieces:
+        bits[i // 8] |= 0x80 >> i % 8
+
+    for pkt in (BitfieldPacket(bytes(bits)), UnchokePacket()):
+        p._SwarmPeer__conn.packets.append(pkt)
+        loop.run_until_complete(p.read_next_packet())
+        loop.run_until_complete(s._handle_packet(p, pkt))
+
+    s.peers.append(p)
+    return p
+
+
+def send_requests(loop, s: Swarm, p: SwarmPeer, n: int) -> list:
+    requests = [s.piece_manager.next_request(p.has_piece) for _ in range(n)]
+    loop.run_until_complete(s.send_requests(p, requests))
+    return requests
+
+
+def answer(p: SwarmPeer, r):
+    p.block_received(Block(r.index(), r.begin_offset(), bytes(r.length())), r)
+
+
+def expire(loop, s: Swarm, now: float):
+    @asyncio.coroutine
+    def run():
+        s.expire_requests(now)
+        # Let re-issued requests go out
+        yield from asyncio.sleep(0)
+
+    loop.run_until_complete(run())
+
+
+def test_dropped_request_is_reissued(clock, loop, test_swarm):
+    """A peer answering requests sent after the one it dropped is not penalized, and the request goes elsewhere"""
+    s = test_swarm
+    p = add_peer(loop, s)
+    q = add_peer(loop, s)
+
+    dropped, = send_requests(loop, s, p, 1)
+    clock.now += 1
+    later = send_requests(loop, s, p, 2)
+    clock.now += 1
+    for r in later:
+        answer(p, r)
+
+    # Still answering: the clock restarts from its last block
+    expire(loop, s, clock.now + REQUEST_TIMEOUT - 3)
+    assert dropped in p.outstanding
+
+    clock.now += REQUEST_TIMEOUT + 1
+    expire(loop, s, clock.now)
+    assert dropped not in p.outstanding
+    assert p.timeouts == 1
+    assert p.consecutive_timeouts == 0
+    assert not p.penalized()
+
+    # Re-issued to the other peer
+    assert dropped in q.outstanding
+    assert s.request_timeouts == s.requests_reissued == 1
+    assert s.outstanding_requests_d[dropped] == [q]
+
+
+def test_stalled_peer_is_penalized(clock, loop, test_swarm):
+    s = test_swarm
+    p = add_peer(loop, s)
+
+    requests = send_requests(loop, s, p, SwarmPeer.PENALTY_TIMEOUTS)
+    clock.now += REQUEST_TIMEOUT
+    expire(loop, s, clock.now)
+
+    # Nobody else to ask, so they go back to the piece manager
+    assert not p.outstanding
+    assert s.requests_reissued == 0
+    released = [s.piece_manager.next_request(p.has_piece) for _ in requests]
+    assert sorted(released) == sorted(requests)
+
+    assert p.consecutive_timeouts == SwarmPeer.PENALTY_TIMEOUTS
+    assert p.penalized()
+    assert p.pipeline_depth() == 1
+
+    # The penalty runs out
+    clock.now += SwarmPeer.PENALTY_TIME
+    assert not p.penalized()
+    assert p.pipeline_depth() == SwarmPeer.MIN_PIPELINE_DEPTH
+
+    # And answering anything clears the count of timeouts in a row
+    r, = send_requests(loop, s, p, 1)
+    answer(p, r)
+    assert p.consecutive_timeouts == 0
+
+
+def test_reissue_skips_unavailable_peers(clock, loop, test_swarm):
+    """Requests only go to peers which have the piece, and aren't sent back to the peer which sat on them"""
+    s = test_swarm
+    p = add_peer(loop, s)
+    without = add_peer(loop, s, pieces=[NUM_PIECES - 1])
+    q = add_peer(loop, s)
+
+    r, = send_requests(loop, s, p, 1)
+    clock.now += REQUEST_TIMEOUT
+    expire(loop, s, clock.now)
+
+    assert r in q.outstanding
+    assert r not in p.outstanding and r not in without.outstanding
+
+
+def test_old_deadlines_are_ignored(clock, loop, test_swarm):
+    """A request sent to a peer again doesn't expire at the deadline it had the first time"""
+    s = test_swarm
+    p = add_peer(loop, s)
+
+    r, = send_requests(loop, s, p, 1)
+    s.release_requests(p)
+    clock.now += REQUEST_TIMEOUT - 1
+    loop.run_until_complete(s.send_requests(p, [r]))
+
+    clock.now += 1
+    expire(loop, s, clock.now)
+    assert r in p.outstanding
+    assert p.timeouts == 0
+
+    clock.now += REQUEST_TIMEOUT
+    expire(loop, s, clock.now)
+    assert r not in p.outstanding
+    assert p.timeouts == 1
+
+
+def fill_pipeline(loop, s: Swarm, p: SwarmPeer) -> list:
+    """Runs p's request pipeline until it's sent one round of requests, returning them"""
+    conn = p._SwarmPeer__conn
+    conn.written.clear()
+
+    @asyncio.coroutine
+    def run():
+        requesting = asyncio.ensure_future(s.request_from_peer(p))
+        yield from asyncio.sleep(0.01)
+        requesting.cancel()
+
+    loop.run_until_complete(run())
+
+    # REQUESTs packed into one write: the bodies follow each length and type
+    data = b''.join(conn.written)
+    size, header = RequestPacket.bspec.size, RequestPacket.bspec.size - RequestPacket.body_bspec.size
+    return [RequestPacket.deserialize(data[i + header:i + size]).request() for i in range(0, len(data), size)]
+
+
+def test_endgame(loop, test_swarm):
+    """Once everything's been requested, missing blocks are asked of other peers too, and cancelled on arrival"""
+    s = test_swarm
+    s.running = True
+    p = add_peer(loop, s)
+    q = add_peer(loop, s)
+    w = add_peer(loop, s)
+
+    requests = send_requests(loop, s, p, 2 * NUM_PIECES)
+    assert s.piece_manager.all_requested()
+    assert s.endgame_started is None
+
+    # Duplicates of p's requests, least duplicated first
+    q_requests = fill_pipeline(loop, s, q)
+    w_requests = fill_pipeline(loop, s, w)
+    assert s.endgame_started is not None
+    assert len(q_requests) == len(w_requests) == SwarmPeer.MIN_PIPELINE_DEPTH
+    assert set(q_requests) <= set(requests) and set(w_requests) <= set(requests)
+    assert not set(q_requests) & set(w_requests)
+    assert s.endgame_requests == len(q_requests) + len(w_requests)
+
+    # q answers first: p is told not to bother, and q and w aren't
+    r = q_requests[0]
+    for conn in (p, q, w):
+        conn._SwarmPeer__conn.written.clear()
+
+    b = Block(r.index(), r.begin_offset(), bytes(r.length()))
+    loop.run_until_complete(s._handle_packet(q, BlockPacket(b)))
+    loop.run_until_complete(asyncio.sleep(0))
+
+    assert p._SwarmPeer__conn.written == [CancelPacket(r).serialize()]
+    assert q._SwarmPeer__conn.written == w._SwarmPeer__conn.written == []
+    assert r not in p.outstanding and r not in q.outstanding
+    assert r not in s.outstanding_requests_d
+    assert s.endgame_cancels == 1
+
+
+def announce(loop, s: Swarm, indices):
+    @asyncio.coroutine
+    def run():
+        for index in indices:
+            checked = Future()
+            checked.set_result(True)
+            yield from s.announce_piece(index, checked)
+
+        # Past the batching interval
+        yield from asyncio.sleep(2 * s.HAVE_BATCH_INTERVAL)
+
+    loop.run_until_complete(run())
+
+
+def test_haves_are_batched(loop, test_swarm):
+    """HAVEs for pieces finished close together go out in one write, once each"""
+    s = test_swarm
+    p = add_peer(loop, s, pieces=[])
+    conn = p._SwarmPeer__conn
+    conn.written.clear()
+
+    announce(loop, s, [3, 1, 4])
+    assert conn.written == [b''.join(HavePacket(i).serialize() for i in (3, 1, 4))]
+
+    announce(loop, s, [5])
+    assert conn.written[1:] == [HavePacket(5).serialize()]
+    assert s.haves_sent == 4
+    assert s.haves_suppressed == 0
+
+
+def test_no_haves_for_peers_with_the_piece(loop, test_swarm):
+    s = test_swarm
+    seed = add_peer(loop, s)
+    leech = add_peer(loop, s, pieces=[0, 1])
+    for p in (seed, leech):
+        p._SwarmPeer__conn.written.clear()
+
+    announce(loop, s, [0, 1, 2])
+    assert seed._SwarmPeer__conn.written == []
+    assert leech._SwarmPeer__conn.written == [HavePacket(2).serialize()]
+    assert s.haves_sent == 1
+    assert s.haves_suppressed == 5
+    assert s.have_bytes_saved() == 5 * HavePacket.size()
+
+
+def test_have_waits_for_check(loop, test_swarm):
+    """Nothing's announced until the piece has been verified and written, and nothing at all if it failed"""
+    s = test_swarm
+    p = add_peer(loop, s, pieces=[])
+    conn = p._SwarmPeer__conn
+    conn.written.clear()
+
+    @asyncio.coroutine
+    def run(index, verified):
+        checked = Future()
+        announcing = asyncio.ensure_future(s.announce_piece(index, checked))
+        yield from asyncio.sleep(2 * s.HAVE_BATCH_INTERVAL)
+        assert not announcing.done()
+        assert conn.written == []
+
+        checked.set_result(verified)
+        yield from announcing
+        yield from asyncio.sleep(2 * s.HAVE_BATCH_INTERVAL)
+
+    loop.run_until_complete(run(0, False))
+    assert conn.written == []
+    assert s.haves_sent == 0
+
+    loop.run_until_complete(run(1, True))
+    assert conn.written == [HavePacket(1).serialize()]
+    assert s.haves_sent == 1
+
+
+def measure(loop, clock, s: Swarm, p: SwarmPeer, delay: float, blocks: int):
+    """p answers a request after delay, and blocks more blocks arrive from it at once"""
+    r, = send_requests(loop, s, p, 1)
+    clock.now += delay
+    answer(p, r)
+    for _ in range(blocks):
+        answer(p, r)
+
+
+def test_pipeline_depth_bounds(clock, loop, test_swarm):
+    s = test_swarm
+    p = add_peer(loop, s)
+
+    # Before any round trip is measured
+    assert p.pipeline_depth() == SwarmPeer.MIN_PIPELINE_DEPTH
+
+    # A slow peer still gets a few requests at once
+    measure(loop, clock, s, p, delay=0.01, blocks=0)
+    assert p.pipeline_depth() == SwarmPeer.MIN_PIPELINE_DEPTH
+
+    # However fast it is, it doesn't get more than MAX_PIPELINE_DEPTH
+    measure(loop, clock, s, p, delay=0.01, blocks=100_000)
+    assert p.pipeline_depth() == SwarmPeer.MAX_PIPELINE_DEPTH
+
+
+def test_pipeline_depth_follows_rate(clock, loop, test_swarm):
+    """The depth covers the bandwidth-delay product: the blocks which arrive in a round trip, plus a queue"""
+    s = test_swarm
+    p = add_peer(loop, s)
+    delay = 0.1
+
+    depths = []
+    for blocks in (20, 80, 400):
+        measure(loop, clock, s, p, delay, blocks)
+        depth = p.pipeline_depth()
+        expected = p.download_rate.rate() * (delay + SwarmPeer.PIPELINE_QUEUE_TIME) / BLOCK_LEN
+        assert expected <= depth < expected + 1
+        depths.append(depth)
+
+    assert depths == sorted(depths) and depths[0] < depths[-1]
+    assert SwarmPeer.MIN_PIPELINE_DEPTH < depths[0] and depths[-1] < SwarmPeer.MAX_PIPELINE_DEPTH
+
+    # As the rate decays, so does the depth
+    clock.now += 30
+    assert p.pipeline_depth() < depths[-1]
+
+
+def test_keepalives_skip_disconnected_peers(loop, test_swarm):
+    """A peer which has gone away is disconnected, and everyone else still gets their keepalive"""
+    s = test_swarm
+    peers = [add_peer(loop, s) for _ in range(3)]
+    for p in peers:
+        p._SwarmPeer__conn.written.clear()
+
+    def broken(packet):
+        raise BrokenPipeError()
+
+    gone = peers[0]
+    gone._SwarmPeer__conn.send = broken
+    loop.run_until_complete(s.send_keepalives())
+
+    assert s.peers == peers[1:]
+    for p in peers[1:]:
+        assert p._SwarmPeer__conn.written == [KeepalivePacket().serialize()]
@@ -0,0 +1,58 @@
+import os
+
+from collections import namedtuple
+from hashlib import sha1
+
+from hypothesis import given
+from hypothesis.strategies import data, integers, lists
+
+from bencode import Bencoded, bdecode, bdecode_buffer, bencode
+from torrent import FileIndex, Torrent
+
+File = namedtuple('File', ['offset', 'length'])
+
+
+def make_files(lengths: list) -> list:
+    files = []
+    offset = 0
+    for length in lengths:
+        files.append(File(offset, length))
+        offset += length
+
+    return files
+
+
+@given(lists(integers(0, 100), min_size=1), data())
+def test_file_index(lengths, d):
+    files = make_files(lengths)
+    index = FileIndex(files)
+    total = sum(lengths)
+
+    start = d.draw(integers(0, total))
+    length = d.draw(integers(0, total - start))
+
+    # The same files the old linear scan through end offsets found
+    expected = [f for f in files if f.offset + f.length > start]
+    assert list(index.files_from_offset(start)) == expected
+
+    expected = [f for f in expected if f.offset < start + length]
+    assert list(index.files_in_span(start, length)) == expected
+
+
+def test_info_hash():
+    for name in os.listdir('test/torrents'):
+        path = os.path.join('test/torrents', name)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        # The same as re-encoding the info dict
+        t = Torrent(path, '/nonexistent')
+        assert t.info_hash == sha1(bencode(bdecode(data)['info'])).digest()
+
+        # Decodes to what's encoded
+        d = bdecode_buffer(data)
+        assert bencode(d) == data
+
+        # The cached info dict can stand in for it
+        d['info'] = Bencoded(t.encoded_info)
+        assert bencode(d) == data
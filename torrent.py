@@ -1,6 +1,7 @@
 import os
 
-from bencode import bencode, bdecode
+from bencode import bdecode_torrent
+from bisect import bisect_right
 from hashlib import sha1
 
 
@@ -16,18 +17,16 @@ class TorrentFile:
         self.__length = length
         self.__offset = offset
         self.__path = os.path.join(download_dir, path)
-        os.makedirs(os.path.dirname(self.path), exist_ok=True)
 
+        # The file isn't opened (or created) until it's first read or written (see FilePool).
+        # Anything past existing_length was never downloaded.
         try:
-            self.__file = open(self.path, 'r+b')
-            self.__file.seek(0)
+            stat = os.stat(self.path)
+            self.__existing_length = min(stat.st_size, self.length)
+            self.__existing_mtime = stat.st_mtime_ns
         except FileNotFoundError:
-            self.__file = open(self.path, 'w+b')
-
-        self.__file.truncate(self.length)
-
-    def __close__(self):
-        self.file.close()
+            self.__existing_length = 0
+            self.__existing_mtime = None
 
     def __eq__(self, other):
         if issubclass(other, TorrentFile):
@@ -37,16 +36,21 @@ class TorrentFile:
     def __hash__(self):
         return self.length * 19 + self.offset + hash(self.path)
 
-    @property
-    def file(self):
-        """File handle for downloaded file on disk"""
-        return self.__file
-
     @property
     def length(self):
         """Number of bytes when downloaded"""
         return self.__length
 
+    @property
+    def existing_length(self):
+        """Number of bytes which were already on disk when the file was opened"""
+        return self.__existing_length
+
+    @property
+    def existing_mtime(self):
+        """When the file was last modified (in ns) before it was opened, or None if it didn't exist"""
+        return self.__existing_mtime
+
     @property
     def offset(self):
         """Number of bytes into the total download (in order according to files dict in .torrent)"""
@@ -58,11 +62,39 @@ class TorrentFile:
         return self.__path
 
 
+class FileIndex:
+    """Finds the files holding a span of the torrent's data, by binary search on where each file ends"""
+
+    def __init__(self, files: list):
+        self.files = files  # ordered by offset, anything with offset and length
+        self.end_offsets = [f.offset + f.length for f in files]
+
+    def first_file(self, start_offset: int) -> int:
+        """Index of the first file holding data at or after start_offset (skipping empty files at it)"""
+        return bisect_right(self.end_offsets, start_offset)
+
+    def files_from_offset(self, start_offset: int):
+        """The files holding start_offset and everything after it, in order"""
+        files = self.files
+        for i in range(self.first_file(start_offset), len(files)):
+            yield files[i]
+
+    def files_in_span(self, start_offset: int, length: int):
+        """Files holding any of the length bytes starting start_offset bytes into the torrent's data"""
+        end_offset = start_offset + length
+        for f in self.files_from_offset(start_offset):
+            if f.offset >= end_offset:
+                break
+
+            yield f
+
+
 class Torrent:
     def __init__(self, filename, download_dir):
         self.download_dir = download_dir
         with open(filename, 'rb') as f:
-            torrent_d = bdecode(f)
+            # The info hash is taken over the info dict exactly as it was encoded
+            torrent_d, info_buf = bdecode_torrent(f.read())
             print(f'Opening {filename}')
             print(torrent_d.keys())
             # print(torrent_d['info']['length'])
@@ -70,12 +102,13 @@ class Torrent:
             # print(torrent_d['info']['piece length'])
             # print(len(torrent_d['info']['pieces']))
             # print(torrent_d['info'].keys())
-            print(torrent_d['announce'])
+            print(torrent_d['announce'].decode())
 
             # Top Level Params
-            self.__announce_url = torrent_d['announce']
+            self.__announce_url = torrent_d['announce'].decode()
             self.__info = torrent_d['info']
-            self.__info_hash_b = sha1(bencode(self.info)).digest()
+            self.__encoded_info = info_buf
+            self.__info_hash_b = sha1(info_buf).digest()
 
             # Info parameters
             self.__files = []  # ordered list of tuples[starting piece index, file]
@@ -84,7 +117,7 @@ class Torrent:
             self.__piece_hashes = [raw_piece_hashes[i:i + 20] for i in range(0, len(raw_piece_hashes), 20)]
             try:
                 self.__length = self.info['length']
-                file_name = self.info['name']
+                file_name = self.name
                 f = TorrentFile(
                     length=self.__length,
                     offset=0,
@@ -99,7 +132,7 @@ class Torrent:
                 for file_dict in self.__info['files']:
                     print(file_dict.keys())
                     file_length = file_dict['length']
-                    file_name = '/'.join(file_dict['path'])
+                    file_name = '/'.join(p.decode() for p in file_dict['path'])
                     print(file_name)
 
                     f = TorrentFile(
@@ -114,10 +147,17 @@ class Torrent:
 
                     self.__length += file_length
 
+            self.__file_list = [f for _, f in self.__files]
+            self.__file_index = FileIndex(self.__file_list)
+
     @property
     def announce(self) -> str:
         return self.__announce_url
 
+    @property
+    def name(self) -> str:
+        return self.info['name'].decode()
+
     @property
     def download_length(self) -> int:
         return self.__length
@@ -125,7 +165,11 @@ class Torrent:
     # def files(self) -> list[]:
     @property
     def files(self) -> list:
-        return [f for _, f in self.__files]
+        return self.__file_list
+
+    @property
+    def file_index(self) -> FileIndex:
+        return self.__file_index
 
     @property
     def piece_length(self) -> int:
@@ -143,6 +187,11 @@ class Torrent:
     def info(self):
         return self.__info
 
+    @property
+    def encoded_info(self) -> bytes:
+        """The info dict as it was encoded in the .torrent, to reuse instead of bencoding info again"""
+        return self.__encoded_info
+
     @property
     def info_hash(self):
         return self.__info_hash_b
@@ -171,4 +220,4 @@ class Torrent:
     @property
     def end_offsets(self) -> list:
         """Returns ordered list[tuple] Map<end_offset, TorrentFile>"""
-        return [(off + f.length, f) for off, f in self.start_offsets]
+        return list(zip(self.__file_index.end_offsets, self.__file_list))
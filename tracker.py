@@ -1,14 +1,13 @@
 from abc import ABC, abstractmethod
 from collections import namedtuple
 from enum import Enum
-from hashlib import sha1
 from socket import inet_ntoa
 from struct import Struct
 from urllib.parse import urlencode, quote_from_bytes
 from urllib.request import urlopen
 from urllib.error import URLError
 
-from bencode import bencode, bdecode
+from bencode import bdecode_buffer
 
 # from swarm import SwarmPeer, PeerFinder
 from torrent import Torrent
@@ -66,10 +65,9 @@ class Tracker(PeerFinder):
             raise UnsupportedTrackerException(f'Tracker protocol not supported {announce_url}!')
 
         # Construct tracker HTTP request
-        info_hash = sha1(bencode(self.torrent.info)).digest()
         self.r = TrackerRequest(
             announce_url=self.torrent.announce,
-            info_hash=info_hash,
+            info_hash=self.torrent.info_hash,
             peer_id=self.pid,
             ip=self.host,
             port=self.port,
@@ -121,10 +119,10 @@ class TrackerRequest:
 
     @classmethod
     def decode_response(cls, resp_data: bytes):
-        data = bdecode(resp_data)
+        data = bdecode_buffer(resp_data)
         peers = data['peers']
         try:
-            return [Peer(p['peer id'], p['ip'], p['port']) for p in peers]
+            return [Peer(p['peer id'], p['ip'].decode(), p['port']) for p in peers]
         except TypeError as e:
             # raise e
             return cls.decode_compact_response(peers)